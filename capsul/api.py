@@ -18,5 +18,6 @@ from capsul.pipeline.pipeline_nodes import OptionalOutputSwitch
 from capsul.engine import capsul_engine
 from capsul.study_config.process_instance import get_process_instance
 from capsul.study_config.study_config import StudyConfig
+from capsul.study_config.memory import CachePolicy
 from capsul.utils.finder import find_processes
 
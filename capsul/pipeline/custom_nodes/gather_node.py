@@ -0,0 +1,110 @@
+
+from capsul.pipeline.pipeline_nodes import Node
+from soma.controller import Controller
+import traits.api as traits
+import sys
+
+if sys.version_info[0] >= 3:
+    xrange = range
+
+
+class GatherNode(Node):
+    '''
+    This "inert" node collects the outputs of parallel branches of a
+    pipeline (typically fed by a
+    :class:`~capsul.pipeline.custom_nodes.scatter_node.ScatterNode`) into a
+    single list, to be reduced by a downstream process. Processes using the
+    gathered list depend on all the branches in the workflow.
+
+    Inputs are named "input_0", "input_1"... If concatenate is True, inputs
+    are lists which are concatenated, otherwise each input is a single item.
+    Undefined inputs are skipped, so the output is updated as branches
+    outputs are set.
+    '''
+
+    def __init__(self, pipeline, name, inputs=2, concatenate=True,
+                 input_type=None):
+        '''
+        Parameters
+        ----------
+        pipeline: Pipeline
+            pipeline which will hold the node
+        name: str
+            node name
+        inputs: int
+            number of inputs (branches)
+        concatenate: bool
+            if True, inputs are lists which are concatenated, otherwise
+            inputs are items collected into the output list.
+        input_type: trait type
+            type of the list items
+        '''
+        in_traitsl = ['input_%d' % i for i in xrange(inputs)]
+        in_traits = [{'name': tr, 'optional': True} for tr in in_traitsl]
+        out_traits = [{'name': 'outputs', 'optional': True}]
+        super(GatherNode, self).__init__(pipeline, name, in_traits,
+                                         out_traits)
+        if input_type:
+            ptype = input_type
+        else:
+            ptype = traits.Any(traits.Undefined)
+
+        self._inputs = in_traitsl
+        self._concatenate = concatenate
+        for name in in_traitsl:
+            if concatenate:
+                self.add_trait(name, traits.List(ptype, output=False))
+            else:
+                self.add_trait(name, ptype)
+                self.trait(name).output = False
+        self.add_trait('outputs', traits.List(ptype, output=True))
+
+        self.set_callbacks()
+
+    def set_callbacks(self, update_callback=None):
+        if update_callback is None:
+            update_callback = self.gather_callback
+        for name in self._inputs:
+            self.on_trait_change(update_callback, name)
+
+    def gather_callback(self):
+        result = []
+        for name in self._inputs:
+            value = getattr(self, name)
+            if value in (None, traits.Undefined):
+                continue
+            if self._concatenate:
+                result += value
+            else:
+                result.append(value)
+        self.outputs = result
+
+    def configured_controller(self):
+        c = self.configure_controller()
+        c.inputs = len(self._inputs)
+        c.concatenate = self._concatenate
+        c.param_type = self.trait('outputs').inner_traits[0].trait_type \
+            .__class__.__name__
+        return c
+
+    @classmethod
+    def configure_controller(cls):
+        c = Controller()
+        c.add_trait('inputs', traits.Int(2))
+        c.add_trait('concatenate', traits.Bool(True))
+        c.add_trait('param_type', traits.Str('Any'))
+        return c
+
+    @classmethod
+    def build_node(cls, pipeline, name, conf_controller):
+        t = None
+        if conf_controller.param_type == 'Str':
+            t = traits.Str(traits.Undefined)
+        elif conf_controller.param_type == 'File':
+            t = traits.File(traits.Undefined)
+        elif conf_controller.param_type not in (None, traits.Undefined,
+                                                'Any'):
+            t = getattr(traits, conf_controller.param_type)()
+        node = GatherNode(pipeline, name, conf_controller.inputs,
+                          conf_controller.concatenate, input_type=t)
+        return node
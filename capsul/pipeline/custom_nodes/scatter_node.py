@@ -0,0 +1,92 @@
+
+from capsul.pipeline.pipeline_nodes import Node
+from soma.controller import Controller
+import traits.api as traits
+import sys
+
+if sys.version_info[0] >= 3:
+    xrange = range
+
+
+class ScatterNode(Node):
+    '''
+    This "inert" node splits its input list into contiguous chunks of
+    (almost) equal sizes, one on each of its outputs, to feed parallel
+    branches of a pipeline. As the workflow of a pipeline is built from its
+    processes only, each branch becomes a separate job (or group of jobs),
+    and branches are run in parallel.
+
+    Outputs are named "output_0", "output_1"... When the input list is
+    shorter than the number of outputs, the last outputs are empty lists.
+    '''
+
+    def __init__(self, pipeline, name, outputs=2, input_type=None):
+        '''
+        Parameters
+        ----------
+        pipeline: Pipeline
+            pipeline which will hold the node
+        name: str
+            node name
+        outputs: int
+            number of outputs (chunks)
+        input_type: trait type
+            type of the list items
+        '''
+        out_traitsl = ['output_%d' % i for i in xrange(outputs)]
+        in_traits = [{'name': 'inputs', 'optional': True}]
+        out_traits = [{'name': tr, 'optional': True} for tr in out_traitsl]
+        super(ScatterNode, self).__init__(pipeline, name, in_traits,
+                                          out_traits)
+        if input_type:
+            ptype = input_type
+        else:
+            ptype = traits.Any(traits.Undefined)
+
+        self._outputs = out_traitsl
+        self.add_trait('inputs', traits.List(ptype, output=False))
+        for name in out_traitsl:
+            self.add_trait(name, traits.List(ptype, output=True))
+
+        self.set_callbacks()
+
+    def set_callbacks(self, update_callback=None):
+        if update_callback is None:
+            update_callback = self.scatter_callback
+        self.on_trait_change(update_callback, 'inputs')
+
+    def scatter_callback(self):
+        size, remainder = divmod(len(self.inputs), len(self._outputs))
+        start = 0
+        for i, name in enumerate(self._outputs):
+            end = start + size + (1 if i < remainder else 0)
+            setattr(self, name, self.inputs[start:end])
+            start = end
+
+    def configured_controller(self):
+        c = self.configure_controller()
+        c.outputs = len(self._outputs)
+        c.param_type = self.trait('inputs').inner_traits[0].trait_type \
+            .__class__.__name__
+        return c
+
+    @classmethod
+    def configure_controller(cls):
+        c = Controller()
+        c.add_trait('outputs', traits.Int(2))
+        c.add_trait('param_type', traits.Str('Any'))
+        return c
+
+    @classmethod
+    def build_node(cls, pipeline, name, conf_controller):
+        t = None
+        if conf_controller.param_type == 'Str':
+            t = traits.Str(traits.Undefined)
+        elif conf_controller.param_type == 'File':
+            t = traits.File(traits.Undefined)
+        elif conf_controller.param_type not in (None, traits.Undefined,
+                                                'Any'):
+            t = getattr(traits, conf_controller.param_type)()
+        node = ScatterNode(pipeline, name, conf_controller.outputs,
+                           input_type=t)
+        return node
@@ -0,0 +1,136 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Dynamic iterations: iterations which size is only known at runtime.
+
+When the iterated inputs of a
+:py:class:`~capsul.pipeline.process_iteration.ProcessIteration` are the
+outputs of another process of the pipeline (for instance a list of detected
+lesions), their values are only known once this process has run. Such
+iterations cannot be expanded in a static soma-workflow workflow.
+
+With the ``dynamic_iterations_directory`` parameter of
+:py:func:`~capsul.pipeline.pipeline_workflow.workflow_from_pipeline`, the
+processes producing the iterated values write their outputs values in a
+JSON file of this directory, and the iteration becomes a
+:py:class:`DynamicIterationJob`. When this job is ready,
+:py:class:`~capsul.pipeline.local_workflow.LocalWorkflowEngine` reads these
+values and expands the iteration into parallel jobs.
+"""
+
+# System import
+from __future__ import print_function
+import os
+import sys
+import json
+import logging
+import six
+import soma_workflow.client as swclient
+
+# Trait import
+from traits.api import Undefined
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+
+def save_outputs(process, filename):
+    """ Write the output parameters values of a process in a JSON file.
+    Undefined values are written as null.
+
+    Parameters
+    ----------
+    process: Process
+        the executed process.
+    filename: str
+        the JSON file name.
+    """
+    outputs = {}
+    for name, trait in six.iteritems(process.user_traits()):
+        if trait.output:
+            value = getattr(process, name)
+            if value is Undefined:
+                value = None
+            outputs[name] = value
+    with open(filename, "w") as f:
+        json.dump(outputs, f)
+
+
+def load_outputs(filename):
+    """ Read the output parameters values written by :py:func:`save_outputs`.
+
+    Parameters
+    ----------
+    filename: str
+        the JSON file name.
+
+    Returns
+    -------
+    outputs: dict
+        the output parameters values, indexed by parameter name. Null values
+        are replaced with Undefined.
+    """
+    with open(filename) as f:
+        outputs = json.load(f)
+    return dict((name, Undefined if value is None else value)
+                for name, value in six.iteritems(outputs))
+
+
+class DynamicIterationJob(swclient.Job):
+    """ Placeholder job of an iteration expanded at runtime.
+
+    This job cannot be run by soma-workflow: it is expanded by
+    :py:class:`~capsul.pipeline.local_workflow.LocalWorkflowEngine` once the
+    jobs it depends on are done.
+
+    Attributes
+    ----------
+    iteration: ProcessIteration
+        the iteration process.
+    sources: dict
+        the iterated parameters values sources, indexed by parameter name:
+        (outputs file, output parameter name) tuples.
+    options: dict
+        the parameters of
+        :py:func:`~capsul.pipeline.pipeline_workflow.workflow_from_pipeline`
+        used to expand the iteration.
+    """
+    def __init__(self, iteration, sources, options, name=None, priority=0):
+        super(DynamicIterationJob, self).__init__(
+            command=[os.path.basename(sys.executable), "-c",
+                     "raise SystemExit(\"dynamic iterations must be expanded "
+                     "before they are run\")"],
+            name=name or iteration.name,
+            priority=priority)
+        self.iteration = iteration
+        self.sources = sources
+        self.options = options
+
+    def expand(self):
+        """ Set the iterated parameters from their sources, and build the
+        workflow of the iteration.
+
+        Returns
+        -------
+        workflow: Workflow
+            the soma-workflow workflow of the iteration.
+        """
+        from capsul.pipeline.pipeline_workflow import workflow_from_pipeline
+
+        outputs = {}
+        for name, (filename, source) in six.iteritems(self.sources):
+            if filename not in outputs:
+                outputs[filename] = load_outputs(filename)
+            value = outputs[filename].get(source, Undefined)
+            if value is Undefined:
+                value = []
+            setattr(self.iteration, name, value)
+        logger.debug("dynamic iteration {0}: {1} iterations".format(
+            self.name, max([len(getattr(self.iteration, name))
+                            for name in self.sources] + [0])))
+        return workflow_from_pipeline(self.iteration, **self.options)
@@ -0,0 +1,254 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Array jobs for iterations.
+
+An iteration over N values normally becomes N soma-workflow jobs. Cluster
+schedulers supporting array jobs may instead run a single job N times, each
+run getting its index in an environment variable. The commands of the
+iterations are stored in a side file, and the array job runs:
+
+::
+
+    python -m capsul.pipeline.job_array <commands file> --array [<variable>]
+
+The index is taken from the scheduler environment variable given on the
+command line, or from the known scheduler variables (see
+:py:data:`array_index_variables`). Jobs submitted as arrays without index
+run all the commands sequentially, so that array jobs still work on
+schedulers (or soma-workflow resources) without array support. Jobs which
+are not submitted as arrays never read the index variables, which may be
+inherited from an enclosing array job, and run all the commands:
+
+::
+
+    python -m capsul.pipeline.job_array <commands file> [<index>]
+
+Array jobs are normally requested through the ``job_arrays_directory``
+parameter of
+:py:func:`~capsul.pipeline.pipeline_workflow.workflow_from_pipeline`.
+"""
+
+# System import
+from __future__ import print_function
+import os
+import sys
+import json
+import tempfile
+import logging
+import soma_workflow.client as swclient
+
+# Capsul import
+from capsul.pipeline.job_fusion import run_commands
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+# Environment variables holding the array index: (name, first index)
+array_index_variables = [
+    ("SLURM_ARRAY_TASK_ID", 0),
+    ("PBS_ARRAY_INDEX", 0),
+    ("PBS_ARRAYID", 0),
+    ("SGE_TASK_ID", 1),
+]
+
+# Native specifications of array jobs, formatted with the array size and
+# last index
+array_specifications = {
+    "slurm": "--array=0-{last}",
+    "pbs": "-t 0-{last}",
+    "pbspro": "-J 0-{last}",
+    "sge": "-t 1-{size}",
+}
+
+# Environment variables holding the array index of the schedulers in
+# array_specifications
+array_specification_variables = {
+    "slurm": "SLURM_ARRAY_TASK_ID",
+    "pbs": "PBS_ARRAYID",
+    "pbspro": "PBS_ARRAY_INDEX",
+    "sge": "SGE_TASK_ID",
+}
+
+
+def array_native_specification(specification, size):
+    """ Get the native specification of an array job.
+
+    Parameters
+    ----------
+    specification: str
+        a scheduler name in :py:data:`array_specifications`, or a format
+        string using the {size} and {last} fields.
+    size: int
+        the number of array elements.
+
+    Returns
+    -------
+    native_specification: str
+        the array job native specification.
+    """
+    specification = array_specifications.get(specification, specification)
+    return specification.format(size=size, last=size - 1)
+
+
+def plain_command(command):
+    """ Convert a job command to a list of strings, as soma-workflow does
+    when it runs the job.
+
+    Parameters
+    ----------
+    command: list
+        the job command.
+
+    Returns
+    -------
+    command: list of str
+        the plain command, None if it holds soma-workflow special paths.
+    """
+    def plain_element(element):
+        if isinstance(element, (list, tuple)):
+            element = [plain_element(item) for item in element]
+            if None in element:
+                return None
+            return str(repr(element)).replace("'", '"')
+        if isinstance(element, swclient.SpecialPath):
+            return None
+        return str(element)
+
+    plain = [plain_element(element) for element in command]
+    if None in plain:
+        return None
+    return plain
+
+
+def array_job(name, commands, directory, array_specification=None,
+              priority=0, native_specification=None, step_name=""):
+    """ Build an array job running commands given by their index.
+
+    Parameters
+    ----------
+    name: str
+        the job name.
+    commands: list
+        the commands of the array elements, as lists of strings (see
+        :py:func:`plain_command`).
+    directory: str
+        directory where the commands side file is written. It must be
+        readable from the computing resource.
+    array_specification: str (optional)
+        the array native specification (see
+        :py:func:`array_native_specification`). If not specified, the job is
+        not submitted as an array and runs all the commands.
+    priority: int (optional)
+        the job priority.
+    native_specification: str (optional)
+        other native specifications of the job.
+    step_name: str (optional)
+        the step name stored in the job user_storage variable.
+
+    Returns
+    -------
+    job: Job
+        the soma-workflow job.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, filename = tempfile.mkstemp(prefix=name + "_", suffix=".json",
+                                    dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"commands": commands}, f)
+    command = [os.path.basename(sys.executable), "-m",
+               "capsul.pipeline.job_array", filename]
+    if array_specification:
+        command.append("--array")
+        variable = array_specification_variables.get(array_specification)
+        if variable is not None:
+            command.append(variable)
+        array_spec = array_native_specification(array_specification,
+                                                len(commands))
+        if native_specification:
+            native_specification = native_specification + " " + array_spec
+        else:
+            native_specification = array_spec
+    job = swclient.Job(
+        name=name,
+        command=command,
+        priority=priority,
+        native_specification=native_specification)
+    if step_name:
+        job.user_storage = step_name
+    return job
+
+
+def array_index(variable=None):
+    """ Get the array index of the running job from the scheduler
+    environment variables.
+
+    Parameters
+    ----------
+    variable: str (optional)
+        the environment variable holding the index, one of
+        :py:data:`array_index_variables`. If not specified, all the known
+        variables are looked for.
+
+    Returns
+    -------
+    index: int
+        the 0-based index, None if the job is not an array element.
+    """
+    variables = array_index_variables
+    if variable is not None:
+        variables = [(name, first_index)
+                     for name, first_index in array_index_variables
+                     if name == variable]
+        if not variables:
+            raise ValueError("unknown array index variable '{0}'".format(
+                variable))
+    for variable, first_index in variables:
+        value = os.environ.get(variable)
+        if value not in (None, "", "undefined"):
+            try:
+                return int(value) - first_index
+            except ValueError:
+                # not an array job (PBS sets it anyway)
+                pass
+    return None
+
+
+def main(args):
+    """ Run the command(s) of an array job.
+
+    Parameters
+    ----------
+    args: list of str
+        the commands file, followed by an explicit index, or by '--array'
+        and optionally the index environment variable for jobs submitted
+        as arrays.
+    """
+    with open(args[0]) as f:
+        commands = json.load(f)["commands"]
+    index = None
+    if len(args) >= 2:
+        if args[1] == "--array":
+            index = array_index(args[2] if len(args) >= 3 else None)
+        else:
+            index = int(args[1])
+    if index is None:
+        logger.info("no array index: running the {0} commands".format(
+            len(commands)))
+        run_commands(commands)
+    else:
+        if index < 0 or index >= len(commands):
+            raise ValueError(
+                "array index {0} out of range: {1} commands in '{2}'".format(
+                    index, len(commands), args[0]))
+        run_commands([commands[index]])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,369 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Fusion of small soma-workflow jobs.
+
+On a cluster, every job waits in the scheduler queue: chains of processes
+running a few seconds each spend more time queued than running. Such jobs
+may be fused into a single job, which runs their commands sequentially in
+the same interpreter:
+
+::
+
+    python -m capsul.pipeline.job_fusion <n1> <command 1> <n2> <command 2>
+
+where each command is given as its number of arguments followed by the
+arguments. Python commands (``python -c <code> <args>``), as generated by
+:py:meth:`Process.get_commandline`, are executed in the runner interpreter,
+other commands are run as sub-processes.
+
+Job fusion is normally requested through the ``fusion_max_runtime``
+parameter of
+:py:func:`~capsul.pipeline.pipeline_workflow.workflow_from_pipeline`.
+"""
+
+# System import
+from __future__ import print_function
+import os
+import sys
+import logging
+import six
+import soma.subprocess
+import soma_workflow.client as swclient
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+
+def _is_fusible(job, runtimes, max_runtime):
+    """ Check if a job may be fused with other ones.
+    """
+    runtime = runtimes.get(job)
+    return (type(job) is swclient.Job
+            and runtime is not None and runtime <= max_runtime
+            and isinstance(job.command, (list, tuple)) and job.command
+            and not job.parallel_job_info and job.stdin is None
+            and job.working_directory is None and not job.env)
+
+
+def _is_python_command(command):
+    """ Check if a command is a python code execution (``python -c``).
+    """
+    return (len(command) >= 3 and command[1] == "-c"
+            and os.path.basename(command[0]).startswith("python"))
+
+
+def fused_job(jobs, name=None):
+    """ Build a job running the commands of several jobs, in order.
+
+    Parameters
+    ----------
+    jobs: list of Job
+        the fused jobs, in execution order.
+    name: str (optional)
+        the fused job name. Jobs names are joined with '+' by default.
+
+    Returns
+    -------
+    job: Job
+        the soma-workflow job.
+    """
+    if _is_python_command(jobs[0].command):
+        python_command = jobs[0].command[0]
+    else:
+        python_command = os.path.basename(sys.executable)
+    command = [python_command, "-m", "capsul.pipeline.job_fusion"]
+    input_files = []
+    output_files = []
+    for job in jobs:
+        command += [str(len(job.command))] + list(job.command)
+        # files written by previous jobs do not have to be transferred
+        input_files += [path for path in job.referenced_input_files
+                        if path not in output_files
+                        and path not in input_files]
+        output_files += [path for path in job.referenced_output_files
+                         if path not in output_files]
+    if name is None:
+        name = "+".join(job.name for job in jobs)
+    job = swclient.Job(
+        name=name,
+        command=command,
+        referenced_input_files=input_files,
+        referenced_output_files=output_files,
+        priority=max(job.priority for job in jobs),
+        native_specification=jobs[0].native_specification)
+    if jobs[0].user_storage:
+        job.user_storage = jobs[0].user_storage
+    return job
+
+
+def _group_jobs(group):
+    """ Get the jobs of a group and of its sub-groups.
+    """
+    jobs = []
+    for element in group.elements:
+        if isinstance(element, swclient.Group):
+            jobs += _group_jobs(element)
+        else:
+            jobs.append(element)
+    return jobs
+
+
+def _expand_group_dependencies(dependencies):
+    """ Replace dependencies on groups by dependencies between their jobs.
+
+    A job depending on a group depends on the last jobs of the group, and
+    a group depending on a job has its first jobs depend on it.
+    """
+    group_dependencies = [dependency for dependency in dependencies
+                          if isinstance(dependency[0], swclient.Group)
+                          or isinstance(dependency[1], swclient.Group)]
+    if not group_dependencies:
+        return dependencies
+    successors = {}
+    predecessors = {}
+    for source, dest in dependencies:
+        successors.setdefault(source, set()).add(dest)
+        predecessors.setdefault(dest, set()).add(source)
+
+    def bounds(element, links):
+        # first (or last) jobs of an element
+        if not isinstance(element, swclient.Group):
+            return [element]
+        elements = set(element.elements)
+        return [job for child in element.elements
+                if not links.get(child, set()) & elements
+                for job in bounds(child, links)]
+
+    dependencies = set(dependencies).difference(group_dependencies)
+    for source, dest in group_dependencies:
+        dependencies.update(
+            (source_job, dest_job)
+            for source_job in bounds(source, successors)
+            for dest_job in bounds(dest, predecessors))
+    return dependencies
+
+
+def _replace_elements(elements, replaced):
+    """ Replace jobs or groups in a tree of groups.
+
+    Parameters
+    ----------
+    elements: list
+        the jobs and groups to update.
+    replaced: dict
+        map the replaced elements to their replacement, or to None if they
+        are removed.
+
+    Returns
+    -------
+    elements: list
+        the new elements. Emptied groups are removed.
+    """
+    new_elements = []
+    for element in elements:
+        if element in replaced:
+            element = replaced[element]
+            if element is None or element in new_elements:
+                continue
+        elif isinstance(element, swclient.Group):
+            element.elements = _replace_elements(element.elements, replaced)
+            if not element.elements:
+                continue
+        new_elements.append(element)
+    return new_elements
+
+
+def fuse_jobs(jobs, dependencies, root_group, runtimes, max_runtime,
+              groups=()):
+    """ Fuse the linear chains of short jobs of a workflow.
+
+    Consecutive jobs A and B are fused when A is the only dependency of B,
+    B is the only job depending on A, and their total estimated runtime is
+    below max_runtime. Jobs with an unknown runtime, parallel jobs, or jobs
+    with specific execution settings (stdin, working directory,
+    environment) are never fused.
+
+    Dependencies on groups are replaced with dependencies on their jobs.
+    Whole groups of jobs (typically sub-pipelines) may also be fused,
+    whatever their structure, if their jobs total runtime is below
+    max_runtime and no job outside the group both depends on a group job and
+    is a dependency of another one.
+
+    Parameters
+    ----------
+    jobs: list of Job
+        the workflow jobs.
+    dependencies: set of (Job, Job) tuples
+        the workflow dependencies.
+    root_group: list
+        the workflow root jobs and groups. Groups are modified in place.
+    runtimes: dict
+        estimated runtime of jobs, in seconds.
+    max_runtime: float
+        maximum estimated runtime of a fused job, in seconds.
+    groups: sequence of Group (optional)
+        groups which jobs may be fused into a single job.
+
+    Returns
+    -------
+    jobs: list of Job
+        the new workflow jobs.
+    dependencies: set of (Job, Job) tuples
+        the new workflow dependencies.
+    root_group: list
+        the new root jobs and groups.
+    """
+    jobs = list(jobs)
+    dependencies = _expand_group_dependencies(dependencies)
+    successors = dict((job, set()) for job in jobs)
+    predecessors = dict((job, set()) for job in jobs)
+    for source, dest in dependencies:
+        successors[source].add(dest)
+        predecessors[dest].add(source)
+
+    def fusible(job):
+        return _is_fusible(job, runtimes, max_runtime)
+
+    def topological_order(members):
+        members = set(members)
+        count = dict((job, len(predecessors[job] & members))
+                     for job in members)
+        ready = [job for job in jobs if job in members and count[job] == 0]
+        ordered = []
+        while ready:
+            job = ready.pop(0)
+            ordered.append(job)
+            for successor in successors[job] & members:
+                count[successor] -= 1
+                if count[successor] == 0:
+                    ready.append(successor)
+        return ordered
+
+    def reenters(members):
+        # check that no path goes out of members and comes back
+        members = set(members)
+        todo = [job for member in members for job in successors[member]
+                if job not in members]
+        done = set()
+        while todo:
+            job = todo.pop()
+            if job in members:
+                return True
+            if job not in done:
+                done.add(job)
+                todo += successors[job]
+        return False
+
+    fused = {}
+    replaced = {}
+
+    def fuse(members, name=None):
+        job = fused_job(members, name)
+        for member in members:
+            fused[member] = job
+            replaced[member] = None
+        replaced[members[0]] = job
+        runtimes[job] = sum(runtimes[member] for member in members)
+        return job
+
+    # fuse groups, larger ones first
+    for group in sorted(groups, key=lambda group: -len(_group_jobs(group))):
+        members = _group_jobs(group)
+        if len(members) < 2 \
+                or any(job in fused or not fusible(job) for job in members) \
+                or sum(runtimes[job] for job in members) > max_runtime \
+                or len(set(job.native_specification
+                           for job in members)) != 1 \
+                or reenters(members):
+            continue
+        job = fuse(topological_order(members), group.name)
+        for member in members:
+            replaced[member] = None
+        replaced[group] = job
+
+    # fuse chains of remaining jobs
+    for job in topological_order(jobs):
+        if job in fused or not fusible(job):
+            continue
+        chain = [job]
+        runtime = runtimes[job]
+        while len(successors[job]) == 1:
+            successor = next(iter(successors[job]))
+            if successor in fused or not fusible(successor) \
+                    or len(predecessors[successor]) != 1 \
+                    or successor.native_specification \
+                        != chain[0].native_specification \
+                    or runtime + runtimes[successor] > max_runtime:
+                break
+            chain.append(successor)
+            runtime += runtimes[successor]
+            job = successor
+        if len(chain) >= 2:
+            fuse(chain)
+
+    if not fused:
+        return jobs, dependencies, root_group
+    logger.debug("{0} jobs fused into {1} jobs".format(
+        len(fused), len(set(six.itervalues(fused)))))
+    new_jobs = []
+    for job in jobs:
+        job = fused.get(job, job)
+        if job not in new_jobs:
+            new_jobs.append(job)
+    new_dependencies = set()
+    for source, dest in dependencies:
+        source = fused.get(source, source)
+        dest = fused.get(dest, dest)
+        if source is not dest:
+            new_dependencies.add((source, dest))
+    root_group = _replace_elements(root_group, replaced)
+    return new_jobs, new_dependencies, root_group
+
+
+def run_commands(commands):
+    """ Run commands sequentially, python ones in the current interpreter.
+
+    Parameters
+    ----------
+    commands: list of list of str
+        the commands.
+    """
+    for command in commands:
+        print("* running:", " ".join(command))
+        sys.stdout.flush()
+        if _is_python_command(command):
+            saved_argv = sys.argv
+            sys.argv = ["-c"] + command[3:]
+            try:
+                exec(compile(command[2], "<string>", "exec"),
+                     {"__name__": "__main__"})
+            except SystemExit as e:
+                if e.code:
+                    raise
+            finally:
+                sys.argv = saved_argv
+        else:
+            soma.subprocess.check_call(command)
+
+
+def main(args):
+    """ Decode commands given as their number of arguments followed by the
+    arguments, and run them.
+    """
+    commands = []
+    i = 0
+    while i < len(args):
+        length = int(args[i])
+        commands.append(args[i + 1:i + 1 + length])
+        i += length + 1
+    run_commands(commands)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,399 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Local execution of soma-workflow workflows, without soma-workflow
+server or database.
+
+Workflows generated by
+:py:func:`~capsul.pipeline.pipeline_workflow.workflow_from_pipeline` (with
+their groups, temporary files, file transfers and shared resource paths) are
+run on the local machine by a pool of worker threads, each running a job
+command as a sub-process:
+
+::
+
+    workflow = workflow_from_pipeline(pipeline)
+    engine = LocalWorkflowEngine(workers=4)
+    failed_jobs = engine.run(workflow)
+
+Jobs are run as soon as the jobs they depend on are done, by priority order.
+Jobs depending on a failed job are not run. Each job has its standard
+output and error written in the engine log directory.
+
+Dynamic iterations (see :py:mod:`capsul.pipeline.dynamic_iteration`) are
+expanded into parallel jobs once the jobs they depend on are done.
+"""
+
+# System import
+from __future__ import print_function
+import os
+import time
+import shutil
+import tempfile
+import logging
+import six
+from six.moves import queue
+from multiprocessing.pool import ThreadPool
+import soma.subprocess
+import soma_workflow.client as swclient
+import soma_workflow.constants as swconstants
+
+# Capsul import
+from capsul.pipeline.dynamic_iteration import DynamicIterationJob
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+
+class LocalWorkflowEngine(object):
+    """ Run soma-workflow workflows on the local machine.
+
+    Attributes
+    ----------
+    workers: int
+        the number of jobs run in parallel.
+    log_directory: str
+        the directory of jobs standard output and error files.
+    jobs_status: dict
+        the jobs status (soma-workflow constants: NOT_SUBMITTED, RUNNING,
+        DONE or FAILED), indexed by job.
+    jobs_exit: dict
+        the jobs (exit status, exit value) (soma-workflow constants
+        FINISHED_REGULARLY, EXIT_ABORTED or EXIT_NOTRUN, and the command
+        return code).
+    jobs_times: dict
+        the jobs (start time, end time).
+    jobs_log: dict
+        the jobs (standard output file, standard error file). The standard
+        error file is None when it is joined to the standard output.
+    expanded_jobs: dict
+        the jobs of expanded dynamic iterations, indexed by dynamic
+        iteration job. A dynamic iteration fails as soon as one of its jobs
+        fails.
+    """
+    def __init__(self, workers=None, log_directory=None, shared_paths=None,
+                 status_callback=None):
+        """ Initialize the LocalWorkflowEngine class.
+
+        Parameters
+        ----------
+        workers: int (optional)
+            the number of jobs run in parallel, the number of CPUs by
+            default.
+        log_directory: str (optional)
+            the directory of jobs standard output and error files. A
+            temporary directory is created by default, and is not removed.
+        shared_paths: dict (optional)
+            shared resource paths translations, as in capsul computing
+            resources configuration: {base_dir: (namespace, uuid)}.
+        status_callback: callable (optional)
+            function called with (job, status) each time a job status
+            changes.
+        """
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        if log_directory is None:
+            log_directory = tempfile.mkdtemp(prefix="capsul_local_workflow_")
+        self.log_directory = log_directory
+        self.shared_paths = dict(((namespace, uuid), base_dir)
+                                 for base_dir, (namespace, uuid)
+                                 in six.iteritems(shared_paths or {}))
+        self.status_callback = status_callback
+        self.jobs_status = {}
+        self.jobs_exit = {}
+        self.jobs_times = {}
+        self.jobs_log = {}
+        self.expanded_jobs = {}
+        self._iteration_jobs = {}
+        self._temporary_paths = {}
+        self._temporary_directory = None
+
+    def _set_status(self, job, status):
+        self.jobs_status[job] = status
+        if self.status_callback is not None:
+            self.status_callback(job, status)
+
+    def _set_failed(self, job, failed_jobs):
+        """ Mark a job as failed, with the dynamic iterations it belongs to.
+        """
+        self._set_status(job, swconstants.FAILED)
+        failed_jobs.append(job)
+        iteration_job = self._iteration_jobs.get(job)
+        if iteration_job is not None \
+                and self.jobs_status[iteration_job] != swconstants.FAILED:
+            logger.error("dynamic iteration {0} failed".format(
+                iteration_job.name))
+            self.jobs_exit[iteration_job] = (swconstants.EXIT_ABORTED, None)
+            self._set_failed(iteration_job, failed_jobs)
+
+    def _special_path(self, path):
+        """ Get the local path of a soma-workflow special path.
+        """
+        referent = path.referent()
+        if isinstance(referent, swclient.FileTransfer):
+            return referent.client_path
+        if isinstance(referent, swclient.TemporaryPath):
+            local_path = self._temporary_paths.get(referent)
+            if local_path is None:
+                if referent.is_directory:
+                    local_path = tempfile.mkdtemp(
+                        dir=self._temporary_directory,
+                        suffix=referent.suffix)
+                else:
+                    fd, local_path = tempfile.mkstemp(
+                        dir=self._temporary_directory,
+                        suffix=referent.suffix)
+                    os.close(fd)
+                    os.unlink(local_path)
+                self._temporary_paths[referent] = local_path
+            return local_path
+        if isinstance(referent, swclient.SharedResourcePath):
+            base_dir = self.shared_paths.get((referent.namespace,
+                                              referent.uuid))
+            if base_dir is None:
+                raise ValueError(
+                    "no translation for shared resource path {0}:{1}".format(
+                        referent.namespace, referent.uuid))
+            return os.path.join(base_dir, referent.relative_path)
+        raise TypeError("unsupported path: {0}".format(path))
+
+    def resolve(self, element, in_list=False):
+        """ Convert a job command element to a string, as soma-workflow does.
+
+        Parameters
+        ----------
+        element: str, list, tuple or SpecialPath
+            the command element.
+        in_list: bool (optional, default False)
+            True for elements of command elements lists, which are converted
+            to their string representation.
+
+        Returns
+        -------
+        element: str or list of str
+            the converted element (a list for the whole command).
+        """
+        if isinstance(element, tuple):
+            # (FileTransfer directory, file name)
+            return os.path.join(self.resolve(element[0]), element[1])
+        if isinstance(element, list):
+            resolved = [self.resolve(item, True) for item in element]
+            if in_list:
+                return str(repr(resolved)).replace("'", '"')
+            return resolved
+        if isinstance(element, swclient.SpecialPath):
+            return element.pattern % self._special_path(element)
+        return str(element)
+
+    def _prepare_job(self, job, index):
+        """ Resolve the command and files of a job. Temporary paths are
+        created here, in the engine thread.
+        """
+        basename = "{0}_{1}".format(
+            index, "".join(c if c.isalnum() else "_" for c in job.name))
+        if job.stdout_file:
+            stdout_file = self.resolve(job.stdout_file)
+        else:
+            stdout_file = os.path.join(self.log_directory,
+                                       basename + ".stdout")
+        if job.join_stderrout:
+            stderr_file = None
+        elif job.stderr_file:
+            stderr_file = self.resolve(job.stderr_file)
+        else:
+            stderr_file = os.path.join(self.log_directory,
+                                       basename + ".stderr")
+        self.jobs_log[job] = (stdout_file, stderr_file)
+        env = None
+        if job.env:
+            env = dict(os.environ)
+            env.update(job.env)
+        return {"command": self.resolve(job.command),
+                "stdout_file": stdout_file,
+                "stderr_file": stderr_file,
+                "stdin": job.stdin and self.resolve(job.stdin) or None,
+                "cwd": job.working_directory
+                    and self.resolve(job.working_directory) or None,
+                "env": env}
+
+    def _run_job(self, job, settings, finished):
+        """ Run a job command and wait for it, in a worker thread. The job
+        result is always put in the finished queue, even if an unexpected
+        error occurs, so that the engine never waits for it forever.
+        """
+        start_time = time.time()
+        exit_status = swconstants.EXIT_ABORTED
+        returncode = None
+        try:
+            stdin = None
+            if settings["stdin"]:
+                stdin = open(settings["stdin"])
+            try:
+                with open(settings["stdout_file"], "w") as stdout:
+                    if settings["stderr_file"] is None:
+                        returncode = soma.subprocess.call(
+                            settings["command"], stdin=stdin, stdout=stdout,
+                            stderr=soma.subprocess.STDOUT,
+                            cwd=settings["cwd"], env=settings["env"])
+                    else:
+                        with open(settings["stderr_file"], "w") as stderr:
+                            returncode = soma.subprocess.call(
+                                settings["command"], stdin=stdin,
+                                stdout=stdout, stderr=stderr,
+                                cwd=settings["cwd"], env=settings["env"])
+            finally:
+                if stdin is not None:
+                    stdin.close()
+            exit_status = swconstants.FINISHED_REGULARLY
+        except BaseException as e:
+            # errors must not escape the worker thread: the pool would wait
+            # for the job forever
+            logger.error("job {0} could not be run: {1!r}".format(job.name,
+                                                                   e))
+        finally:
+            finished.put((job, exit_status, returncode, start_time,
+                          time.time()))
+
+    def _expand_job(self, job, jobs, job_indices, successors, waiting):
+        """ Expand a dynamic iteration job, and insert the jobs of the
+        iteration workflow before it. The dynamic iteration job then ends
+        with them, as a barrier.
+        """
+        workflow = job.expand()
+        sub_jobs = list(workflow.jobs)
+        self.expanded_jobs[job] = sub_jobs
+        for sub_job in sub_jobs:
+            self._iteration_jobs[sub_job] = job
+            job_indices[sub_job] = len(jobs)
+            jobs.append(sub_job)
+            successors[sub_job] = []
+            waiting[sub_job] = 0
+            self.jobs_status[sub_job] = swconstants.NOT_SUBMITTED
+            self.jobs_exit[sub_job] = (swconstants.EXIT_NOTRUN, None)
+        for source, dest in workflow.dependencies:
+            successors[source].append(dest)
+            waiting[dest] += 1
+        for sub_job in sub_jobs:
+            if not successors[sub_job]:
+                successors[sub_job].append(job)
+                waiting[job] += 1
+        return sub_jobs
+
+    def run(self, workflow):
+        """ Run a workflow, and wait for its end.
+
+        Parameters
+        ----------
+        workflow: Workflow
+            the soma-workflow workflow.
+
+        Returns
+        -------
+        failed_jobs: list of Job
+            the failed jobs. Jobs depending on them are not run.
+        """
+        jobs = list(workflow.jobs)
+        self.expanded_jobs = {}
+        self._iteration_jobs = {}
+        job_indices = dict((job, index) for index, job in enumerate(jobs))
+        successors = dict((job, []) for job in jobs)
+        waiting = dict((job, 0) for job in jobs)
+        for source, dest in workflow.dependencies:
+            successors[source].append(dest)
+            waiting[dest] += 1
+        self.jobs_status = dict((job, swconstants.NOT_SUBMITTED)
+                                for job in jobs)
+        self.jobs_exit = dict((job, (swconstants.EXIT_NOTRUN, None))
+                              for job in jobs)
+        self.jobs_times = {}
+        self.jobs_log = {}
+        if not os.path.isdir(self.log_directory):
+            os.makedirs(self.log_directory)
+        self._temporary_paths = {}
+        self._temporary_directory = tempfile.mkdtemp(
+            prefix="capsul_local_workflow_tmp_")
+
+        ready = [job for job in jobs if waiting[job] == 0]
+        finished = queue.Queue()
+        failed_jobs = []
+        running = 0
+        pool = ThreadPool(self.workers)
+        try:
+            while ready or running:
+                # submit ready jobs, high priorities first
+                ready.sort(key=lambda job: (-job.priority, job_indices[job]))
+                while ready:
+                    job = ready.pop(0)
+                    if isinstance(job, DynamicIterationJob) \
+                            and job not in self.expanded_jobs:
+                        try:
+                            sub_jobs = self._expand_job(
+                                job, jobs, job_indices, successors, waiting)
+                        except Exception as e:
+                            logger.error(
+                                "dynamic iteration {0} could not be "
+                                "expanded: {1}".format(job.name, e))
+                            self.jobs_exit[job] = (
+                                swconstants.EXIT_ABORTED, None)
+                            self._set_failed(job, failed_jobs)
+                            continue
+                        self._set_status(job, swconstants.RUNNING)
+                        ready += [sub_job for sub_job in sub_jobs
+                                  if waiting[sub_job] == 0]
+                        if waiting[job] == 0:
+                            # empty iteration
+                            ready.append(job)
+                        continue
+                    if isinstance(job, (swclient.BarrierJob,
+                                        DynamicIterationJob)):
+                        self._set_status(job, swconstants.DONE)
+                        self.jobs_exit[job] = (
+                            swconstants.FINISHED_REGULARLY, 0)
+                        for successor in successors[job]:
+                            waiting[successor] -= 1
+                            if waiting[successor] == 0:
+                                ready.append(successor)
+                        continue
+                    try:
+                        settings = self._prepare_job(job, job_indices[job])
+                    except Exception as e:
+                        logger.error("job {0} could not be run: {1}".format(
+                            job.name, e))
+                        self.jobs_exit[job] = (swconstants.EXIT_ABORTED,
+                                               None)
+                        self._set_failed(job, failed_jobs)
+                        continue
+                    self._set_status(job, swconstants.RUNNING)
+                    pool.apply_async(self._run_job,
+                                     (job, settings, finished))
+                    running += 1
+                if not running:
+                    break
+                job, exit_status, returncode, start_time, end_time \
+                    = finished.get()
+                running -= 1
+                self.jobs_exit[job] = (exit_status, returncode)
+                self.jobs_times[job] = (start_time, end_time)
+                if exit_status == swconstants.FINISHED_REGULARLY \
+                        and returncode == 0:
+                    self._set_status(job, swconstants.DONE)
+                    for successor in successors[job]:
+                        waiting[successor] -= 1
+                        if waiting[successor] == 0:
+                            ready.append(successor)
+                else:
+                    logger.error("job {0} failed".format(job.name))
+                    self._set_failed(job, failed_jobs)
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(self._temporary_directory, ignore_errors=True)
+            self._temporary_paths = {}
+        return failed_jobs
@@ -35,6 +35,7 @@ except ImportError:
 
 # Capsul import
 from capsul.process.process import Process, NipypeProcess
+from capsul.utils.formats import associated_files
 from .topological_sort import GraphNode
 from .topological_sort import Graph
 from .pipeline_nodes import Plug
@@ -1380,7 +1381,8 @@ class Pipeline(Process):
 
         return graph
 
-    def workflow_ordered_nodes(self, remove_disabled_steps=True):
+    def workflow_ordered_nodes(self, remove_disabled_steps=True,
+                               unexpanded_pipelines=None):
         """ Generate a workflow: list of process node to execute
 
         Returns
@@ -1391,14 +1393,20 @@ class Pipeline(Process):
             When set, disabled steps (and their children) will not be included
             in the workflow graph.
             Default: True
+        unexpanded_pipelines: list of str (optional)
+            names (dotted paths from this pipeline) of sub-pipeline nodes
+            which are returned as single nodes instead of being replaced by
+            their internal nodes.
         """
+        unexpanded_pipelines = set(unexpanded_pipelines or [])
+
         # Create a graph and a list of graph node edges
         graph = self.workflow_graph(remove_disabled_steps)
 
         # Start the topologival sort
         ordered_list = graph.topological_sort()
 
-        def walk_workflow(wokflow, workflow_list):
+        def walk_workflow(wokflow, workflow_list, pipeline, prefix):
             """ Recursive fonction to go through pipelines' graphs
             """
             # Go through all the workflows
@@ -1408,11 +1416,17 @@ class Pipeline(Process):
                 if isinstance(sub_workflow[1], list):
                     workflow_list.extend(sub_workflow[1])
 
+                # Keep the sub-pipeline node as a whole if requested
+                elif prefix + sub_workflow[0] in unexpanded_pipelines:
+                    workflow_list.append(pipeline.nodes[sub_workflow[0]])
+
                 # Otherwise we need to call the topological sort in order to
                 # sort the graph and than flat the graph structure
                 else:
                     flat_structure = sub_workflow[1].topological_sort()
-                    walk_workflow(flat_structure, workflow_list)
+                    walk_workflow(flat_structure, workflow_list,
+                                  sub_workflow[1].pipeline,
+                                  prefix + sub_workflow[0] + ".")
 
         # Generate the output workflow representation
         self.workflow_repr = "->".join([x[0] for x in ordered_list])
@@ -1420,7 +1434,7 @@ class Pipeline(Process):
 
         # Generate the final workflow by flattenin graphs structures
         workflow_list = []
-        walk_workflow(ordered_list, workflow_list)
+        walk_workflow(ordered_list, workflow_list, self, "")
 
         return workflow_list
 
@@ -1542,10 +1556,9 @@ class Pipeline(Process):
                     except:
                         pass
                 # handle additional files (.hdr, .minf...)
-                # TODO
-                if os.path.exists(tmpfile + '.minf'):
+                for extra in associated_files(tmpfile, existing_only=True):
                     try:
-                        os.unlink(tmpfile + '.minf')
+                        os.unlink(extra)
                     except:
                         pass
 
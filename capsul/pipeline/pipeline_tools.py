@@ -18,6 +18,7 @@ import sys
 import json
 from datetime import date, time, datetime
 import io
+from collections import deque
 
 # Define the logger
 logger = logging.getLogger(__name__)
@@ -32,6 +33,7 @@ except ImportError:
 from capsul.pipeline.pipeline import Pipeline, PipelineNode, Switch, \
     ProcessNode, OptionalOutputSwitch
 from capsul.pipeline.process_iteration import ProcessIteration
+from capsul.utils.stat_cache import StatCache
 from soma.controller import Controller
 
 if sys.version_info[0] >= 3:
@@ -545,7 +547,42 @@ def save_dot_image(pipeline, filename, nodes_sizes={}, use_nodes_pos=False,
     os.unlink(dot_filename)
 
 
-def disable_runtime_steps_with_existing_outputs(pipeline):
+def _file_plug_values(nodes, output=None, any_trait=False):
+    '''
+    List the file values of nodes plugs, to check their existence at once.
+
+    Parameters
+    ----------
+    nodes: iterable of Node
+        the nodes to check.
+    output: bool (optional)
+        if set, only list output (True) or input (False) plugs values.
+    any_trait: bool (optional)
+        if set, Any traits values are also listed.
+
+    Returns
+    -------
+    values: list of str
+        the plugs values.
+    '''
+    trait_types = (traits.File, traits.Directory)
+    if any_trait:
+        trait_types += (traits.Any, )
+    values = []
+    for node in nodes:
+        process = node.process
+        for plug_name, plug in six.iteritems(node.plugs):
+            if output is not None and bool(plug.output) != output:
+                continue
+            trait = process.trait(plug_name)
+            if isinstance(trait.trait_type, trait_types):
+                value = getattr(process, plug_name)
+                if isinstance(value, basestring):
+                    values.append(value)
+    return values
+
+
+def disable_runtime_steps_with_existing_outputs(pipeline, stat_cache=None):
     '''
     Disable steps in a pipeline which outputs contain existing files. This
     disabling is the "runtime steps disabling" one (see
@@ -558,8 +595,21 @@ def disable_runtime_steps_with_existing_outputs(pipeline):
     ----------
     pipeline: Pipeline (mandatory)
         pipeline to disbale nodes in.
+    stat_cache: StatCache (optional)
+        the files existence cache to use. If not given, a new one is used,
+        which lists the directories of the output files concurrently.
     '''
     steps = getattr(pipeline, 'pipeline_steps', Controller())
+    if stat_cache is None:
+        stat_cache = StatCache()
+    stat_cache.prefetch(_file_plug_values(
+        [pipeline.nodes[node_name]
+         for step, trait in six.iteritems(steps.user_traits())
+         if getattr(steps, step)
+         for node_name in trait.nodes
+         if pipeline.nodes[node_name].enabled
+            and pipeline.nodes[node_name].activated],
+        output=True))
     for step, trait in six.iteritems(steps.user_traits()):
         if not getattr(steps, step):
             continue  # already inactive
@@ -574,7 +624,7 @@ def disable_runtime_steps_with_existing_outputs(pipeline):
                                      or isinstance(trait.trait_type, traits.Directory)):
                     value = getattr(process, param)
                     if value is not None and value is not traits.Undefined \
-                            and os.path.exists(value):
+                            and stat_cache.exists(value):
                         # check special case when the output is also an input
                         # (of the same node)
                         disable = True
@@ -597,7 +647,8 @@ def disable_runtime_steps_with_existing_outputs(pipeline):
 
 
 def nodes_with_existing_outputs(pipeline, exclude_inactive=True,
-                                recursive=False, exclude_inputs=True):
+                                recursive=False, exclude_inputs=True,
+                                stat_cache=None):
     '''
     Checks nodes in a pipeline which outputs contain existing files on the
     filesystem. Such nodes, maybe, should not run again. Only nodes which
@@ -625,6 +676,9 @@ def nodes_with_existing_outputs(pipeline, exclude_inactive=True,
         inputs will not be listed in the existing outputs, so that they will
         not be erased by a cleaning operation, and will not prevent execution
         of these nodes.
+    stat_cache: StatCache (optional)
+        the files existence cache to use. If not given, a new one is used,
+        which lists the directories of the checked files concurrently.
 
     Returns
     -------
@@ -640,10 +694,11 @@ def nodes_with_existing_outputs(pipeline, exclude_inactive=True,
             if not getattr(steps, step):
                 disabled_nodes.update(trait.nodes)
 
-    # nodes = pipeline.nodes.items()
-    nodes = list(pipeline.nodes.items())
+    # Select the nodes to check
+    checked_nodes = []
+    nodes = deque(pipeline.nodes.items())
     while nodes:
-        node_name, node = nodes.pop(0)
+        node_name, node = nodes.popleft()
         if node_name == '' or not hasattr(node, 'process'):
             # main pipeline node, switch...
             continue
@@ -652,10 +707,21 @@ def nodes_with_existing_outputs(pipeline, exclude_inactive=True,
             continue
         process = node.process
         if recursive and isinstance(process, Pipeline):
-            nodes += [('%s.%s' % (node_name, new_name), new_node)
-                      for new_name, new_node in six.iteritems(process.nodes)
-                      if new_name != '']
+            nodes.extend(('%s.%s' % (node_name, new_name), new_node)
+                         for new_name, new_node in six.iteritems(process.nodes)
+                         if new_name != '')
             continue
+        checked_nodes.append((node_name, node))
+
+    # List the files directories at once
+    if stat_cache is None:
+        stat_cache = StatCache()
+    stat_cache.prefetch(_file_plug_values(
+        [node for node_name, node in checked_nodes],
+        output=None if exclude_inputs else True, any_trait=True))
+
+    for node_name, node in checked_nodes:
+        process = node.process
         plug_list = []
         input_files_list = set()
         for plug_name, plug in six.iteritems(node.plugs):
@@ -665,7 +731,7 @@ def nodes_with_existing_outputs(pipeline, exclude_inactive=True,
                     or isinstance(trait.trait_type, traits.Any):
                 value = getattr(process, plug_name)
                 if isinstance(value, basestring) \
-                        and os.path.exists(value) \
+                        and stat_cache.exists(value) \
                         and value not in input_files_list:
                     if plug.output:
                         plug_list.append((plug_name, value))
@@ -680,7 +746,7 @@ def nodes_with_existing_outputs(pipeline, exclude_inactive=True,
     return selected_nodes
 
 
-def nodes_with_missing_inputs(pipeline, recursive=True):
+def nodes_with_missing_inputs(pipeline, recursive=True, stat_cache=None):
     '''
     Checks nodes in a pipeline which inputs contain invalid inputs.
     Inputs which are files non-existing on the filesystem (so, which cannot
@@ -697,6 +763,9 @@ def nodes_with_missing_inputs(pipeline, recursive=True):
         that if not set, a pipeline is regarded as a process, but pipelines may
         not use all their inputs/outputs so the result might be inaccurate.
         Default: True
+    stat_cache: StatCache (optional)
+        the files existence cache to use. If not given, a new one is used,
+        which lists the directories of the checked files concurrently.
 
     Returns
     -------
@@ -712,10 +781,11 @@ def nodes_with_missing_inputs(pipeline, recursive=True):
             disabled_nodes.update(
                 [pipeline.nodes[node_name] for node_name in trait.nodes])
 
-    # nodes = pipeline.nodes.items()
-    nodes = list(pipeline.nodes.items())
+    # Select the nodes to check
+    checked_nodes = []
+    nodes = deque(pipeline.nodes.items())
     while nodes:
-        node_name, node = nodes.pop(0)
+        node_name, node = nodes.popleft()
         if node_name == '' or not hasattr(node, 'process'):
             # main pipeline node, switch...
             continue
@@ -723,10 +793,20 @@ def nodes_with_missing_inputs(pipeline, recursive=True):
             continue
         process = node.process
         if recursive and isinstance(process, Pipeline):
-            nodes += [('%s.%s' % (node_name, new_name), new_node)
-                      for new_name, new_node in six.iteritems(process.nodes)
-                      if new_name != '']
+            nodes.extend(('%s.%s' % (node_name, new_name), new_node)
+                         for new_name, new_node in six.iteritems(process.nodes)
+                         if new_name != '')
             continue
+        checked_nodes.append((node_name, node))
+
+    # List the files directories at once
+    if stat_cache is None:
+        stat_cache = StatCache()
+    stat_cache.prefetch(_file_plug_values(
+        [node for node_name, node in checked_nodes], output=False))
+
+    for node_name, node in checked_nodes:
+        process = node.process
         for plug_name, plug in six.iteritems(node.plugs):
             if not plug.output:
                 trait = process.trait(plug_name)
@@ -735,7 +815,7 @@ def nodes_with_missing_inputs(pipeline, recursive=True):
                     value = getattr(process, plug_name)
                     keep_me = False
                     if value is None or value is traits.Undefined \
-                            or value == '' or not os.path.exists(value):
+                            or value == '' or not stat_cache.exists(value):
                         # check where this file comes from
                         origin_node, origin_param, origin_parent \
                             = where_is_plug_value_from(plug, recursive)
@@ -763,6 +843,138 @@ def nodes_with_missing_inputs(pipeline, recursive=True):
     return selected_nodes
 
 
+def _is_file_trait(trait):
+    '''
+    Check if a trait is a File or Directory trait, or a list (or tuple) of
+    them, recursively.
+    '''
+    if isinstance(trait.trait_type, (traits.File, traits.Directory)):
+        return True
+    return any(_is_file_trait(inner_trait)
+               for inner_trait in trait.inner_traits)
+
+
+def _file_values(value):
+    '''
+    List the file names of a File or Directory parameter value, or of a list
+    (or tuple) of them, recursively. Undefined and empty values are skipped.
+    '''
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _file_values(item)]
+    if isinstance(value, basestring) and value:
+        return [value]
+    return []
+
+
+def node_signature(node):
+    '''
+    Get the parameters signature of a process node, used to re-execute
+    nodes whose parameters have changed (see :py:func:`nodes_to_update`).
+
+    The signature covers the process identifier and versions, and the
+    values of parameters which do not come from another process (those
+    are covered by the upstream node update).
+
+    Parameters
+    ----------
+    node: Node (mandatory)
+        the process node.
+
+    Returns
+    -------
+    signature: str
+        the parameters hash.
+    '''
+    from capsul.study_config.memory import hash_parameters
+
+    process = node.process
+    parameters = {}
+    for plug_name, plug in six.iteritems(node.plugs):
+        value = getattr(process, plug_name, traits.Undefined)
+        if value is traits.Undefined or isinstance(value, Controller):
+            continue
+        trait = process.trait(plug_name)
+        if plug.output:
+            # output file names only: other outputs are results
+            if not _is_file_trait(trait):
+                continue
+        elif where_is_plug_value_from(plug)[0] is not None:
+            continue
+        parameters[plug_name] = value
+    parameters = {"id": process.id,
+                  "versions": getattr(process, "versions", {}),
+                  "parameters": parameters}
+    return hash_parameters(parameters)
+
+
+def nodes_to_update(pipeline, nodes, signatures=None):
+    '''
+    Select the nodes of a pipeline which have to be (re-)executed, as make
+    does: a node is re-executed if one of its output files is missing or
+    older than one of its input files (File and Directory parameters, and
+    lists of them), if its parameters have changed
+    since its last execution, or if a node it depends on is re-executed.
+    Nodes without output files are always executed.
+
+    Parameters
+    ----------
+    pipeline: Pipeline (mandatory)
+        the pipeline.
+    nodes: list of Node (mandatory)
+        the process nodes to execute, in execution order (see
+        :py:meth:`Pipeline.workflow_ordered_nodes`).
+    signatures: dict (optional)
+        nodes signatures recorded at their last execution (see
+        :py:func:`node_signature`), indexed by node full name. If not
+        given, parameters changes are not checked.
+
+    Returns
+    -------
+    to_update: dict
+        map the nodes to execute to the reason of their execution.
+    '''
+    from capsul.study_config.memory import _execution_node_map
+
+    to_update = {}
+    node_map = _execution_node_map(nodes)
+    for node in nodes:
+        process = node.process
+        reason = None
+        input_times = []
+        output_times = []
+        for plug_name, plug in six.iteritems(node.plugs):
+            # propagate upstream updates
+            if not plug.output and reason is None:
+                source = node_map.get(where_is_plug_value_from(plug)[0])
+                if source in to_update:
+                    reason = "upstream node %s is updated" % source.full_name
+            trait = process.trait(plug_name)
+            if not _is_file_trait(trait):
+                continue
+            for path in _file_values(getattr(process, plug_name)):
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    if plug.output and reason is None:
+                        reason = "output %s is missing" % plug_name
+                    continue
+                if plug.output:
+                    output_times.append(mtime)
+                else:
+                    input_times.append(mtime)
+        if reason is None and not output_times:
+            reason = "no output file"
+        if reason is None and input_times \
+                and min(output_times) < max(input_times):
+            reason = "outputs are older than inputs"
+        if reason is None and signatures is not None \
+                and signatures.get(node.full_name) != node_signature(node):
+            reason = "parameters have changed"
+        if reason is not None:
+            to_update[node] = reason
+    return to_update
+
+
 def where_is_plug_value_from(plug, recursive=True):
     '''
     Find where the given (input) plug takes its value from.
@@ -11,25 +11,40 @@
 Available functions:
 workflow = workflow_from_pipeline(pipeline)
 controller, wf_id = workflow_run(workflow_name, workflow, study_config)
+submission = workflow_submit(workflow_name, workflow, study_config)
+signature = workflow_signature(pipeline, options)
 """
 
 from __future__ import print_function
 import os
+import copy
 import socket
+import tempfile
+import logging
 import sys
 import six
 
 import soma_workflow.client as swclient
 
 from capsul.pipeline.pipeline import Pipeline, Switch
+from capsul.pipeline.pipeline_nodes import ProcessNode
 from capsul.pipeline import pipeline_tools
+from capsul.pipeline import job_fusion
+from capsul.pipeline import job_array
+from capsul.pipeline.dynamic_iteration import DynamicIterationJob
 from capsul.process.process import Process
 from capsul.pipeline.topological_sort import Graph
+from capsul.utils.formats import associated_files
 from traits.api import Directory, Undefined, File, Str, Any, List
 from soma.sorted_dictionary import OrderedDict
 from .process_iteration import ProcessIteration
 from capsul.attributes import completion_engine_iteration
 from capsul.attributes.completion_engine import ProcessCompletionEngine
+from soma.controller import Controller
+from soma.controller.trait_utils import is_trait_pathname
+
+# Define the logger
+logger = logging.getLogger(__name__)
 
 
 if sys.version_info[0] >= 3:
@@ -41,8 +56,163 @@ else:
         return container.values()
 
 
+def _process_state(process, parameters_filter=None):
+    """ Get the structure and parameters values of a process, as basic
+    python objects.
+
+    parameters_filter is a function telling which parameters are included.
+    Parameters of iterated processes are set during the workflow generation,
+    so only those not linked to the iteration parameters are included.
+    """
+    parameters = {}
+    for name, trait in six.iteritems(process.user_traits()):
+        value = getattr(process, name)
+        if isinstance(value, Controller) \
+                or (parameters_filter is not None
+                    and not parameters_filter(name)):
+            continue
+        if value == '' and is_trait_pathname(trait):
+            # empty file names may be either '' or Undefined, and are
+            # reset to Undefined after temporary files assignment
+            value = Undefined
+        parameters[name] = value
+    state = {"id": getattr(process, "id", process.__class__.__name__),
+             "versions": getattr(process, "versions", {}),
+             "parameters": parameters}
+    for attribute in ("native_specification", "parallel_job_info",
+                      "estimated_runtime"):
+        state[attribute] = getattr(process, attribute, None)
+    if isinstance(process, Pipeline):
+        state["structure"] = process.pipeline_state()
+        steps = getattr(process, "pipeline_steps", None)
+        if isinstance(steps, Controller):
+            state["steps"] = dict((name, getattr(steps, name))
+                                  for name in steps.user_traits())
+        nodes = {}
+        for name, node in six.iteritems(process.nodes):
+            if name == "":
+                continue
+            node_filter = None
+            if parameters_filter is not None:
+                node_filter = lambda name, node=node: \
+                    name not in node.plugs \
+                    or not (node.plugs[name].links_from
+                            or node.plugs[name].links_to)
+            if isinstance(node, ProcessNode):
+                nodes[name] = _process_state(node.process, node_filter)
+            else:
+                nodes[name] = {
+                    "type": node.__class__.__name__,
+                    "parameters": dict(
+                        (name, getattr(node, name))
+                        for name in node.user_traits()
+                        if node_filter is None or node_filter(name))}
+        state["nodes"] = nodes
+    elif isinstance(process, ProcessIteration):
+        state["iterated"] = _process_state(process.process,
+                                           lambda name: False)
+    return state
+
+
+def workflow_signature(pipeline, options):
+    """ Compute the signature of the workflow of a pipeline, used to cache
+    workflows (see the workflow_cache_directory parameter of
+    :py:func:`workflow_from_pipeline`).
+
+    The signature covers the pipeline structure, nodes states and
+    parameters values, and the workflow generation options. It does not
+    cover the processes code.
+
+    Parameters
+    ----------
+    pipeline: Process (mandatory)
+        a CAPSUL pipeline or process.
+    options: dict (mandatory)
+        the workflow generation options.
+
+    Returns
+    -------
+    signature: str
+        the hexadecimal signature.
+    """
+    from capsul.study_config.memory import hash_parameters
+
+    return hash_parameters({"pipeline": _process_state(pipeline),
+                            "options": options})
+
+
+def load_cached_workflow(directory, signature):
+    """ Load a workflow from the workflows cache.
+
+    Parameters
+    ----------
+    directory: str (mandatory)
+        the workflows cache directory.
+    signature: str (mandatory)
+        the workflow signature (see :py:func:`workflow_signature`).
+
+    Returns
+    -------
+    workflow: Workflow
+        the cached workflow, None if it is not in the cache or cannot be
+        used anymore.
+    """
+    fname = os.path.join(directory, signature + ".workflow")
+    if not os.path.exists(fname):
+        return None
+    try:
+        workflow = swclient.Helper.unserialize(fname)
+    except Exception as e:
+        logger.warning("cannot read cached workflow '{0}': {1}".format(
+            fname, e))
+        return None
+    # array jobs commands files may have been removed
+    for job in workflow.jobs:
+        command = job.command
+        if isinstance(command, list) and len(command) >= 4 \
+                and command[1:3] == ["-m", "capsul.pipeline.job_array"] \
+                and not os.path.exists(command[3]):
+            return None
+    return workflow
+
+
+def save_cached_workflow(directory, signature, workflow):
+    """ Store a workflow in the workflows cache.
+
+    Parameters
+    ----------
+    directory: str (mandatory)
+        the workflows cache directory.
+    signature: str (mandatory)
+        the workflow signature (see :py:func:`workflow_signature`).
+    workflow: Workflow (mandatory)
+        the workflow.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_fname = tempfile.mkstemp(prefix=signature, suffix=".tmp",
+                                     dir=directory)
+    os.close(fd)
+    try:
+        swclient.Helper.serialize(tmp_fname, workflow)
+        os.rename(tmp_fname, os.path.join(directory,
+                                          signature + ".workflow"))
+    except Exception:
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
+
+
 def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
-                           jobs_priority=0, create_directories=True):
+                           jobs_priority=0, create_directories=True,
+                           fusion_max_runtime=None, jobs_runtimes=None,
+                           fuse_sub_pipelines=False,
+                           job_arrays_directory=None,
+                           job_array_specification=None,
+                           workflow_cache_directory=None,
+                           transfers_aggregation_threshold=None,
+                           dynamic_iterations_directory=None,
+                           stream_iterations=True):
     """ Create a soma-workflow workflow from a Capsul Pipeline
 
     Parameters
@@ -66,6 +236,59 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
     create_directories: bool (optional, default: True)
         if set, needed output directories (which will contain output files)
         will be created in a first job, which all other ones depend on.
+    fusion_max_runtime: float (optional)
+        if set, linear chains of short jobs are fused into single jobs
+        running at most this time (in seconds), which run the processes
+        sequentially in the same interpreter (see
+        :py:mod:`capsul.pipeline.job_fusion`). Processes runtimes are
+        taken from jobs_runtimes, or from the ``estimated_runtime``
+        attribute of processes. Processes with unknown runtimes are not
+        fused.
+    jobs_runtimes: dict (optional)
+        estimated runtime of processes in seconds, indexed by Process
+        instance, used for jobs fusion.
+    fuse_sub_pipelines: bool (optional, default: False)
+        if set with fusion_max_runtime, the jobs of a sub-pipeline may also
+        be fused into a single job, whatever the sub-pipeline structure.
+    job_arrays_directory: str (optional)
+        if set, iterations of a process are emitted as a single array job
+        instead of one job per iteration, and the iterations commands are
+        stored in a file of this directory, which must be readable from the
+        computing resource (see :py:mod:`capsul.pipeline.job_array`). This
+        only applies to iterations without temporary files, file transfers
+        or shared resource paths.
+    job_array_specification: str (optional)
+        native specification of array jobs: a scheduler name ('slurm',
+        'pbs', 'pbspro', 'sge') or a format string using the {size} and
+        {last} fields. If not set, array jobs are regular jobs running all
+        the iterations sequentially.
+    workflow_cache_directory: str (optional)
+        if set, generated workflows are stored in this directory, and
+        returned again when the pipeline structure, parameters and the
+        options are unchanged (see :py:func:`workflow_signature`). Processes
+        code changes are not detected.
+    transfers_aggregation_threshold: int (optional)
+        if set, when a directory holds at least this number of transferred
+        files, they are transferred through a single directory transfer.
+        The whole directory is then transferred, so only directories which
+        only hold files read or written by the workflow (typically output
+        directories) are aggregated.
+    dynamic_iterations_directory: str (optional)
+        if set, iterations over values which are produced by another process
+        of the pipeline, and thus only known at runtime, are emitted as
+        :py:class:`~capsul.pipeline.dynamic_iteration.DynamicIterationJob`
+        jobs, expanded once the producing process has run (see
+        :py:mod:`capsul.pipeline.dynamic_iteration`). Producing processes
+        write their outputs values in files of this directory. Iterations
+        which outputs are only known at runtime are also expanded into
+        parallel jobs, the iterated process computing the outputs. Such
+        workflows can only be run by
+        :py:class:`~capsul.pipeline.local_workflow.LocalWorkflowEngine`.
+    stream_iterations: bool (optional, default: True)
+        if set, when two iterative nodes of the same size are only linked
+        element-wise (iterated outputs to iterated inputs), each iteration
+        of the downstream node only depends on the same iteration of the
+        upstream node, instead of waiting for all of them.
 
     Returns
     -------
@@ -127,24 +350,8 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
             return self.referent() is other.referent()
 
 
-    def _files_group(path, merged_formats):
-        bname = os.path.basename(path)
-        l0 = len(path) - len(bname)
-        p0 = 0
-        paths = [path]
-        while True:
-            p = bname.find('.', p0)
-            if p < 0:
-                break
-            ext = bname[p:]
-            p0 = p + 1
-            format_def = merged_formats.get(ext)
-            if format_def:
-                path0 = path[:l0 + p]
-                paths += [path0 + e[0] for e in format_def]
-                break
-        paths.append(path + '.minf')
-        return paths
+    def _files_group(path):
+        return [path] + associated_files(path)
 
     def _translated_path(path, shared_map, shared_paths, trait=None):
         if path is None or path is Undefined \
@@ -168,6 +375,33 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
                 return item
         return None
 
+    def _replace_in_list(rlist, temp_map):
+        for i, item in enumerate(rlist):
+            if item in temp_map:
+                value = temp_map[item]
+                value = value.__class__(value)
+                if hasattr(item, 'pattern'):
+                    # temp case (differs from shared case)
+                    value.pattern = item.pattern
+                rlist[i] = value
+            elif isinstance(item, (list, tuple)):
+                deeperlist = list(item)
+                _replace_in_list(deeperlist, temp_map)
+                rlist[i] = deeperlist
+            elif item is Undefined:
+                rlist[i] = ''
+
+    def _referenced_transfers(proc_transfers):
+        # FileTransfer objects of a process, files in aggregated
+        # directories transfers being given as (transfer, file name)
+        referenced = []
+        for transfer, path in six_values(proc_transfers):
+            if isinstance(transfer, tuple):
+                transfer = transfer[0]
+            if transfer not in referenced:
+                referenced.append(transfer)
+        return referenced
+
     def build_job(process, temp_map={}, shared_map={}, transfers=[{}, {}],
                   shared_paths={}, forbidden_temp=set(), name='', priority=0,
                   step_name=''):
@@ -198,22 +432,6 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
         job: Job
             a soma-workflow Job instance that will execute the CAPSUL process
         """
-        def _replace_in_list(rlist, temp_map):
-            for i, item in enumerate(rlist):
-                if item in temp_map:
-                    value = temp_map[item]
-                    value = value.__class__(value)
-                    if hasattr(item, 'pattern'):
-                        # temp case (differs from shared case)
-                        value.pattern = item.pattern
-                    rlist[i] = value
-                elif isinstance(item, (list, tuple)):
-                    deeperlist = list(item)
-                    _replace_in_list(deeperlist, temp_map)
-                    rlist[i] = deeperlist
-                elif item is Undefined:
-                    rlist[i] = ''
-
         def _replace_transfers(rlist, process, itransfers, otransfers):
             param_name = None
             i = 3
@@ -271,7 +489,20 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
                                         parameter)
 
         # Get the process command line
-        process_cmdline = process.get_commandline()
+        outputs_file = dynamic_outputs.get(process)
+        if outputs_file is not None:
+            # the process outputs are iterated by a dynamic iteration
+            if type(process).get_commandline \
+                    is not Process.get_commandline:
+                raise ValueError(
+                    'Process %s has a specific commandline and cannot be '
+                    'the source of a dynamic iteration' % job_name)
+            values = dict((trait_name, getattr(process, trait_name))
+                          for trait_name in process.user_traits())
+            process_cmdline = process.get_commandline_from_values(
+                values, outputs_file)
+        else:
+            process_cmdline = process.get_commandline()
         # and replace in commandline
         iproc_transfers = transfers[0].get(process, {})
         oproc_transfers = transfers[1].get(process, {})
@@ -291,10 +522,10 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
             command=process_cmdline,
             referenced_input_files
                 =input_replaced_paths \
-                    + [x[0] for x in iproc_transfers.values()],
+                    + _referenced_transfers(iproc_transfers),
             referenced_output_files
                 =output_replaced_paths \
-                    + [x[0] for x in oproc_transfers.values()],
+                    + _referenced_transfers(oproc_transfers),
             priority=priority,
             native_specification=native_spec)
         # handle parallel job info (as in soma-workflow)
@@ -476,7 +707,7 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
                         continue
                     todo_plugs.append((node, param_name, output))
 
-    def _get_transfers(pipeline, transfer_paths, merged_formats):
+    def _get_transfers(pipeline, transfer_paths):
         """ Create and list FileTransfer objects needed in the pipeline.
 
         Parameters
@@ -522,8 +753,7 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
                             transfer_item = swclient.FileTransfer(
                                 is_input=not output,
                                 client_path=path,
-                                client_paths=_files_group(path,
-                                                          merged_formats))
+                                client_paths=_files_group(path))
                             _propagate_transfer(node, param,
                                                 path, not output, transfers,
                                                 transfer_item)
@@ -536,6 +766,114 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
                                   and not isinstance(sub_node, Switch)]
         return transfers
 
+    def _aggregate_transfers(transfers, threshold):
+        """ Replace file transfers with directory transfers in directories
+        holding at least threshold transferred files.
+
+        Transfers are grouped by directory and by initial status (inputs and
+        outputs are not mixed). Aggregated files are then referenced as
+        (directory_transfer, file_name) in jobs commandlines.
+
+        A directory transfer moves the whole directory: directories holding
+        other files than the ones the workflow reads or writes (at the time
+        the workflow is built) are not aggregated, so that unrelated files
+        are neither uploaded nor overwritten.
+
+        Parameters
+        ----------
+        transfers: [in_transfers, out_transfers]
+            see _get_transfers(). Modified in place.
+        threshold: int
+            minimum number of files of an aggregated directory.
+        """
+        directories = {}
+        workflow_files = {}
+        for proc_transfers in transfers:
+            for process_transfers in six_values(proc_transfers):
+                for transfer, path in six_values(process_transfers):
+                    directory = os.path.dirname(path)
+                    key = (directory, transfer.initial_status)
+                    directories.setdefault(key, set()).add(transfer)
+                    workflow_files.setdefault(directory, set()).add(
+                        os.path.basename(path))
+        aggregated = {}
+        for (directory, status), dir_transfers \
+                in six.iteritems(directories):
+            if len(dir_transfers) < threshold:
+                continue
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                # not created yet
+                entries = []
+            if not workflow_files[directory].issuperset(entries):
+                continue
+            dir_transfer = swclient.FileTransfer(
+                is_input=(status == swclient.constants.FILES_ON_CLIENT),
+                client_path=directory)
+            dir_transfer.initial_status = status
+            for transfer in dir_transfers:
+                aggregated[transfer] = dir_transfer
+        if not aggregated:
+            return
+        for proc_transfers in transfers:
+            for process_transfers in six_values(proc_transfers):
+                for param, (transfer, path) \
+                        in list(six.iteritems(process_transfers)):
+                    dir_transfer = aggregated.get(transfer)
+                    if dir_transfer is not None:
+                        process_transfers[param] = (
+                            (dir_transfer, os.path.basename(path)), path)
+
+    def _dynamic_iterations_sources(pipeline, directory):
+        '''
+        Find the iterations over empty values linked from other processes
+        outputs, and the files where these processes will write their
+        outputs values.
+
+        Returns
+        -------
+        dynamic_sources: dict
+            {iteration process: {parameter: (outputs file, source parameter)}}
+        dynamic_outputs: dict
+            {source process: outputs file}
+        dynamic_names: dict
+            {iteration process: node name}
+        '''
+        dynamic_sources = {}
+        dynamic_outputs = {}
+        dynamic_names = {}
+        for node in pipeline.all_nodes():
+            it_process = getattr(node, 'process', None)
+            if not isinstance(node, ProcessNode) \
+                    or not isinstance(it_process, ProcessIteration):
+                continue
+            for parameter in it_process.iterative_parameters:
+                if it_process.trait(parameter).output \
+                        or getattr(it_process, parameter):
+                    continue
+                for link in node.plugs[parameter].links_from:
+                    source_node, source_param = link[2], link[1]
+                    source = getattr(source_node, 'process', None)
+                    if not isinstance(source_node, ProcessNode) \
+                            or isinstance(source, (Pipeline,
+                                                   ProcessIteration)) \
+                            or not source.trait(source_param).output:
+                        continue
+                    outputs_file = dynamic_outputs.get(source)
+                    if outputs_file is None:
+                        if not os.path.isdir(directory):
+                            os.makedirs(directory)
+                        fd, outputs_file = tempfile.mkstemp(
+                            prefix=source.name + '_', suffix='.json',
+                            dir=directory)
+                        os.close(fd)
+                        dynamic_outputs[source] = outputs_file
+                    dynamic_sources.setdefault(it_process, {})[parameter] \
+                        = (outputs_file, source_param)
+                    dynamic_names[it_process] = node.name
+        return dynamic_sources, dynamic_outputs, dynamic_names
+
     def _expand_nodes(nodes):
         '''Expands the nodes list or set to leaf nodes by replacing pipeline
         nodes by their children list.
@@ -659,6 +997,9 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
         -------
         (jobs, dependencies, groups, root_jobs)
         '''
+        if it_process in dynamic_sources:
+            return build_dynamic_iteration(it_process, step_name)
+
         no_output_value = None
         size = None
         size_error = False
@@ -712,11 +1053,12 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
             return (jobs, dependencies, groups, root_jobs)
 
         if no_output_value:
-            # this case is a "really" dynamic iteration, the number of
-            # iterations and parameters are determined in runtime, so we
-            # cannot handle it at the moment.
-            raise ValueError('Dynamic iteration is not handled in this '
-                'version of CAPSUL / Soma-Workflow')
+            # this case is a "really" dynamic iteration: outputs are
+            # determined at runtime by the iterated process, unless the
+            # completion gives them.
+            if not dynamic_iterations_directory:
+                raise ValueError('Dynamic iteration is not handled in this '
+                    'version of CAPSUL / Soma-Workflow')
 
             for parameter in it_process.iterative_parameters:
                 trait = it_process.trait(parameter)
@@ -725,50 +1067,350 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
             outputs = {}
             for iteration in xrange(size):
                 for parameter in it_process.iterative_parameters:
-                    if not no_output_value \
-                            or not it_process.trait(parameter).output:
+                    if it_process.trait(parameter).output:
+                        setattr(it_process.process, parameter, Undefined)
+                    else:
                         setattr(it_process.process, parameter,
                                 getattr(it_process, parameter)[iteration])
 
                 # operate completion
                 complete_iteration(it_process, iteration)
 
-                #workflow = workflow_from_pipeline(it_process.process,
-                                                  #study_config=study_config)
-                #workflows.append(workflow)
+                process_name = it_process.process.name + '_%d' % iteration
+                (sub_jobs, sub_dependencies, sub_groups,
+                 sub_root_jobs) = iter_to_workflow(
+                    it_process.process, process_name, step_name,
+                    temp_map, shared_map, transfers,
+                    shared_paths, disabled_nodes, remove_temp, steps,
+                    study_config, iteration)
+                jobs.update(dict([((p, iteration), j)
+                                  for p, j in six.iteritems(sub_jobs)]))
+                dependencies.update(sub_dependencies)
+                groups.update(sub_groups)
+                root_jobs.update(sub_root_jobs)
 
                 for parameter in it_process.iterative_parameters:
                     trait = it_process.trait(parameter)
                     if trait.output:
-                        outputs.setdefault(
-                            parameter,[]).append(getattr(it_process.process,
-                                                         parameter))
+                        value = getattr(it_process.process, parameter)
+                        if value is Undefined:
+                            # unknown until the process runs
+                            value = ''
+                        outputs.setdefault(parameter, []).append(value)
             for parameter, value in six.iteritems(outputs):
                 setattr(it_process, parameter, value)
         else:
+            template = None
+            # array jobs need iterations which only differ by their
+            # parameters values, as checked for the template
+            array_eligible = False
             for iteration in xrange(size):
-                for parameter in it_process.iterative_parameters:
-                    setattr(it_process.process, parameter,
-                            getattr(it_process, parameter)[iteration])
+                if template is not None and iteration > 1:
+                    # only substitute the iteration values in the jobs of
+                    # the first iteration
+                    (sub_jobs, sub_dependencies, sub_groups,
+                     sub_root_jobs) = instantiate_iteration_template(
+                        template, it_process, iteration, shared_map,
+                        shared_paths)
+                else:
+                    for parameter in it_process.iterative_parameters:
+                        setattr(it_process.process, parameter,
+                                getattr(it_process, parameter)[iteration])
 
-                # operate completion
-                complete_iteration(it_process, iteration)
+                    # operate completion
+                    complete_iteration(it_process, iteration)
 
-                process_name = it_process.process.name + '_%d' % iteration
-                (sub_jobs, sub_dependencies, sub_groups, sub_root_jobs) = \
-                    iter_to_workflow(it_process.process, process_name,
-                        step_name,
+                    process_name = it_process.process.name + '_%d' % iteration
+                    (sub_jobs, sub_dependencies, sub_groups,
+                     sub_root_jobs) = iter_to_workflow(
+                        it_process.process, process_name, step_name,
                         temp_map, shared_map, transfers,
                         shared_paths, disabled_nodes, remove_temp, steps,
                         study_config, iteration)
+                    if iteration == 0 and size > 1:
+                        template = build_iteration_template(
+                            it_process, transfers, sub_jobs,
+                            sub_dependencies, sub_groups, sub_root_jobs)
+                        array_eligible = template is not None
+                    elif iteration == 1 and template is not None \
+                            and not check_iteration_template(
+                                template, it_process, iteration):
+                        # some values are derived from the iterative
+                        # parameters (by traits notifications or process
+                        # logic): all iterations have to be built
+                        template = None
                 jobs.update(dict([((p, iteration), j)
                                   for p, j in six.iteritems(sub_jobs)]))
                 dependencies.update(sub_dependencies)
                 groups.update(sub_groups)
                 root_jobs.update(sub_root_jobs)
 
+            if job_arrays_directory and array_eligible \
+                    and not isinstance(it_process.process, Pipeline):
+                array_jobs = build_array_job(it_process, jobs, step_name)
+                if array_jobs is not None:
+                    jobs = array_jobs
+                    root_jobs = dict(array_jobs)
+
         return (jobs, dependencies, groups, root_jobs)
 
+    def build_dynamic_iteration(it_process, step_name):
+        '''
+        Build a DynamicIterationJob for an iteration over values produced
+        by other processes (see :py:mod:`capsul.pipeline.dynamic_iteration`).
+
+        Returns
+        -------
+        (jobs, dependencies, groups, root_jobs)
+        '''
+        for name in it_process.user_traits():
+            values = getattr(it_process, name)
+            if not isinstance(values, list):
+                values = [values]
+            if any(isinstance(value, TempFile) for value in values):
+                raise ValueError(
+                    'Dynamic iteration %s cannot use the temporary value '
+                    'of parameter %s' % (it_process.name, name))
+        job = DynamicIterationJob(
+            it_process, dynamic_sources[it_process],
+            {'study_config': study_config,
+             'jobs_priority': jobs_priority,
+             'create_directories': create_directories,
+             'dynamic_iterations_directory': dynamic_iterations_directory},
+            name=dynamic_names[it_process], priority=jobs_priority)
+        if step_name:
+            job.user_storage = step_name
+        key = (it_process, 0)
+        return ({key: job}, set(), {}, {key: job})
+
+    def build_array_job(it_process, jobs, step_name):
+        '''
+        Replace the jobs of the iterations of a process with an array job
+        (see :py:mod:`capsul.pipeline.job_array`).
+
+        Returns
+        -------
+        jobs: dict
+            {key: array_job}, or None if the jobs commands hold soma-workflow
+            special paths.
+        '''
+        iteration_jobs = sorted(six.iteritems(jobs),
+                                key=lambda item: item[0][1])
+        commands = []
+        for key, job in iteration_jobs:
+            command = job_array.plain_command(job.command)
+            if command is None:
+                return None
+            commands.append(command)
+        first_job = iteration_jobs[0][1]
+        job = job_array.array_job(
+            it_process.process.name, commands, job_arrays_directory,
+            job_array_specification, priority=first_job.priority,
+            native_specification=first_job.native_specification,
+            step_name=step_name)
+        return {iteration_jobs[0][0]: job}
+
+
+    def _iteration_plug_source(node, plug_name, iterative_parameters):
+        ''' Find the iterative parameter a plug of an iterated pipeline
+        node takes its value from, following the links of sibling nodes.
+        '''
+        plug = node.plugs[plug_name]
+        if plug.output:
+            links = plug.links_to
+        else:
+            links = plug.links_from
+        for link in links:
+            source_node, source_plug = link[2], link[1]
+            if source_node is node.pipeline.pipeline_node:
+                if source_plug in iterative_parameters:
+                    return source_plug
+            elif not plug.output:
+                source = _iteration_plug_source(
+                    source_node, source_plug, iterative_parameters)
+                if source is not None:
+                    return source
+        return None
+
+    def build_iteration_template(it_process, transfers, jobs, dependencies,
+                                 groups, root_jobs):
+        '''
+        Record the jobs of the first iteration of an iterative node as a
+        template for the other iterations (see
+        instantiate_iteration_template()): other iterations only differ by
+        the iterative parameters values in the jobs commandlines.
+
+        The template is only used when this holds: the iterated process is
+        a process, or a pipeline of processes (without switches or
+        sub-pipelines), using the default commandline, without temporary
+        files, file transfers nor attributes completion. It is also checked
+        against the second iteration (see check_iteration_template()), so
+        that values derived from the iterative parameters are not frozen.
+
+        Returns
+        -------
+        template: dict
+            the first iteration workflow (jobs, dependencies, groups,
+            root_jobs) and, for each job, the job process values and the
+            process parameters set by each iterative parameter. None if the
+            template cannot be used.
+        '''
+        process = it_process.process
+        iterative_parameters = set(it_process.iterative_parameters)
+        completion_engine = ProcessCompletionEngine.get_completion_engine(
+            it_process)
+        if hasattr(completion_engine, 'complete_iteration_step'):
+            try:
+                if completion_engine.get_attribute_values().user_traits():
+                    return None
+            except AttributeError:
+                pass
+        if isinstance(process, Pipeline):
+            if process.find_empty_parameters():
+                return None
+            nodes = [node for name, node in six.iteritems(process.nodes)
+                     if name != '']
+            if not all(isinstance(node, ProcessNode)
+                       and not isinstance(node.process,
+                                          (Pipeline, ProcessIteration))
+                       for node in nodes):
+                return None
+            processes = dict((node.process, node) for node in nodes)
+        else:
+            processes = {process: None}
+        base_commandline = six.get_unbound_function(Process.get_commandline)
+        job_processes = {}
+        for key, job in six.iteritems(jobs):
+            job_process = key[0] if isinstance(key, tuple) else key
+            if job_process not in processes \
+                    or six.get_unbound_function(
+                        type(job_process).get_commandline) \
+                        is not base_commandline \
+                    or transfers[0].get(job_process) \
+                    or transfers[1].get(job_process):
+                return None
+            job_processes[job] = job_process
+        template_jobs = {}
+        for job, job_process in six.iteritems(job_processes):
+            values = {}
+            iterated = {}
+            node = processes[job_process]
+            for name in job_process.user_traits():
+                value = getattr(job_process, name)
+                if isinstance(value, TempFile) \
+                        or (isinstance(value, list)
+                            and any(isinstance(item, TempFile)
+                                    for item in value)):
+                    return None
+                if isinstance(value, list):
+                    value = list(value)
+                values[name] = value
+                if node is None:
+                    source = name if name in iterative_parameters else None
+                elif name in node.plugs:
+                    source = _iteration_plug_source(node, name,
+                                                    iterative_parameters)
+                else:
+                    source = None
+                if source is not None:
+                    iterated.setdefault(source, []).append(name)
+            template_jobs[job] = (job_process, values, iterated)
+        return {'workflow': (jobs, dependencies, groups, root_jobs),
+                'jobs': template_jobs}
+
+    def check_iteration_template(template, it_process, iteration):
+        '''
+        Check the template of an iterative node (see
+        build_iteration_template()) against an iteration which parameters
+        are set on the iterated process: the template is only valid if the
+        values of the jobs processes are those it substitutes.
+
+        Returns
+        -------
+        valid: bool
+        '''
+        for job_process, values, iterated \
+                in six.itervalues(template['jobs']):
+            values = dict(values)
+            for parameter, names in six.iteritems(iterated):
+                value = getattr(it_process, parameter)[iteration]
+                for name in names:
+                    values[name] = value
+            for name in job_process.user_traits():
+                if name not in values \
+                        or getattr(job_process, name) != values[name]:
+                    logger.debug('iteration template of %s: %s.%s is not '
+                                 'an iterative value'
+                                 % (it_process.name, job_process.name, name))
+                    return False
+        return True
+
+    def instantiate_iteration_template(template, it_process, iteration,
+                                       shared_map, shared_paths):
+        '''
+        Build the workflow of an iteration from the first iteration template
+        (see build_iteration_template()), without setting the iteration
+        parameters on the iterated process.
+
+        Returns
+        -------
+        (jobs, dependencies, groups, root_jobs)
+        '''
+        def iteration_key(key):
+            if isinstance(key, tuple) and len(key) == 2 and key[1] == 0:
+                return (key[0], iteration)
+            return key
+
+        def iteration_name(name):
+            if name == template_name:
+                return it_process.process.name + '_%d' % iteration
+            return name
+
+        jobs, dependencies, groups, root_jobs = template['workflow']
+        template_name = it_process.process.name + '_0'
+        new_jobs = {}
+        for job, (job_process, values, iterated) \
+                in six.iteritems(template['jobs']):
+            values = dict(values)
+            for parameter, names in six.iteritems(iterated):
+                value = getattr(it_process, parameter)[iteration]
+                for name in names:
+                    values[name] = value
+                    trait = job_process.trait(name)
+                    for item in (value if isinstance(value, list)
+                                 else [value]):
+                        _translated_path(item, shared_map, shared_paths,
+                                         trait)
+            commandline = job_process.get_commandline_from_values(values)
+            _replace_in_list(commandline, shared_map)
+            new_job = copy.copy(job)
+            new_job.command = commandline
+            new_job.name = iteration_name(job.name)
+            new_job.referenced_input_files = list(job.referenced_input_files)
+            new_job.referenced_output_files \
+                = list(job.referenced_output_files)
+            new_jobs[job] = new_job
+
+        new_groups = {}
+        def new_element(element):
+            if element in new_jobs:
+                return new_jobs[element]
+            new_group = new_groups.get(element)
+            if new_group is None:
+                new_group = swclient.Group(
+                    [new_element(item) for item in element.elements],
+                    name=iteration_name(element.name))
+                new_groups[element] = new_group
+            return new_group
+
+        return (dict((iteration_key(key), new_jobs[job])
+                     for key, job in six.iteritems(jobs)),
+                set((new_jobs[source], new_jobs[dest])
+                    for source, dest in dependencies),
+                dict((iteration_key(key), new_element(group))
+                     for key, group in six.iteritems(groups)),
+                dict((iteration_key(key), new_element(element))
+                     for key, element in six.iteritems(root_jobs)))
 
     def complete_iteration(it_process, iteration):
         completion_engine = ProcessCompletionEngine.get_completion_engine(
@@ -778,6 +1420,49 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
             completion_engine.complete_iteration_step(iteration)
 
 
+    def _iteration_elements(it_process, root_jobs):
+        '''
+        Get the root jobs / groups of each iteration of an iterative node,
+        as a list of lists, or None if iterations are not separate jobs
+        (array jobs, dynamic iterations).
+        '''
+        size = max([len(getattr(it_process, parameter))
+                    for parameter in it_process.iterative_parameters] + [0])
+        elements = [[] for iteration in xrange(size)]
+        for key, element in six.iteritems(root_jobs):
+            if not isinstance(key, tuple) or key[1] not in xrange(size) \
+                    or isinstance(element, DynamicIterationJob):
+                return None
+            elements[key[1]].append(element)
+        if not all(elements):
+            return None
+        return elements
+
+    def _streamed_iterations(node, dnode, iteration_elements):
+        '''
+        Check if the iterations of two graph nodes may depend element-wise
+        on each other: both are iterative nodes of the same size, and all
+        the links between them connect iterated parameters.
+        '''
+        if not isinstance(node.meta, list) or not isinstance(dnode.meta, list):
+            return False
+        source, dest = node.meta[0], dnode.meta[0]
+        selements = iteration_elements.get(source)
+        delements = iteration_elements.get(dest)
+        if not selements or not delements \
+                or len(selements) != len(delements):
+            return False
+        linked = False
+        for plug_name, plug in six.iteritems(source.plugs):
+            for link in plug.links_to:
+                if link[2] is not dest:
+                    continue
+                if plug_name not in source.process.iterative_parameters \
+                        or link[1] not in dest.process.iterative_parameters:
+                    return False
+                linked = True
+        return linked
+
     def workflow_from_graph(graph, temp_map={}, shared_map={},
                             transfers=[{}, {}], shared_paths={},
                             disabled_nodes=set(), forbidden_temp=set(),
@@ -821,6 +1506,7 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
         root_jobs = {}
         dependencies = set()
         group_nodes = {}
+        iteration_elements = {}
 
         ordered_nodes = graph.topological_sort()
         proc_keys = dict([(node[1] if isinstance(node[1], Graph)
@@ -869,6 +1555,8 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
                         {}, steps, study_config={})
                     (sub_jobs, sub_deps, sub_groups, sub_root_jobs) = \
                         sub_workflows
+                    iteration_elements[it_node] = _iteration_elements(
+                        process, sub_root_jobs)
                     group = build_group(node_name, six_values(sub_root_jobs))
                     groups.setdefault(process, []).append(group)
                     root_jobs.setdefault(process, []).append(group)
@@ -921,6 +1609,16 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
                     djobs = groups[dnode.meta]
                     if not isinstance(djobs, list):
                         djobs = [djobs]
+                if stream_iterations and _streamed_iterations(
+                        node, dnode, iteration_elements):
+                    # element-wise dependencies between iterations
+                    for selements, delements in zip(
+                            iteration_elements[node.meta[0]],
+                            iteration_elements[dnode.meta[0]]):
+                        dependencies.update([(sjob, djob)
+                                             for sjob in selements
+                                             for djob in delements])
+                    continue
                 for djob in djobs:
                     dependencies.update([(sjob, djob) for sjob in sjobs])
 
@@ -964,27 +1662,45 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
             priority=priority)
         return job
 
-    # TODO: handle formats in a separate, centralized place
-    # formats: {name: ext_props}
-    #     ext_props: {ext: [dependent_exts]}
-    #     dependent_exts: (ext, mandatory)
-    formats = {
-        'NIFTI-1': {'.nii': [], '.img': [('.hdr', True)], '.nii.gz': []},
-        'GIS': {'.ima': [('.dim', True)]},
-        'GIFTI': {'.gii': []},
-        'MESH': {'.mesh': []},
-        'ARG': {'.arg': [('.data', False)]},
-    }
-    # transform it to an ext-based dict
-    # merged_formats: {ext: [dependent_exts]}
-    # (formats names are lost here)
-    merged_formats = {}
-    for format, values in six.iteritems(formats):
-        merged_formats.update(values)
-
     if study_config is None:
         study_config = pipeline.get_study_config()
 
+    signature = None
+    if workflow_cache_directory and not dynamic_iterations_directory:
+        if disabled_nodes is None:
+            disabled_names = None
+        else:
+            disabled_names = [getattr(node, 'full_name', node)
+                              for node in disabled_nodes]
+        if jobs_runtimes:
+            runtimes = sorted((process.id, process.name, runtime)
+                              for process, runtime
+                              in six.iteritems(jobs_runtimes))
+        else:
+            runtimes = None
+        try:
+            signature = workflow_signature(pipeline, {
+                'swf_paths': _get_swf_paths(study_config),
+                'disabled_nodes': disabled_names,
+                'jobs_priority': jobs_priority,
+                'create_directories': create_directories,
+                'fusion_max_runtime': fusion_max_runtime,
+                'jobs_runtimes': runtimes,
+                'fuse_sub_pipelines': fuse_sub_pipelines,
+                'job_arrays_directory': job_arrays_directory,
+                'job_array_specification': job_array_specification,
+                'transfers_aggregation_threshold':
+                    transfers_aggregation_threshold,
+                'stream_iterations': stream_iterations})
+        except (TypeError, ValueError) as e:
+            # some parameters values cannot be hashed
+            logger.warning('workflow not cached: {0}'.format(e))
+        if signature is not None:
+            workflow = load_cached_workflow(workflow_cache_directory,
+                                            signature)
+            if workflow is not None:
+                return workflow
+
     if not isinstance(pipeline, Pipeline):
         # "pipeline" is actally a single process (or should, if it is not a
         # pipeline). Get it into a pipeine (with a single node) to make the
@@ -1000,7 +1716,7 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
     shared_map = {}
 
     swf_paths = _get_swf_paths(study_config)
-    transfers = _get_transfers(pipeline, swf_paths[0], merged_formats)
+    transfers = _get_transfers(pipeline, swf_paths[0])
     #print('disabling nodes:', disabled_nodes)
     # get complete list of disabled leaf nodes
     if disabled_nodes is None:
@@ -1012,6 +1728,15 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
     disabled_nodes = _expand_nodes(disabled_nodes)
     move_to_input, remove_temp = _handle_disable_nodes(
         pipeline, temp_subst_map, transfers, disabled_nodes)
+    if transfers_aggregation_threshold:
+        _aggregate_transfers(transfers, transfers_aggregation_threshold)
+    dynamic_sources = {}
+    dynamic_outputs = {}
+    dynamic_names = {}
+    if dynamic_iterations_directory:
+        dynamic_sources, dynamic_outputs, dynamic_names \
+            = _dynamic_iterations_sources(pipeline,
+                                          dynamic_iterations_directory)
     #print('changed transfers:', move_to_input)
     #print('removed temp:', remove_temp)
     #print('temp_map:', temp_map, '\n')
@@ -1045,6 +1770,30 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
     all_jobs = six_values(jobs)
     root_jobs = six_values(root_jobs)
 
+    if fusion_max_runtime is not None:
+        runtimes = {}
+        for key, job in six.iteritems(jobs):
+            # iterations jobs keys are (process, iteration) tuples, possibly
+            # nested
+            process = key
+            while isinstance(process, tuple):
+                process = process[0]
+            runtime = None
+            if jobs_runtimes:
+                runtime = jobs_runtimes.get(process)
+            if runtime is None:
+                runtime = getattr(process, 'estimated_runtime', None)
+            runtimes[job] = runtime
+        fused_groups = []
+        if fuse_sub_pipelines:
+            fused_groups = [group for key, group in six.iteritems(groups)
+                            if isinstance(key, Graph)
+                            or (isinstance(key, tuple)
+                                and isinstance(key[0], Pipeline))]
+        all_jobs, dependencies, root_jobs = job_fusion.fuse_jobs(
+            all_jobs, dependencies, root_jobs, runtimes, fusion_max_runtime,
+            fused_groups)
+
     # if directories have to be created, all other primary jobs will depend
     # on this first one
     if create_directories and dirs_job is not None:
@@ -1062,20 +1811,15 @@ def workflow_from_pipeline(pipeline, study_config=None, disabled_nodes=None,
         root_group=root_jobs,
         name=pipeline.name)
 
-    return workflow
+    if signature is not None:
+        save_cached_workflow(workflow_cache_directory, signature, workflow)
 
+    return workflow
 
-def workflow_run(workflow_name, workflow, study_config):
-    """ Create a soma-workflow controller and submit a workflow
 
-    Parameters
-    ----------
-    workflow_name: str (mandatory)
-        the name of the workflow
-    workflow: Workflow (mandatory)
-        the soma-workflow workflow
-    study_config: StudyConfig (mandatory)
-        contains needed configuration through the SomaWorkflowConfig module
+def _workflow_controller(study_config):
+    """ Get the soma-workflow controller and queue of the study_config
+    computing resource.
     """
     swm = study_config.modules['SomaWorkflowConfig']
     swm.connect_resource()
@@ -1089,6 +1833,22 @@ def workflow_run(workflow_name, workflow, study_config):
         queue = res_conf.queue
         if queue is Undefined:
             queue = None
+    return controller, queue
+
+
+def workflow_run(workflow_name, workflow, study_config):
+    """ Create a soma-workflow controller and submit a workflow
+
+    Parameters
+    ----------
+    workflow_name: str (mandatory)
+        the name of the workflow
+    workflow: Workflow (mandatory)
+        the soma-workflow workflow
+    study_config: StudyConfig (mandatory)
+        contains needed configuration through the SomaWorkflowConfig module
+    """
+    controller, queue = _workflow_controller(study_config)
     wf_id = controller.submit_workflow(workflow=workflow, name=workflow_name,
                                        queue=queue)
     swclient.Helper.transfer_input_files(wf_id, controller)
@@ -1096,3 +1856,36 @@ def workflow_run(workflow_name, workflow, study_config):
     # TODO: should we transfer if the WF fails ?
     swclient.Helper.transfer_output_files(wf_id, controller)
     return controller, wf_id
+
+
+def workflow_submit(workflow_name, workflow, study_config, chunk_size=None,
+                    callback=None):
+    """ Submit a workflow without waiting for its end
+
+    Parameters
+    ----------
+    workflow_name: str (mandatory)
+        the name of the workflow
+    workflow: Workflow (mandatory)
+        the soma-workflow workflow
+    study_config: StudyConfig (mandatory)
+        contains needed configuration through the SomaWorkflowConfig module
+    chunk_size: int (optional)
+        if given, large workflows are submitted as several workflows of about
+        chunk_size jobs, each one once the previous ones it depends on are
+        done
+    callback: callable (optional)
+        function called with (job_id, job_name, status) for each job status
+        change, when the submission is polled
+
+    Returns
+    -------
+    submission: WorkflowSubmission
+        the submission handle, to poll, monitor or wait for the workflow (see
+        :py:class:`~capsul.pipeline.workflow_submission.WorkflowSubmission`)
+    """
+    from capsul.pipeline.workflow_submission import WorkflowSubmission
+    controller, queue = _workflow_controller(study_config)
+    return WorkflowSubmission(controller, workflow, name=workflow_name,
+                              queue=queue, chunk_size=chunk_size,
+                              callback=callback)
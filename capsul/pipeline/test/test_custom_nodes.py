@@ -145,6 +145,42 @@ class PipelineLOO(Pipeline):
             'train': (150.0, 150.0)}
 
 
+class MapProcess(Process):
+    def __init__(self):
+        super(MapProcess, self).__init__()
+        self.add_trait('inputs', traits.List(traits.File(), output=False))
+        self.add_trait('output', traits.File(output=True))
+
+
+class ReduceProcess(Process):
+    def __init__(self):
+        super(ReduceProcess, self).__init__()
+        self.add_trait('inputs', traits.List(traits.File(), output=False))
+        self.add_trait('output', traits.File(output=True))
+
+
+class MapReducePipeline(Pipeline):
+    def pipeline_definition(self):
+        self.add_custom_node('scatter',
+                             'capsul.pipeline.custom_nodes.scatter_node',
+                             parameters={'outputs': 3,
+                                         'param_type': 'File'})
+        self.add_custom_node('gather',
+                             'capsul.pipeline.custom_nodes.gather_node',
+                             parameters={'inputs': 3,
+                                         'concatenate': False,
+                                         'param_type': 'File'})
+        for i in range(3):
+            self.add_process('map%d' % i, MapProcess())
+            self.add_link('scatter.output_%d->map%d.inputs' % (i, i))
+            self.add_link('map%d.output->gather.input_%d' % (i, i))
+            self.export_parameter('map%d' % i, 'output', 'map%d_output' % i)
+        self.add_process('reduce', ReduceProcess())
+        self.add_link('gather.outputs->reduce.inputs')
+        self.export_parameter('scatter', 'inputs')
+        self.export_parameter('reduce', 'output')
+
+
 class TestCustomNodes(unittest.TestCase):
     def setUp(self):
         self.temp_files = []
@@ -275,6 +311,38 @@ class TestCustomNodes(unittest.TestCase):
         self._test_loo_pipeline(pipeline2)
 
 
+    def test_scatter_gather_workflow(self):
+        sc = StudyConfig()
+        pipeline = sc.get_process_instance(MapReducePipeline)
+        pipeline.inputs = ['/dir/file%d' % i for i in range(5)]
+        for i in range(3):
+            setattr(pipeline, 'map%d_output' % i, '/dir/map%d' % i)
+        pipeline.output = '/dir/reduced'
+        self.assertEqual(
+            [pipeline.nodes['map%d' % i].process.inputs for i in range(3)],
+            [['/dir/file0', '/dir/file1'], ['/dir/file2', '/dir/file3'],
+             ['/dir/file4']])
+        self.assertEqual(pipeline.nodes['reduce'].process.inputs,
+                         ['/dir/map0', '/dir/map1', '/dir/map2'])
+        wf = pipeline_workflow.workflow_from_pipeline(pipeline,
+                                                      create_directories=False)
+        self.assertEqual(sorted(job.name for job in wf.jobs),
+                         ['map0', 'map1', 'map2', 'reduce'])
+        self.assertEqual(
+            sorted([[x.name for x in d] for d in wf.dependencies]),
+            [['map%d' % i, 'reduce'] for i in range(3)])
+
+        # the nodes configuration is saved
+        py_file = tempfile.mkstemp(suffix='_capsul.py')
+        pyfname = py_file[1]
+        os.close(py_file[0])
+        self.temp_files.append(pyfname)
+        python_export.save_py_pipeline(pipeline, pyfname)
+        pipeline2 = sc.get_process_instance(pyfname)
+        self.assertEqual(len(pipeline2.nodes['scatter'].plugs), 4)
+        self.assertEqual(len(pipeline2.nodes['gather'].plugs), 4)
+
+
 def test():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestCustomNodes)
     runtime = unittest.TextTestRunner(verbosity=2).run(suite)
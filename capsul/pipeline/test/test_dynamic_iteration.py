@@ -0,0 +1,201 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+from __future__ import print_function
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+import soma_workflow.client as swclient
+import soma_workflow.constants as swconstants
+
+# Trait import
+from traits.api import File, Directory, List
+
+# Capsul import
+from capsul.api import Process
+from capsul.api import Pipeline
+from capsul.pipeline import pipeline_workflow
+from capsul.pipeline.local_workflow import LocalWorkflowEngine
+from capsul.pipeline.dynamic_iteration import DynamicIterationJob
+
+
+class SplitProcess(Process):
+    """ Write each line of a file in a separate file
+    """
+    def __init__(self):
+        super(SplitProcess, self).__init__()
+        self.add_trait("input_file", File(optional=False))
+        self.add_trait("directory", Directory(optional=False))
+        self.add_trait("files", List(File(), output=True))
+
+    def _run_process(self):
+        files = []
+        with open(self.input_file) as f:
+            for i, line in enumerate(f):
+                filename = os.path.join(self.directory,
+                                        "line_%d.txt" % i)
+                with open(filename, "w") as g:
+                    g.write(line.strip())
+                files.append(filename)
+        self.files = files
+
+
+class UpperProcess(Process):
+    """ Write a file content in upper case, in a file named after it
+    """
+    def __init__(self):
+        super(UpperProcess, self).__init__()
+        self.add_trait("input_file", File(optional=False))
+        self.add_trait("output_file", File(output=True))
+
+    def _run_process(self):
+        self.output_file = os.path.splitext(self.input_file)[0] + "_upper.txt"
+        with open(self.input_file) as f:
+            content = f.read()
+        with open(self.output_file, "w") as f:
+            f.write(content.upper())
+
+
+class FailingUpperProcess(UpperProcess):
+    """ Upper case conversion failing on 'b' files
+    """
+    def _run_process(self):
+        with open(self.input_file) as f:
+            if f.read() == "b":
+                raise ValueError("cannot convert 'b'")
+        super(FailingUpperProcess, self)._run_process()
+
+
+class DynamicPipeline(Pipeline):
+    """ split -> upper, iterated over the split files
+    """
+    def pipeline_definition(self):
+        self.add_process(
+            "split", "capsul.pipeline.test.test_dynamic_iteration.SplitProcess")
+        self.add_iterative_process(
+            "upper", "capsul.pipeline.test.test_dynamic_iteration.UpperProcess",
+            iterative_plugs=["input_file", "output_file"])
+        self.add_link("split.files->upper.input_file")
+
+
+class FailingDynamicPipeline(Pipeline):
+    """ split -> upper, iterated over the split files, failing on 'b'
+    """
+    def pipeline_definition(self):
+        self.add_process(
+            "split", "capsul.pipeline.test.test_dynamic_iteration.SplitProcess")
+        self.add_iterative_process(
+            "upper",
+            "capsul.pipeline.test.test_dynamic_iteration.FailingUpperProcess",
+            iterative_plugs=["input_file", "output_file"])
+        self.add_link("split.files->upper.input_file")
+
+
+class TestDynamicIteration(unittest.TestCase):
+    """ Test the expansion of iterations at runtime
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="capsul_test")
+        self.dynamic_directory = os.path.join(self.directory, "dynamic")
+        self.input_file = os.path.join(self.directory, "in.txt")
+        with open(self.input_file, "w") as f:
+            f.write("a\nb\nc\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_dynamic_iteration(self):
+        """ Test an iteration over files produced at runtime
+        """
+        pipeline = DynamicPipeline()
+        pipeline.input_file = self.input_file
+        pipeline.directory = self.directory
+
+        # without dynamic iterations, the iteration is empty
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False)
+        self.assertEqual([job.name for job in workflow.jobs
+                          if not isinstance(job, swclient.BarrierJob)],
+                         ["split"])
+
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False,
+            dynamic_iterations_directory=self.dynamic_directory)
+        dynamic_jobs = [job for job in workflow.jobs
+                        if isinstance(job, DynamicIterationJob)]
+        self.assertEqual([job.name for job in dynamic_jobs], ["upper"])
+        engine = LocalWorkflowEngine(workers=2)
+        self.assertEqual(engine.run(workflow), [])
+        self.assertEqual(len(engine.expanded_jobs[dynamic_jobs[0]]), 3)
+        for i, content in enumerate(("A", "B", "C")):
+            with open(os.path.join(self.directory,
+                                   "line_%d_upper.txt" % i)) as f:
+                self.assertEqual(f.read(), content)
+
+    def test_failed_iteration(self):
+        """ Test a dynamic iteration with a failed job
+        """
+        pipeline = FailingDynamicPipeline()
+        pipeline.input_file = self.input_file
+        pipeline.directory = self.directory
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False,
+            dynamic_iterations_directory=self.dynamic_directory)
+        dynamic_job = [job for job in workflow.jobs
+                       if isinstance(job, DynamicIterationJob)][0]
+        engine = LocalWorkflowEngine(workers=2)
+        failed_jobs = engine.run(workflow)
+        sub_jobs = engine.expanded_jobs[dynamic_job]
+        self.assertEqual(len(sub_jobs), 3)
+        self.assertEqual(
+            sorted(engine.jobs_status[job] for job in sub_jobs),
+            sorted([swconstants.DONE, swconstants.DONE, swconstants.FAILED]))
+        self.assertEqual(engine.jobs_status[dynamic_job], swconstants.FAILED)
+        self.assertEqual(engine.jobs_exit[dynamic_job],
+                         (swconstants.EXIT_ABORTED, None))
+        self.assertEqual(len(failed_jobs), 2)
+        self.assertTrue(dynamic_job in failed_jobs)
+        for source, dest in workflow.dependencies:
+            if source is dynamic_job:
+                self.assertEqual(engine.jobs_status[dest],
+                                 swconstants.NOT_SUBMITTED)
+
+    def test_dynamic_outputs(self):
+        """ Test an iteration which outputs are computed at runtime
+        """
+        pipeline = DynamicPipeline()
+        pipeline.input_file = self.input_file
+        pipeline.directory = self.directory
+        pipeline.nodes["upper"].process.input_file = [
+            os.path.join(self.directory, "x.txt"),
+            os.path.join(self.directory, "y.txt")]
+        pipeline.nodes["upper"].process.output_file = []
+        self.assertRaises(
+            ValueError, pipeline_workflow.workflow_from_pipeline,
+            pipeline.nodes["upper"].process, create_directories=False)
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline.nodes["upper"].process, create_directories=False,
+            dynamic_iterations_directory=self.dynamic_directory)
+        self.assertEqual(sorted(job.name for job in workflow.jobs
+                                if not isinstance(job, swclient.BarrierJob)),
+                         ["UpperProcess_0", "UpperProcess_1"])
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDynamicIteration)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
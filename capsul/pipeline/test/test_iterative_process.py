@@ -14,6 +14,7 @@ import re
 import os
 import tempfile
 import shutil
+import soma_workflow.client as swclient
 
 # Trait import
 from traits.api import String, Float, Undefined, List, File
@@ -62,6 +63,21 @@ class DummyProcess(Process):
         self.other_output = self.other_input
 
 
+class DerivedOutputProcess(Process):
+    """ Process which output file name is derived from its input
+    """
+    def __init__(self):
+        super(DerivedOutputProcess, self).__init__()
+        self.add_trait("input_image", File(optional=False, output=False))
+        self.add_trait("output_image", File(output=True))
+
+    def _input_image_changed(self, value):
+        self.output_image = value + ".out"
+
+    def _run_process(self):
+        open(self.output_image, 'w').write(open(self.input_image).read())
+
+
 class CreateFilesProcess(Process):
     def __init__(self):
         super(CreateFilesProcess, self).__init__()
@@ -150,6 +166,73 @@ class MyBigPipeline(Pipeline):
                 "other_output"])
 
 
+class DummyChain(Pipeline):
+    """ Chain of two dummy processes, without temporary files
+    """
+    do_autoexport_nodes_parameters = False
+
+    def pipeline_definition(self):
+        self.add_process(
+            "first",
+            "capsul.pipeline.test.test_iterative_process.DummyProcess")
+        self.add_process(
+            "second",
+            "capsul.pipeline.test.test_iterative_process.DummyProcess")
+        self.add_link("first.output_image->second.input_image")
+        self.export_parameter("first", "input_image")
+        self.export_parameter("first", "output_image", "first_output")
+        self.export_parameter("first", "dynamic_parameter")
+        self.export_parameter("first", "other_input")
+        self.add_link("dynamic_parameter->second.dynamic_parameter")
+        self.add_link("first.other_output->second.other_input")
+        self.export_parameter("second", "output_image")
+        self.export_parameter("second", "other_output")
+
+
+class MyChainPipeline(Pipeline):
+    """ Iteration of a sub-pipeline
+    """
+    def pipeline_definition(self):
+        self.add_iterative_process(
+            "iterative",
+            "capsul.pipeline.test.test_iterative_process.DummyChain",
+            iterative_plugs=["input_image", "first_output", "output_image",
+                             "dynamic_parameter", "other_output"])
+
+
+class MyStreamPipeline(Pipeline):
+    """ Chain of two iterative nodes
+    """
+    do_autoexport_nodes_parameters = False
+
+    def pipeline_definition(self):
+        for name in ("first", "second"):
+            self.add_iterative_process(
+                name,
+                "capsul.pipeline.test.test_iterative_process.DummyProcess",
+                iterative_plugs=["input_image", "output_image",
+                                 "dynamic_parameter", "other_output"])
+            self.export_parameter(name, "output_image",
+                                  name + "_output_image")
+            for parameter in ("dynamic_parameter", "other_input",
+                              "other_output"):
+                self.export_parameter(name, parameter,
+                                      name + "_" + parameter)
+        self.add_link("first.output_image->second.input_image")
+        self.export_parameter("first", "input_image")
+
+
+class MyDerivedPipeline(Pipeline):
+    """ Iteration over the inputs of a process with derived outputs
+    """
+    def pipeline_definition(self):
+        self.add_iterative_process(
+            "iterative",
+            "capsul.pipeline.test.test_iterative_process."
+            "DerivedOutputProcess",
+            iterative_plugs=["input_image"])
+
+
 class TestPipeline(unittest.TestCase):
     """ Class to test a pipeline with an iterative node
     """
@@ -257,6 +340,95 @@ class TestPipeline(unittest.TestCase):
         self.assertEqual(subjects,
                          set(["toto", "tutu", "tata", "titi", "tete"]))
 
+    def test_iterative_sub_pipeline_workflow(self):
+        """ Test the jobs of iterations built from the first one
+        """
+        pipeline = MyChainPipeline()
+        size = 4
+        names = ["subject%d" % i for i in range(size)]
+        pipeline.input_image = [os.path.join(self.directory, name)
+                                for name in names]
+        pipeline.first_output = [os.path.join(self.directory, name + "_tmp")
+                                 for name in names]
+        pipeline.output_image = [os.path.join(self.directory, name + "_out")
+                                 for name in names]
+        pipeline.dynamic_parameter = [float(i) for i in range(size)]
+        pipeline.other_output = [0.] * size
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False)
+        self.assertEqual(len(workflow.jobs), 2 * size)
+        self.assertEqual(len(set(workflow.jobs)), 2 * size)
+        commands = {}
+        for job in workflow.jobs:
+            args = dict(zip(job.command[3::2], job.command[4::2]))
+            kwargs = eval(re.match('^.*kwargs=({.*}); kwargs.update.*$',
+                                   job.command[2]).group(1))
+            commands[job] = (args["input_image"], args["output_image"],
+                             kwargs["dynamic_parameter"])
+        self.assertEqual(
+            sorted(commands.values()),
+            sorted([(pipeline.input_image[i], pipeline.first_output[i], i)
+                    for i in range(size)]
+                   + [(pipeline.first_output[i], pipeline.output_image[i], i)
+                      for i in range(size)]))
+        self.assertEqual(len(workflow.dependencies), size)
+        for source, dest in workflow.dependencies:
+            self.assertEqual(commands[source][1], commands[dest][0])
+        self.assertEqual(sorted(group.name for group in workflow.groups
+                                if group.name != "iterative"),
+                         ["DummyChain_%d" % i for i in range(size)])
+
+    def test_derived_values_workflow(self):
+        """ Test the jobs of iterations with values derived from the
+        iterative parameters
+        """
+        pipeline = MyDerivedPipeline()
+        pipeline.input_image = [os.path.join(self.directory, name)
+                                for name in ("a", "b", "c")]
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False)
+        outputs = []
+        for job in workflow.jobs:
+            args = dict(zip(job.command[3::2], job.command[4::2]))
+            outputs.append((args["input_image"], args["output_image"]))
+        self.assertEqual(sorted(outputs),
+                         [(name, name + ".out")
+                          for name in pipeline.input_image])
+
+    def test_streamed_iterations_workflow(self):
+        """ Test the element-wise dependencies of chained iterations
+        """
+        pipeline = MyStreamPipeline()
+        size = 3
+        names = ["subject%d" % i for i in range(size)]
+        pipeline.input_image = [os.path.join(self.directory, name)
+                                for name in names]
+        pipeline.first_output_image = [
+            os.path.join(self.directory, name + "_tmp") for name in names]
+        pipeline.second_output_image = [
+            os.path.join(self.directory, name + "_out") for name in names]
+        pipeline.first_dynamic_parameter = [float(i) for i in range(size)]
+        pipeline.second_dynamic_parameter = [float(i) for i in range(size)]
+        pipeline.first_other_output = [0.] * size
+        pipeline.second_other_output = [0.] * size
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False)
+        inputs = {}
+        for job in workflow.jobs:
+            args = dict(zip(job.command[3::2], job.command[4::2]))
+            inputs[job] = args["input_image"]
+        self.assertEqual(len(workflow.jobs), 2 * size)
+        self.assertEqual(len(workflow.dependencies), size)
+        for source, dest in workflow.dependencies:
+            self.assertEqual(inputs[source] + "_tmp", inputs[dest])
+
+        # without streaming, the second iterations wait for all the first
+        # ones, through barriers
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False, stream_iterations=False)
+        self.assertTrue([job for job in workflow.jobs
+                         if isinstance(job, swclient.BarrierJob)])
+
     def test_iterative_pipeline_workflow_run(self):
         import soma_workflow.configuration as swconfig
         import soma_workflow.constants as swconstants
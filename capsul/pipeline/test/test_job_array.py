@@ -0,0 +1,168 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+from __future__ import print_function
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+import json
+
+# Capsul import
+from capsul.pipeline import pipeline_workflow
+from capsul.pipeline import job_array
+from capsul.pipeline.test.test_iterative_process import MySmallPipeline
+from capsul.pipeline.test.test_iterative_process import MyDerivedPipeline
+
+
+class TestJobArray(unittest.TestCase):
+    """ Test the array jobs of iterations
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="capsul_test")
+        self.arrays_directory = os.path.join(self.directory, "arrays")
+        self.pipeline = MySmallPipeline()
+        names = ["toto", "tutu", "titi"]
+        self.pipeline.files_to_create = [
+            os.path.join(self.directory, name) for name in names]
+        self.pipeline.output_image = [
+            os.path.join(self.directory, name + "_out") for name in names]
+        self.pipeline.dynamic_parameter = [3, 1, 4]
+        self.pipeline.other_output = [0., 0., 0.]
+        self.pipeline.other_input = 5
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_array_job(self):
+        """ Test the array job of an iteration, and run it
+        """
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False,
+            job_arrays_directory=self.arrays_directory,
+            job_array_specification="slurm")
+        jobs = dict((job.name, job) for job in workflow.jobs)
+        # the iteration group has input and output barriers
+        self.assertEqual(sorted(jobs), ["DummyProcess", "end", "init",
+                                        "iterative_input",
+                                        "iterative_output"])
+        self.assertEqual(
+            sorted((source.name, dest.name)
+                   for source, dest in workflow.dependencies),
+            [("DummyProcess", "iterative_output"),
+             ("init", "iterative_input"),
+             ("iterative_input", "DummyProcess"),
+             ("iterative_output", "end")])
+        job = jobs["DummyProcess"]
+        self.assertEqual(job.native_specification, "--array=0-2")
+        self.assertEqual(job.command[1:3], ["-m", "capsul.pipeline.job_array"])
+        self.assertEqual(job.command[4:], ["--array", "SLURM_ARRAY_TASK_ID"])
+        with open(job.command[3]) as f:
+            commands = json.load(f)["commands"]
+        self.assertEqual(len(commands), 3)
+
+        # run the array elements, as the scheduler would
+        for fname in self.pipeline.files_to_create:
+            with open(fname, "w") as f:
+                f.write("file: %s\n" % fname)
+        for index in range(3):
+            os.environ["SLURM_ARRAY_TASK_ID"] = str(index)
+            try:
+                job_array.main(job.command[3:])
+            finally:
+                del os.environ["SLURM_ARRAY_TASK_ID"]
+            with open(self.pipeline.output_image[index]) as f:
+                self.assertEqual(f.read(), "file: %s\n"
+                                 % self.pipeline.files_to_create[index])
+
+    def test_no_array_specification(self):
+        """ Test an array job without array specification
+        """
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False,
+            job_arrays_directory=self.arrays_directory)
+        job = [job for job in workflow.jobs if job.name == "DummyProcess"][0]
+        self.assertEqual(job.native_specification, None)
+        self.assertEqual(len(job.command), 4)
+        for fname in self.pipeline.files_to_create:
+            with open(fname, "w") as f:
+                f.write("file: %s\n" % fname)
+        # index variables inherited from an enclosing array job, or set by
+        # LSF for any job, are ignored
+        os.environ["SLURM_ARRAY_TASK_ID"] = "1"
+        os.environ["LSB_JOBINDEX"] = "0"
+        try:
+            job_array.main(job.command[3:])
+        finally:
+            del os.environ["SLURM_ARRAY_TASK_ID"]
+            del os.environ["LSB_JOBINDEX"]
+        for fname in self.pipeline.output_image:
+            self.assertTrue(os.path.exists(fname))
+
+    def test_array_index(self):
+        """ Test the array index of array elements
+        """
+        commands_file = os.path.join(self.directory, "commands.json")
+        with open(commands_file, "w") as f:
+            json.dump({"commands": [["true"], ["true"]]}, f)
+        os.environ["SGE_TASK_ID"] = "2"
+        try:
+            self.assertEqual(job_array.array_index("SGE_TASK_ID"), 1)
+            self.assertEqual(job_array.array_index(), 1)
+            self.assertEqual(job_array.array_index("SLURM_ARRAY_TASK_ID"),
+                             None)
+            self.assertRaises(ValueError, job_array.array_index,
+                              "LSB_JOBINDEX")
+            os.environ["SGE_TASK_ID"] = "3"
+            self.assertRaises(ValueError, job_array.main,
+                              [commands_file, "--array", "SGE_TASK_ID"])
+            os.environ["SGE_TASK_ID"] = "0"
+            self.assertRaises(ValueError, job_array.main,
+                              [commands_file, "--array", "SGE_TASK_ID"])
+        finally:
+            del os.environ["SGE_TASK_ID"]
+        self.assertRaises(ValueError, job_array.main, [commands_file, "-1"])
+        self.assertRaises(ValueError, job_array.main, [commands_file, "2"])
+        job_array.main([commands_file, "1"])
+
+    def test_derived_values(self):
+        """ Test an array job of iterations with derived output values
+        """
+        pipeline = MyDerivedPipeline()
+        pipeline.input_image = self.pipeline.files_to_create
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            pipeline, create_directories=False,
+            job_arrays_directory=self.arrays_directory)
+        self.assertEqual(len(workflow.jobs), 1)
+        job = workflow.jobs[0]
+        with open(job.command[3]) as f:
+            commands = json.load(f)["commands"]
+        self.assertEqual(
+            [command[command.index("output_image") + 1]
+             for command in commands],
+            [fname + ".out" for fname in pipeline.input_image])
+        for fname in pipeline.input_image:
+            with open(fname, "w") as f:
+                f.write("file: %s\n" % fname)
+        job_array.main(job.command[3:])
+        for fname in pipeline.input_image:
+            self.assertTrue(os.path.exists(fname + ".out"))
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestJobArray)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
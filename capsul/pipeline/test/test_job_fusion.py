@@ -0,0 +1,173 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+from __future__ import print_function
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+import soma_workflow.client as swclient
+
+# Trait import
+from traits.api import File, String
+
+# Capsul import
+from capsul.api import Process
+from capsul.api import Pipeline
+from capsul.pipeline import pipeline_workflow
+from capsul.pipeline import job_fusion
+
+
+class AppendProcess(Process):
+    """ Append a text to a file
+    """
+    estimated_runtime = 5.
+
+    def __init__(self):
+        super(AppendProcess, self).__init__()
+        self.add_trait("input_file", File(optional=False))
+        self.add_trait("text", String(optional=False))
+        self.add_trait("output_file", File(optional=False, output=True))
+
+    def _run_process(self):
+        with open(self.input_file) as f:
+            content = f.read()
+        with open(self.output_file, "w") as f:
+            f.write(content + self.text)
+
+
+class AppendChain(Pipeline):
+    """ Sub-pipeline: first -> second, first -> third
+    """
+    do_autoexport_nodes_parameters = False
+
+    def pipeline_definition(self):
+        for name in ("first", "second", "third"):
+            self.add_process(
+                name, "capsul.pipeline.test.test_job_fusion.AppendProcess")
+            self.export_parameter(name, "text", name + "_text")
+        self.add_link("first.output_file->second.input_file")
+        self.add_link("first.output_file->third.input_file")
+        self.export_parameter("first", "input_file")
+        self.export_parameter("first", "output_file", "first_output")
+        self.export_parameter("second", "output_file", "second_output")
+        self.export_parameter("third", "output_file", "third_output")
+
+
+class FusionPipeline(Pipeline):
+    """ Chain of processes: a -> b -> c -> sub-pipeline
+    """
+    do_autoexport_nodes_parameters = False
+
+    def pipeline_definition(self):
+        for name in ("a", "b", "c"):
+            self.add_process(
+                name, "capsul.pipeline.test.test_job_fusion.AppendProcess")
+            self.export_parameter(name, "text", name + "_text")
+            self.export_parameter(name, "output_file", name + "_output")
+        self.add_process(
+            "sub", "capsul.pipeline.test.test_job_fusion.AppendChain")
+        self.add_link("a.output_file->b.input_file")
+        self.add_link("b.output_file->c.input_file")
+        self.add_link("c.output_file->sub.input_file")
+        self.export_parameter("a", "input_file")
+        for name in ("first", "second", "third"):
+            self.export_parameter("sub", name + "_text")
+            self.export_parameter("sub", name + "_output")
+
+
+class TestJobFusion(unittest.TestCase):
+    """ Test the fusion of small jobs
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="capsul_test")
+        self.pipeline = FusionPipeline()
+        self.pipeline.input_file = os.path.join(self.directory, "in.txt")
+        with open(self.pipeline.input_file, "w") as f:
+            f.write("-")
+        for name in ("a", "b", "c", "first", "second", "third"):
+            setattr(self.pipeline, name + "_text", name)
+            setattr(self.pipeline, name + "_output",
+                    os.path.join(self.directory, name + ".txt"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def jobs_names(self, workflow):
+        return sorted(job.name for job in workflow.jobs
+                      if not isinstance(job, swclient.BarrierJob))
+
+    def test_no_fusion(self):
+        """ Test that jobs are not fused by default
+        """
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False)
+        self.assertEqual(self.jobs_names(workflow),
+                         ["a", "b", "c", "first", "second", "third"])
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False, fusion_max_runtime=60.,
+            jobs_runtimes={self.pipeline.nodes["b"].process: 100.})
+        self.assertEqual(self.jobs_names(workflow),
+                         ["a", "b", "c+first", "second", "third"])
+
+    def test_chains_fusion(self):
+        """ Test the fusion of linear chains of jobs
+        """
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False, fusion_max_runtime=60.)
+        self.assertEqual(self.jobs_names(workflow),
+                         ["a+b+c+first", "second", "third"])
+        dependencies = sorted((source.name, dest.name)
+                              for source, dest in workflow.dependencies)
+        self.assertEqual(dependencies, [("a+b+c+first", "second"),
+                                        ("a+b+c+first", "third")])
+
+        # the runtime limit splits chains
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False, fusion_max_runtime=10.)
+        self.assertEqual(self.jobs_names(workflow),
+                         ["a+b", "c+first", "second", "third"])
+
+    def test_sub_pipelines_fusion(self):
+        """ Test the fusion of sub-pipelines, and run the fused jobs
+        """
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False, fusion_max_runtime=20.,
+            fuse_sub_pipelines=True)
+        self.assertEqual(self.jobs_names(workflow), ["a+b+c", "sub"])
+        self.assertEqual([(source.name, dest.name)
+                          for source, dest in workflow.dependencies],
+                         [("a+b+c", "sub")])
+        self.assertEqual(sorted(element.name
+                                for element in workflow.root_group),
+                         ["a+b+c", "sub"])
+
+        # run the fused commands, in dependencies order
+        for name in ("a+b+c", "sub"):
+            job = [job for job in workflow.jobs if job.name == name][0]
+            self.assertEqual(job.command[1:3],
+                             ["-m", "capsul.pipeline.job_fusion"])
+            job_fusion.main(job.command[3:])
+        for name, content in (("c", "-abc"), ("second", "-abcfirstsecond"),
+                              ("third", "-abcfirstthird")):
+            with open(os.path.join(self.directory, name + ".txt")) as f:
+                self.assertEqual(f.read(), content)
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestJobFusion)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,170 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+from __future__ import print_function
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+import threading
+import soma.subprocess
+import soma_workflow.constants as swconstants
+
+# Trait import
+from traits.api import File
+
+# Capsul import
+from capsul.api import Process
+from capsul.api import Pipeline
+from capsul.study_config.study_config import StudyConfig
+from capsul.pipeline import pipeline_workflow
+from capsul.pipeline.local_workflow import LocalWorkflowEngine
+
+
+class FailingProcess(Process):
+    """ Process which always fails
+    """
+    def __init__(self):
+        super(FailingProcess, self).__init__()
+        self.add_trait("input_file", File(optional=False))
+        self.add_trait("output_file", File(optional=False, output=True))
+
+    def _run_process(self):
+        raise RuntimeError("failing on purpose")
+
+
+class LocalPipeline(Pipeline):
+    """ a -> b (through a temporary file), c -> d
+    """
+    do_autoexport_nodes_parameters = False
+
+    def pipeline_definition(self):
+        for name in ("a", "b", "d"):
+            self.add_process(
+                name, "capsul.pipeline.test.test_job_fusion.AppendProcess")
+            self.export_parameter(name, "text", name + "_text")
+        self.add_process(
+            "c", "capsul.pipeline.test.test_local_workflow.FailingProcess")
+        self.add_link("a.output_file->b.input_file")
+        self.add_link("c.output_file->d.input_file")
+        self.export_parameter("a", "input_file")
+        self.add_link("input_file->c.input_file")
+        self.export_parameter("b", "output_file")
+        self.export_parameter("c", "output_file", "failed_output")
+        self.export_parameter("d", "output_file", "not_run_output")
+
+
+class TestLocalWorkflow(unittest.TestCase):
+    """ Test the local workflow engine
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="capsul_test")
+        self.pipeline = LocalPipeline()
+        self.pipeline.input_file = os.path.join(self.directory, "in.txt")
+        with open(self.pipeline.input_file, "w") as f:
+            f.write("-")
+        for name in ("a", "b", "d"):
+            setattr(self.pipeline, name + "_text", name)
+        self.pipeline.output_file = os.path.join(self.directory, "out.txt")
+        self.pipeline.failed_output = os.path.join(self.directory, "c.txt")
+        self.pipeline.not_run_output = os.path.join(self.directory, "d.txt")
+        # use file transfers for inputs
+        self.study_config = StudyConfig()
+        self.study_config.somaworkflow_computing_resource = "localhost"
+        self.study_config.somaworkflow_computing_resources_config.localhost \
+            = {"transfer_paths": [self.directory]}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run(self):
+        """ Test a workflow run with temporary files, transfers and a
+        failing job
+        """
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, study_config=self.study_config)
+        statuses = []
+        log_directory = os.path.join(self.directory, "logs")
+        engine = LocalWorkflowEngine(
+            workers=2, log_directory=log_directory,
+            status_callback=lambda job, status: statuses.append(
+                (job.name, status)))
+        failed_jobs = engine.run(workflow)
+        jobs = dict((job.name, job) for job in workflow.jobs)
+
+        self.assertEqual([job.name for job in failed_jobs], ["c"])
+        with open(self.pipeline.output_file) as f:
+            self.assertEqual(f.read(), "-ab")
+        self.assertEqual(engine.jobs_status[jobs["b"]], swconstants.DONE)
+        self.assertEqual(engine.jobs_status[jobs["d"]],
+                         swconstants.NOT_SUBMITTED)
+        self.assertEqual(engine.jobs_exit[jobs["d"]],
+                         (swconstants.EXIT_NOTRUN, None))
+        self.assertFalse(os.path.exists(self.pipeline.not_run_output))
+        self.assertTrue(("b", swconstants.RUNNING) in statuses)
+        self.assertTrue(("b", swconstants.DONE) in statuses)
+
+        # the failure is in the job log
+        stdout_file, stderr_file = engine.jobs_log[jobs["c"]]
+        self.assertTrue(stderr_file.startswith(log_directory))
+        with open(stderr_file) as f:
+            self.assertTrue("failing on purpose" in f.read())
+
+    def test_run_directory_transfers(self):
+        """ Test a workflow run with outputs in a directory transfer
+        """
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, study_config=self.study_config,
+            transfers_aggregation_threshold=3)
+        engine = LocalWorkflowEngine(workers=2)
+        failed_jobs = engine.run(workflow)
+        self.assertEqual([job.name for job in failed_jobs], ["c"])
+        with open(self.pipeline.output_file) as f:
+            self.assertEqual(f.read(), "-ab")
+
+    def test_unexpected_error(self):
+        """ Test that errors escaping a job run do not block the engine
+        """
+        class Interrupted(BaseException):
+            pass
+
+        def call(*args, **kwargs):
+            raise Interrupted()
+
+        workflow = pipeline_workflow.workflow_from_pipeline(
+            self.pipeline, create_directories=False)
+        engine = LocalWorkflowEngine(workers=2)
+        failed_jobs = []
+        thread = threading.Thread(
+            target=lambda: failed_jobs.extend(engine.run(workflow)))
+        thread.daemon = True
+        subprocess_call = soma.subprocess.call
+        soma.subprocess.call = call
+        try:
+            thread.start()
+            thread.join(30)
+        finally:
+            soma.subprocess.call = subprocess_call
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(job.name for job in failed_jobs), ["a", "c"])
+        self.assertEqual(set(engine.jobs_exit[job] for job in failed_jobs),
+                         set([(swconstants.EXIT_ABORTED, None)]))
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLocalWorkflow)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
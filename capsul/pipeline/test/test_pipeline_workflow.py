@@ -11,6 +11,8 @@ from __future__ import print_function
 import unittest
 import os
 import sys
+import tempfile
+import shutil
 from traits.api import File
 from capsul.api import Process
 from capsul.api import Pipeline, PipelineNode
@@ -134,6 +136,90 @@ class TestPipelineWorkflow(unittest.TestCase):
             raise ValueError('workflow should have failed due to a missing '
                 'temporary file')
 
+    def test_transfers_aggregation(self):
+        self.pipeline.enable_all_pipeline_steps()
+        output_dir = tempfile.mkdtemp(prefix='capsul_test_transfers',
+                                      dir='/tmp')
+        try:
+            for i in range(1, 4):
+                setattr(self.pipeline, 'output%d' % i,
+                        os.path.join(output_dir, 'file_out%d.nii' % i))
+            wf = pipeline_workflow.workflow_from_pipeline(
+                self.pipeline, study_config=self.study_config,
+                transfers_aggregation_threshold=2)
+            jobs = dict((job.name, job) for job in wf.jobs)
+            # the 3 outputs are transferred as a directory
+            outputs = set()
+            for name in ('node2', 'node3', 'node4'):
+                self.assertEqual(len(jobs[name].referenced_output_files), 1)
+                outputs.update(jobs[name].referenced_output_files)
+            self.assertEqual(len(outputs), 1)
+            self.assertEqual(list(outputs)[0].client_path, output_dir)
+            self.assertTrue((list(outputs)[0], 'file_out3.nii')
+                            in jobs['node4'].command)
+            # the input is still a file transfer
+            self.assertEqual(
+                [transfer.client_path
+                 for transfer in jobs['node1'].referenced_input_files],
+                ['/tmp/file_in.nii'])
+
+            # directories holding other files are not aggregated
+            open(os.path.join(output_dir, 'unrelated.txt'), 'w').close()
+            wf = pipeline_workflow.workflow_from_pipeline(
+                self.pipeline, study_config=self.study_config,
+                transfers_aggregation_threshold=2)
+            jobs = dict((job.name, job) for job in wf.jobs)
+            self.assertEqual(
+                sorted(transfer.client_path
+                       for name in ('node2', 'node3', 'node4')
+                       for transfer in jobs[name].referenced_output_files),
+                [os.path.join(output_dir, 'file_out%d.nii' % i)
+                 for i in range(1, 4)])
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_workflow_cache(self):
+        self.pipeline.enable_all_pipeline_steps()
+        cache_dir = tempfile.mkdtemp(prefix='capsul_test_wf_cache')
+        try:
+            wf = pipeline_workflow.workflow_from_pipeline(
+                self.pipeline, study_config=self.study_config,
+                workflow_cache_directory=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            # an unchanged configuration gives the cached workflow
+            wf2 = pipeline_workflow.workflow_from_pipeline(
+                self.pipeline, study_config=self.study_config,
+                workflow_cache_directory=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            def commands(workflow):
+                # special paths (temporary files) objects are not the same
+                return sorted((job.name,
+                               [arg if isinstance(arg, str)
+                                else arg.__class__.__name__
+                                for arg in job.command])
+                              for job in workflow.jobs)
+            self.assertEqual(commands(wf), commands(wf2))
+            self.assertEqual(len(wf2.dependencies), 4)
+            # parameters, steps and options changes give new workflows
+            self.pipeline.output3 = '/tmp/file_out4.nii'
+            wf = pipeline_workflow.workflow_from_pipeline(
+                self.pipeline, study_config=self.study_config,
+                workflow_cache_directory=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.pipeline.pipeline_steps.step3 = False
+            wf = pipeline_workflow.workflow_from_pipeline(
+                self.pipeline, study_config=self.study_config,
+                workflow_cache_directory=cache_dir)
+            self.assertEqual(len(wf.jobs), 4)
+            wf = pipeline_workflow.workflow_from_pipeline(
+                self.pipeline, study_config=self.study_config,
+                create_directories=False,
+                workflow_cache_directory=cache_dir)
+            self.assertEqual(len(wf.jobs), 3)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 def test():
     """ Function to execute unitest
@@ -0,0 +1,179 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+from __future__ import print_function
+
+# System import
+import unittest
+import soma_workflow.client as swclient
+import soma_workflow.constants as swconstants
+
+# Capsul import
+from capsul.pipeline.workflow_submission import split_workflow
+from capsul.pipeline.workflow_submission import WorkflowSubmission
+
+
+class EngineJob(object):
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+
+class EngineWorkflow(object):
+    def __init__(self, workflow, first_id):
+        self.workflow = workflow
+        self.job_mapping = dict(
+            (job, EngineJob(first_id + index))
+            for index, job in enumerate(workflow.jobs))
+
+
+class FakeController(object):
+    """ Workflow controller running one level of jobs at each status
+    request. Jobs named "fail*" fail.
+    """
+    def __init__(self):
+        self.workflows = {}
+        self.status = {}
+        self.submitted = []
+
+    def submit_workflow(self, workflow, name=None, queue=None):
+        wf_id = len(self.workflows) + 1
+        self.workflows[wf_id] = EngineWorkflow(workflow, wf_id * 1000)
+        self.status[wf_id] = dict((job, swconstants.NOT_SUBMITTED)
+                                  for job in workflow.jobs)
+        self.submitted.append(name)
+        return wf_id
+
+    def workflow(self, wf_id):
+        return self.workflows[wf_id]
+
+    def workflow_elements_status(self, wf_id):
+        workflow = self.workflows[wf_id].workflow
+        status = self.status[wf_id]
+        ready = [job for job, job_status in status.items()
+                 if job_status == swconstants.NOT_SUBMITTED
+                 and all(status[source] == swconstants.DONE
+                         for source, dest in workflow.dependencies
+                         if dest is job)]
+        for job in ready:
+            if job.name.startswith("fail"):
+                status[job] = swconstants.FAILED
+            else:
+                status[job] = swconstants.DONE
+        if any(job_status == swconstants.NOT_SUBMITTED
+               and all(status[source] == swconstants.DONE
+                       for source, dest in workflow.dependencies
+                       if dest is job)
+               for job, job_status in status.items()):
+            workflow_status = swconstants.WORKFLOW_IN_PROGRESS
+        else:
+            workflow_status = swconstants.WORKFLOW_DONE
+        mapping = self.workflows[wf_id].job_mapping
+        jobs_info = [
+            (mapping[job].job_id, job_status, None,
+             (swconstants.FINISHED_REGULARLY
+              if job_status == swconstants.DONE else swconstants.EXIT_NOTRUN,
+              0 if job_status == swconstants.DONE else None),
+             (None, None, None))
+            for job, job_status in status.items()]
+        return jobs_info, [], workflow_status, None, []
+
+
+class TestWorkflowSubmission(unittest.TestCase):
+    """ Test the chunked and non-blocking submission of workflows
+    """
+    def setUp(self):
+        # chain a -> b -> c -> d, e independent, b and d share a temporary
+        # file
+        self.jobs = dict((name, swclient.Job(command=["echo", name],
+                                             name=name))
+                         for name in ("a", "b", "c", "d", "e"))
+        temporary = swclient.TemporaryPath()
+        self.jobs["b"].command.append(temporary)
+        self.jobs["d"].command.append([temporary])
+        self.dependencies = [(self.jobs["a"], self.jobs["b"]),
+                             (self.jobs["b"], self.jobs["c"]),
+                             (self.jobs["c"], self.jobs["d"])]
+
+    def workflow(self):
+        return swclient.Workflow(
+            jobs=[self.jobs[name] for name in ("a", "b", "c", "d", "e")],
+            dependencies=self.dependencies, name="wf")
+
+    def test_split_workflow(self):
+        """ Test the splitting of workflows into chunks
+        """
+        chunks = split_workflow(self.workflow(), 2)
+        self.assertEqual(
+            [(sorted(job.name for job in chunk.jobs), dependencies)
+             for chunk, dependencies in chunks],
+            [(["a", "e"], set()), (["b", "c", "d"], set([0]))])
+        self.assertEqual([chunk.name for chunk, dependencies in chunks],
+                         ["wf (1/2)", "wf (2/2)"])
+        self.assertEqual(sorted((source.name, dest.name)
+                                for source, dest in chunks[1][0].dependencies),
+                         [("b", "c"), ("c", "d")])
+
+        # without shared temporary path, chunks keep their size
+        self.jobs["d"].command.pop()
+        chunks = split_workflow(self.workflow(), 2)
+        self.assertEqual(
+            [(sorted(job.name for job in chunk.jobs), dependencies)
+             for chunk, dependencies in chunks],
+            [(["a", "e"], set()), (["b", "c"], set([0])),
+             (["d"], set([1]))])
+
+    def test_submission(self):
+        """ Test the submission and monitoring of chunks
+        """
+        controller = FakeController()
+        changes = []
+        submission = WorkflowSubmission(
+            controller, self.workflow(), chunk_size=2, transfer_files=False,
+            callback=lambda *change: changes.append(change))
+        # the second chunk waits for the first one
+        self.assertEqual(controller.submitted, ["wf (1/2)"])
+        self.assertEqual(submission.workflow_ids, [1, None])
+        self.assertFalse(submission.done)
+        names = [job_name for job_id, job_name, status
+                 in submission.monitor(interval=0.)
+                 if status == swconstants.DONE]
+        self.assertTrue(submission.done)
+        self.assertEqual(controller.submitted, ["wf (1/2)", "wf (2/2)"])
+        self.assertEqual(sorted(names), ["a", "b", "c", "d", "e"])
+        self.assertEqual(sorted(change[1] for change in changes
+                                if change[2] == swconstants.DONE),
+                         sorted(names))
+        self.assertEqual(set(submission.jobs_status.values()),
+                         set([swconstants.DONE]))
+
+    def test_failed_chunk(self):
+        """ Test that chunks depending on a failed chunk are not submitted
+        """
+        self.jobs["a"].name = "fail_a"
+        controller = FakeController()
+        submission = WorkflowSubmission(
+            controller, self.workflow(), chunk_size=2, transfer_files=False)
+        self.assertTrue(submission.wait(interval=0.))
+        self.assertEqual(controller.submitted, ["wf (1/2)"])
+        self.assertEqual(
+            sorted((submission.jobs_names[job_id], status)
+                   for job_id, status in submission.jobs_status.items()),
+            [("e", swconstants.DONE), ("fail_a", swconstants.FAILED)])
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(
+        TestWorkflowSubmission)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,361 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Non-blocking submission and monitoring of soma-workflow workflows.
+
+:py:func:`~capsul.pipeline.pipeline_workflow.workflow_run` submits a
+workflow and waits for its end. A :py:class:`WorkflowSubmission` instead
+returns as soon as the workflow is submitted, and is then polled for jobs
+status changes:
+
+::
+
+    submission = workflow_submit("my workflow", workflow, study_config,
+                                 chunk_size=5000)
+    for job_id, job_name, status in submission.monitor(interval=10.):
+        if status == swconstants.FAILED:
+            print("job", job_name, "failed")
+    failed_jobs = submission.failed_jobs()
+
+Very large workflows may be submitted as several chunks (see
+:py:func:`split_workflow`), each chunk being submitted as a separate
+soma-workflow workflow once the chunks it depends on are done.
+"""
+
+# System import
+from __future__ import print_function
+import time
+import logging
+import six
+import soma_workflow.client as swclient
+import soma_workflow.constants as swconstants
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+
+def _temporary_paths(job):
+    """ Get the temporary paths used by a job.
+    """
+    paths = set()
+    elements = [job.command, job.stdin, job.stdout_file, job.stderr_file,
+                job.working_directory]
+    elements += list(job.referenced_input_files or [])
+    elements += list(job.referenced_output_files or [])
+    while elements:
+        element = elements.pop()
+        if isinstance(element, (list, tuple)):
+            elements += element
+        elif isinstance(element, swclient.SpecialPath):
+            referent = element.referent()
+            if isinstance(referent, swclient.TemporaryPath):
+                paths.add(referent)
+    return paths
+
+
+def split_workflow(workflow, chunk_size):
+    """ Split a workflow into smaller workflows.
+
+    Jobs are taken in dependencies order, so each chunk only depends on
+    previous ones. Jobs sharing a temporary path are kept in the same chunk,
+    so chunks may be larger than chunk_size. Groups are not kept: chunks
+    jobs are all at their root level.
+
+    Parameters
+    ----------
+    workflow: Workflow
+        the soma-workflow workflow.
+    chunk_size: int
+        the maximum number of jobs of a chunk.
+
+    Returns
+    -------
+    chunks: list of (Workflow, set of int) tuples
+        the chunks workflows, with the indices of the chunks they depend on.
+    """
+    jobs = list(workflow.jobs)
+    job_indices = dict((job, index) for index, job in enumerate(jobs))
+    successors = dict((job, []) for job in jobs)
+    predecessors = dict((job, []) for job in jobs)
+    for source, dest in workflow.dependencies:
+        successors[source].append(dest)
+        predecessors[dest].append(source)
+
+    # dependencies order
+    count = dict((job, len(predecessors[job])) for job in jobs)
+    ready = [job for job in jobs if count[job] == 0]
+    ordered = []
+    while ready:
+        job = ready.pop(0)
+        ordered.append(job)
+        for successor in successors[job]:
+            count[successor] -= 1
+            if count[successor] == 0:
+                ready.append(successor)
+    if len(ordered) != len(jobs):
+        raise ValueError("workflow dependencies have cycles")
+
+    # chunks are ranges of ordered jobs: ranges sharing temporary paths are
+    # merged, which keeps chunks dependencies in order
+    bounds = list(range(0, len(ordered), chunk_size))
+    chunk_of = dict((job, index // chunk_size)
+                    for index, job in enumerate(ordered))
+    temporary_chunks = {}
+    for job in ordered:
+        for path in _temporary_paths(job):
+            temporary_chunks.setdefault(path, set()).add(chunk_of[job])
+    merged = set()
+    for chunks in six.itervalues(temporary_chunks):
+        merged.update(range(min(chunks) + 1, max(chunks) + 1))
+    bounds = [bound for index, bound in enumerate(bounds)
+              if index not in merged] + [len(ordered)]
+
+    chunks = []
+    for index in range(len(bounds) - 1):
+        chunk_jobs = ordered[bounds[index]:bounds[index + 1]]
+        chunk_jobs.sort(key=lambda job: job_indices[job])
+        for job in chunk_jobs:
+            chunk_of[job] = index
+        dependencies = set()
+        chunk_dependencies = set()
+        for job in chunk_jobs:
+            for source in predecessors[job]:
+                if chunk_of[source] == index:
+                    dependencies.add((source, job))
+                else:
+                    chunk_dependencies.add(chunk_of[source])
+        name = workflow.name
+        if len(bounds) > 2:
+            name = "{0} ({1}/{2})".format(workflow.name, index + 1,
+                                           len(bounds) - 1)
+        chunk = swclient.Workflow(jobs=chunk_jobs, dependencies=dependencies,
+                                  root_group=chunk_jobs, name=name)
+        chunks.append((chunk, chunk_dependencies))
+    return chunks
+
+
+class WorkflowSubmission(object):
+    """ Handle on a workflow submitted to soma-workflow.
+
+    The workflow is submitted when the handle is created, possibly as
+    several chunks. Jobs status are then updated each time :py:meth:`poll`
+    is called, which also submits chunks as soon as the chunks they depend
+    on are done, and transfers output files of finished chunks.
+
+    Attributes
+    ----------
+    controller: WorkflowController
+        the soma-workflow controller.
+    workflow_ids: list of int
+        the identifiers of the submitted workflows (one per chunk), None for
+        chunks which are not submitted yet.
+    jobs_status: dict
+        the status of the submitted jobs, indexed by job identifier.
+    jobs_names: dict
+        the names of the submitted jobs, indexed by job identifier.
+    """
+    def __init__(self, controller, workflow, name=None, queue=None,
+                 chunk_size=None, transfer_files=True, callback=None):
+        """ Initialize the WorkflowSubmission class, and submit the workflow.
+
+        Parameters
+        ----------
+        controller: WorkflowController
+            the soma-workflow controller.
+        workflow: Workflow
+            the soma-workflow workflow.
+        name: str (optional)
+            the workflow name.
+        queue: str (optional)
+            the computing resource queue.
+        chunk_size: int (optional)
+            if given, the workflow is split into chunks of about chunk_size
+            jobs (see :py:func:`split_workflow`).
+        transfer_files: bool (optional, default True)
+            transfer the input files of chunks when they are submitted, and
+            their output files when they end.
+        callback: callable (optional)
+            function called with (job_id, job_name, status) for each job
+            status change.
+        """
+        self.controller = controller
+        self.name = name or workflow.name
+        self.queue = queue
+        self.transfer_files = transfer_files
+        self.callback = callback
+        if chunk_size and len(workflow.jobs) > chunk_size:
+            self._chunks = split_workflow(workflow, chunk_size)
+        else:
+            self._chunks = [(workflow, set())]
+        self.workflow_ids = [None] * len(self._chunks)
+        self.jobs_status = {}
+        self.jobs_names = {}
+        # chunks status: None (not submitted), or a soma-workflow workflow
+        # status
+        self._chunks_status = [None] * len(self._chunks)
+        self._failed_chunks = set()
+        self._cancelled_chunks = set()
+        self._submit_ready_chunks()
+
+    def _submit_ready_chunks(self):
+        """ Submit the chunks which dependencies are done.
+        """
+        for index, (workflow, dependencies) in enumerate(self._chunks):
+            if self.workflow_ids[index] is not None \
+                    or index in self._cancelled_chunks:
+                continue
+            if dependencies & (self._failed_chunks | self._cancelled_chunks):
+                logger.warning("workflow {0}: chunk {1} is not submitted "
+                               "since a previous chunk failed".format(
+                                   self.name, index))
+                self._cancelled_chunks.add(index)
+                continue
+            if not all(self._chunks_status[dependency]
+                       == swconstants.WORKFLOW_DONE
+                       for dependency in dependencies):
+                continue
+            name = self.name
+            if len(self._chunks) > 1:
+                name = "{0} ({1}/{2})".format(self.name, index + 1,
+                                               len(self._chunks))
+            wf_id = self.controller.submit_workflow(
+                workflow=workflow, name=name, queue=self.queue)
+            self.workflow_ids[index] = wf_id
+            self._chunks_status[index] = swconstants.WORKFLOW_NOT_STARTED
+            if self.transfer_files:
+                swclient.Helper.transfer_input_files(wf_id, self.controller)
+            # the submitted jobs are copies: get their names from the server
+            submitted = self.controller.workflow(wf_id)
+            for job, engine_job in six.iteritems(submitted.job_mapping):
+                self.jobs_names[engine_job.job_id] = job.name
+
+    def poll(self):
+        """ Update the jobs status, and submit the chunks which are ready.
+
+        Returns
+        -------
+        changes: list of (job_id, job_name, status) tuples
+            the status changes since the last call.
+        """
+        changes = []
+        for index, wf_id in enumerate(self.workflow_ids):
+            if wf_id is None or self._chunks_status[index] \
+                    == swconstants.WORKFLOW_DONE:
+                continue
+            jobs_info, transfers_info, workflow_status, queue, \
+                temporaries_info \
+                = self.controller.workflow_elements_status(wf_id)
+            failed = False
+            for job_id, status, queue, exit_info, dates in jobs_info:
+                if self.jobs_status.get(job_id) != status:
+                    self.jobs_status[job_id] = status
+                    changes.append((job_id, self.jobs_names.get(job_id),
+                                    status))
+                if status == swconstants.FAILED \
+                        or (status == swconstants.DONE
+                            and exit_info[1] != 0):
+                    failed = True
+            self._chunks_status[index] = workflow_status
+            if workflow_status == swconstants.WORKFLOW_DONE:
+                if failed:
+                    self._failed_chunks.add(index)
+                if self.transfer_files:
+                    swclient.Helper.transfer_output_files(
+                        wf_id, self.controller)
+        self._submit_ready_chunks()
+        if self.callback is not None:
+            for change in changes:
+                self.callback(*change)
+        return changes
+
+    @property
+    def done(self):
+        """ True when all the submitted chunks are done and no other chunk
+        may be submitted.
+        """
+        return all(status == swconstants.WORKFLOW_DONE
+                   or index in self._cancelled_chunks
+                   for index, status in enumerate(self._chunks_status))
+
+    def monitor(self, interval=1., timeout=None):
+        """ Iterate over jobs status changes until the workflow is done.
+
+        Parameters
+        ----------
+        interval: float (optional, default 1.)
+            the polling interval, in seconds.
+        timeout: float (optional)
+            stop monitoring after timeout seconds.
+
+        Yields
+        ------
+        change: (job_id, job_name, status) tuple
+            a job status change.
+        """
+        start_time = time.time()
+        while True:
+            for change in self.poll():
+                yield change
+            if self.done:
+                break
+            if timeout is not None \
+                    and time.time() - start_time + interval > timeout:
+                break
+            time.sleep(interval)
+
+    def wait(self, interval=1., timeout=None):
+        """ Wait for the end of the workflow, polling its status.
+
+        Parameters
+        ----------
+        interval: float (optional, default 1.)
+            the polling interval, in seconds.
+        timeout: float (optional)
+            stop waiting after timeout seconds.
+
+        Returns
+        -------
+        done: bool
+            True if the workflow is done.
+        """
+        for change in self.monitor(interval, timeout):
+            pass
+        return self.done
+
+    def failed_jobs(self):
+        """ Get the failed jobs of the submitted chunks.
+
+        Returns
+        -------
+        failed_jobs: list of job identifiers
+            the jobs which have failed, or were aborted or killed.
+        """
+        failed_jobs = []
+        for wf_id in self.workflow_ids:
+            if wf_id is not None:
+                failed_jobs += swclient.Helper.list_failed_jobs(
+                    wf_id, self.controller, include_aborted_jobs=True,
+                    include_user_killed_jobs=True)
+        return failed_jobs
+
+    def stop(self):
+        """ Stop the submitted chunks, and cancel the other ones.
+        """
+        for index, wf_id in enumerate(self.workflow_ids):
+            if wf_id is None:
+                self._cancelled_chunks.add(index)
+            elif self._chunks_status[index] != swconstants.WORKFLOW_DONE:
+                self.controller.stop_workflow(wf_id)
+
+    def delete(self):
+        """ Delete the submitted workflows from soma-workflow.
+        """
+        for index, wf_id in enumerate(self.workflow_ids):
+            if wf_id is not None:
+                self.controller.delete_workflow(wf_id)
+            self._cancelled_chunks.add(index)
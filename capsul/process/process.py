@@ -19,7 +19,13 @@ import shutil
 import six
 import sys
 import functools
-import glob
+import errno
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows: reflinks fall back to copies
+    fcntl = None
 
 # Define the logger
 logger = logging.getLogger(__name__)
@@ -38,6 +44,8 @@ from soma.controller.trait_utils import get_trait_desc
 
 # Capsul import
 from capsul.utils.version_utils import get_tool_version
+from capsul.utils.formats import associated_files
+from capsul.utils.formats import split_extension
 
 if sys.version_info[0] <= 3:
     unicode = str
@@ -478,6 +486,29 @@ class Process(six.with_metaclass(ProcessMeta, Controller)):
         instaitiating the current process, and calling its
         :meth:`_run_process` method.
 
+        Returns
+        -------
+        commandline: list of strings
+            Arguments are in separate elements of the list.
+        """
+        values = dict((trait_name, getattr(self, trait_name))
+                      for trait_name in self.user_traits())
+        return self.get_commandline_from_values(values)
+
+    def get_commandline_from_values(self, values, outputs_file=None):
+        """ Generate the default commandline representation of the process
+        (see :meth:`get_commandline`) for given parameters values, without
+        setting them on the process.
+
+        Parameters
+        ----------
+        values: dict
+            the process parameters values, indexed by parameter name.
+        outputs_file: str (optional)
+            if given, the output parameters values are written in this JSON
+            file after the process execution (see
+            :py:func:`capsul.pipeline.dynamic_iteration.save_outputs`).
+
         Returns
         -------
         commandline: list of strings
@@ -510,7 +541,7 @@ class Process(six.with_metaclass(ProcessMeta, Controller)):
         pathsdict = {}
 
         for trait_name, trait in six.iteritems(self.user_traits()):
-            value = getattr(self, trait_name)
+            value = values.get(trait_name, Undefined)
             if trait_name in reserved_params \
                     or not is_trait_value_defined(value):
                 continue
@@ -541,6 +572,17 @@ class Process(six.with_metaclass(ProcessMeta, Controller)):
             call_name = '%s()' % class_name
 
         # Construct the command line
+        if outputs_file is None:
+            call = "{0}(**kwargs)".format(call_name)
+        else:
+            if hasattr(self, '_function'):
+                raise ValueError(
+                    'outputs of function process %s cannot be saved'
+                    % self.name)
+            call = ("process = {0}; process(**kwargs); "
+                    "from capsul.pipeline.dynamic_iteration import "
+                    "save_outputs; save_outputs(process, {1})").format(
+                        call_name, repr(outputs_file))
         python_command = os.path.basename(sys.executable)
         commandline = [
             python_command,
@@ -549,10 +591,9 @@ class Process(six.with_metaclass(ProcessMeta, Controller)):
              "kwargs.update(dict((sys.argv[i * 2 + {3}], "
              "sys.argv[i * 2 + {4}]) "
              "for i in range(int((len(sys.argv) - {3}) / 2)))); "
-             "{5}(**kwargs)").format(module_name, class_name,
-                                       repr(argsdict), len(pathslist) + 1,
-                                       len(pathslist) + 2,
-                                       call_name).replace("'", '"')
+             "{5}").format(module_name, class_name,
+                           repr(argsdict), len(pathslist) + 1,
+                           len(pathslist) + 2, call).replace("'", '"')
         ] + pathslist + sum([list(x) for x in pathsdict.items()], [])
 
         return commandline
@@ -916,13 +957,85 @@ class Process(six.with_metaclass(ProcessMeta, Controller)):
         return missing
 
 
+# ioctl request cloning a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Ways of copying input files in FileCopyProcess
+copy_modes = ("copy", "hardlink", "symlink", "reflink")
+
+
+def copy_file(source, dest, copy_mode="copy"):
+    """ Copy a file, keeping its metadata (as 'cp -p').
+
+    Parameters
+    ----------
+    source: str
+        the file to copy.
+    dest: str
+        the copy location. An existing file is replaced, a previous link
+        to the source file is only kept by the link modes.
+    copy_mode: str (optional, default 'copy')
+        'copy' for a real copy, 'hardlink' or 'symlink' to link the source
+        file (only for tools which do not modify their inputs), 'reflink'
+        to clone the file on copy-on-write filesystems. Links fall back to
+        a copy when they are not supported (different filesystems for
+        instance).
+    """
+    if copy_mode not in copy_modes:
+        raise ValueError("unknown copy mode '{0}'".format(copy_mode))
+    if os.path.exists(dest) and os.path.samefile(source, dest):
+        if copy_mode in ("hardlink", "symlink"):
+            # already linked
+            return
+        if (os.path.join(os.path.realpath(os.path.dirname(source)),
+                         os.path.basename(source)) ==
+                os.path.join(os.path.realpath(os.path.dirname(dest)),
+                             os.path.basename(dest))):
+            # the file itself, there is nothing to copy
+            return
+    if os.path.lexists(dest):
+        # do not write through a previous link
+        os.unlink(dest)
+    try:
+        if copy_mode == "hardlink":
+            os.link(source, dest)
+            return
+        elif copy_mode == "symlink":
+            os.symlink(os.path.abspath(source), dest)
+            return
+        elif copy_mode == "reflink" and fcntl is not None:
+            with open(source, "rb") as source_file:
+                with open(dest, "wb") as dest_file:
+                    fcntl.ioctl(dest_file.fileno(), FICLONE,
+                                source_file.fileno())
+            shutil.copystat(source, dest)
+            return
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP,
+                           errno.ENOTTY, errno.EINVAL, errno.ENOSYS,
+                           errno.EMLINK):
+            raise
+        logger.debug("cannot {0} '{1}', copying it: {2}".format(
+            copy_mode, source, e))
+        if os.path.lexists(dest):
+            os.unlink(dest)
+    shutil.copy2(source, dest)
+
+
 class FileCopyProcess(Process):
     """ A specific process that copies all the input files.
 
+    Input files are copied with their associated files ('.hdr' or '.mat'
+    files for instance, see :py:mod:`capsul.utils.formats`), in parallel.
+    Files of unregistered formats are copied with the files having the
+    same name and other extensions.
+
     Attributes
     ----------
     `copied_inputs` : list of 2-uplet
         the list of copied files (src, dest).
+    `copy_mode` : str
+        how files are copied: see :py:func:`copy_file`.
 
     Methods
     -------
@@ -932,7 +1045,8 @@ class FileCopyProcess(Process):
     _copy_input_files
     """
     def __init__(self, activate_copy=True, inputs_to_copy=None,
-                 inputs_to_clean=None, destination=None):
+                 inputs_to_clean=None, destination=None, copy_mode="copy",
+                 copy_workers=4):
         """ Initialize the FileCopyProcess class.
 
         Parameters
@@ -949,13 +1063,23 @@ class FileCopyProcess(Process):
             where the files are copied.
             If None, files are copied in a '_workspace' folder included in the
             image folder.
+        copy_mode: str (optional, default 'copy')
+            'copy', 'hardlink', 'symlink' or 'reflink': see
+            :py:func:`copy_file`. Links must only be used if the process
+            does not modify its inputs.
+        copy_workers: int (optional, default 4)
+            the number of files copied in parallel.
         """
         # Inheritance
         super(FileCopyProcess, self).__init__()
 
         # Class parameters
+        if copy_mode not in copy_modes:
+            raise ValueError("unknown copy mode '{0}'".format(copy_mode))
         self.activate_copy = activate_copy
         self.destination = destination
+        self.copy_mode = copy_mode
+        self.copy_workers = copy_workers
         if self.activate_copy:
             self.inputs_to_clean = inputs_to_clean or []
             if inputs_to_copy is None:
@@ -1029,12 +1153,59 @@ class FileCopyProcess(Process):
         self.copied_inputs = self._copy_input_files(input_parameters)
 
     def _copy_input_files(self, python_object):
-        """ Recursive method that copy the input process files.
+        """ Copy the input process files.
+
+        Parameters
+        ----------
+        python_object: object
+            a generic python object.
+
+        Returns
+        -------
+        out: object
+            the copied-file input object.
+        """
+        # Find the files to copy, then copy them in parallel
+        copies = {}
+        out = self._get_copied_files(python_object, copies, {})
+        copies = sorted(six.iteritems(copies))
+        if self.copy_workers and self.copy_workers > 1 and len(copies) > 1:
+            pool = ThreadPool(min(self.copy_workers, len(copies)))
+            try:
+                pool.map(self._copy_file, copies)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for copy in copies:
+                self._copy_file(copy)
+
+        return out
+
+    def _copy_file(self, copy):
+        """ Copy a file.
+
+        Parameters
+        ----------
+        copy: tuple
+            the (destination, source) files.
+        """
+        dest, source = copy
+        copy_file(source, dest, self.copy_mode)
+
+    def _get_copied_files(self, python_object, copies, listings):
+        """ Recursive method that finds the input process files to copy.
 
         Parameters
         ----------
         python_object: object
             a generic python object.
+        copies: dict
+            map the files to copy, with their associated files, to their
+            source.
+        listings: dict
+            the files of the source directories of unregistered formats,
+            listed once.
 
         Returns
         -------
@@ -1048,7 +1219,7 @@ class FileCopyProcess(Process):
             out = {}
             for key, val in python_object.items():
                 if val is not Undefined:
-                    out[key] = self._copy_input_files(val)
+                    out[key] = self._get_copied_files(val, copies, listings)
 
         # Deal with tuple and list
         # Create an output list or tuple that will contain the copied file
@@ -1057,12 +1228,11 @@ class FileCopyProcess(Process):
             out = []
             for val in python_object:
                 if val is not Undefined:
-                    out.append(self._copy_input_files(val))
+                    out.append(self._get_copied_files(val, copies, listings))
             if isinstance(python_object, tuple):
                 out = tuple(out)
 
-        # Otherwise start the copy (with metadata cp -p) if the object is
-        # a file
+        # Otherwise copy (with metadata cp -p) the object if it is a file
         else:
             out = python_object
             if (python_object is not Undefined and
@@ -1077,16 +1247,25 @@ class FileCopyProcess(Process):
                     os.makedirs(destdir)
                 fname = os.path.basename(python_object)
                 out = os.path.join(destdir, fname)
-                shutil.copy2(python_object, out)
-                
-                # Copy associated .mat files
-                name = fname.split(".")[0]
-                matfnames = glob.glob(os.path.join(
-                    os.path.dirname(python_object), name + ".*"))
-                for matfname in matfnames:
-                    extrafname = os.path.basename(matfname)
-                    extraout = os.path.join(destdir, extrafname)
-                    shutil.copy2(matfname, extraout)
+                copies[out] = python_object
+
+                # Copy associated files (.hdr, .mat...)
+                for extra in associated_files(python_object,
+                                              existing_only=True):
+                    copies[os.path.join(destdir,
+                                        os.path.basename(extra))] = extra
+
+                # Unregistered formats: copy the files with the same name
+                # and other extensions
+                if split_extension(python_object)[1] is None:
+                    if srcdir not in listings:
+                        listings[srcdir] = os.listdir(srcdir or os.curdir)
+                    name = fname.split(".")[0]
+                    for extrafname in listings[srcdir]:
+                        extra = os.path.join(srcdir, extrafname)
+                        if extrafname.startswith(name + ".") \
+                                and os.path.isfile(extra):
+                            copies[os.path.join(destdir, extrafname)] = extra
 
         return out
 
@@ -290,6 +290,22 @@ def main():
                       'it is kept.')
     parser.add_option_group(group2)
 
+    group_cache = OptionGroup(parser, 'Smart caching',
+                              description='Caching of processes results')
+    group_cache.add_option('--smart-caching', dest='smart_caching',
+                           action='store_true', default=False,
+                           help='use smart-caching with provenance '
+                           'signatures: results are stored in the output '
+                           'directory, and nodes already computed with the '
+                           'same inputs are not run again.')
+    group_cache.add_option('--cache-plan', dest='cache_plan',
+                           action='store_true', default=False,
+                           help='display which pipeline nodes are cached, '
+                           'which have to be run, and the estimated time '
+                           'saved according to stored runtimes, then exit '
+                           'without running anything.')
+    parser.add_option_group(group_cache)
+
     group3 = OptionGroup(parser, 'Iteration',
                         description='Iteration')
     group3.add_option('-I', '--iterate', dest='iterate_on', action='append',
@@ -424,6 +440,19 @@ def main():
         del aval, attribs, completion_engine, process
         sys.exit(0)
 
+    if options.smart_caching or options.cache_plan:
+        study_config.use_smart_caching = True
+        study_config.smart_caching_provenance = True
+
+    if options.cache_plan:
+        try:
+            plan = study_config.smart_caching_plan(process)
+        except ValueError as e:
+            print("error: {0}".format(e), file=sys.stderr)
+            sys.exit(1)
+        print(plan.report())
+        sys.exit(0)
+
     resource_id = options.resource_id
     password = options.password
     rsa_key_pass = options.rsa_key_pass
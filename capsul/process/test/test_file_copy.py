@@ -0,0 +1,133 @@
+##########################################################################
+# Capsul - Copyright (C) CEA, 2014
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+
+# Capsul import
+from capsul.api import FileCopyProcess
+from capsul.process.process import copy_file
+
+# Trait import
+from traits.api import File, List, String
+
+
+class DummyCopyProcess(FileCopyProcess):
+    """ Dummy file copy.
+    """
+    i = File(output=False, optional=False, desc="a file")
+    l = List(File(), output=False, optional=False, desc="a list of file")
+    s = String(output=True, optional=False, desc="the output file copy map")
+
+    def _run_process(self):
+        self.s = repr(self.copied_inputs)
+
+
+class TestFileCopy(unittest.TestCase):
+    """ Test the copy of FileCopyProcess input files.
+    """
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        self.files = []
+        for fname in ["a.nii", "a.mat", "b.nii", "c.nii", "ab.nii"]:
+            fname = os.path.join(self.workspace_dir, fname)
+            with open(fname, "w") as f:
+                f.write(os.path.basename(fname))
+            self.files.append(fname)
+        self.destination = os.path.join(self.workspace_dir, "copy")
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+
+    def test_copy_modes(self):
+        """ Test input files copies with their associated files.
+        """
+        for copy_mode in ["copy", "hardlink", "symlink", "reflink"]:
+            process = DummyCopyProcess(destination=self.destination,
+                                       copy_mode=copy_mode)
+            process(i=self.files[0], l=self.files[2:4])
+            self.assertEqual(process.copied_inputs, {
+                "i": os.path.join(self.destination, "a.nii"),
+                "l": [os.path.join(self.destination, "b.nii"),
+                      os.path.join(self.destination, "c.nii")]})
+            self.assertEqual(sorted(os.listdir(self.destination)),
+                             ["a.mat", "a.nii", "b.nii", "c.nii"])
+            for fname in os.listdir(self.destination):
+                with open(os.path.join(self.destination, fname)) as f:
+                    self.assertEqual(f.read(), fname)
+            if copy_mode == "hardlink":
+                self.assertTrue(os.path.samefile(
+                    self.files[0], os.path.join(self.destination, "a.nii")))
+            self.assertEqual(
+                os.path.islink(os.path.join(self.destination, "a.nii")),
+                copy_mode == "symlink")
+            shutil.rmtree(self.destination)
+
+        self.assertRaises(ValueError, DummyCopyProcess, copy_mode="move")
+
+    def test_associated_files(self):
+        """ Test copies of sidecar files and of files of unregistered formats.
+        """
+        for fname in ["dwi.nii.gz", "dwi.json", "dwi.bval", "dwi.bvec",
+                      "dwi_other.json", "d.foo", "d.bar", "d.foo.minf",
+                      "dd.bar"]:
+            with open(os.path.join(self.workspace_dir, fname), "w") as f:
+                f.write(fname)
+        process = DummyCopyProcess(destination=self.destination)
+        process(i=os.path.join(self.workspace_dir, "dwi.nii.gz"),
+                l=[os.path.join(self.workspace_dir, "d.foo")])
+        self.assertEqual(sorted(os.listdir(self.destination)),
+                         ["d.bar", "d.foo", "d.foo.minf", "dwi.bval",
+                          "dwi.bvec", "dwi.json", "dwi.nii.gz"])
+
+    def test_copy_file(self):
+        """ Test copies replacing existing files.
+        """
+        dest = os.path.join(self.workspace_dir, "dest.nii")
+        copy_file(self.files[0], dest, "symlink")
+        copy_file(self.files[2], dest, "copy")
+        self.assertFalse(os.path.islink(dest))
+        copy_file(self.files[0], dest, "hardlink")
+        copy_file(self.files[0], dest, "hardlink")
+        with open(dest) as f:
+            self.assertEqual(f.read(), "a.nii")
+
+        # A copy replaces a previous link: writing to the copy keeps the
+        # source file unchanged
+        for copy_mode in ["hardlink", "symlink"]:
+            copy_file(self.files[0], dest, copy_mode)
+            copy_file(self.files[0], dest, "copy")
+            self.assertFalse(os.path.islink(dest))
+            self.assertFalse(os.path.samefile(self.files[0], dest))
+            with open(dest, "w") as f:
+                f.write("modified")
+            with open(self.files[0]) as f:
+                self.assertEqual(f.read(), "a.nii")
+            with open(dest) as f:
+                self.assertEqual(f.read(), "modified")
+
+        # Copying a file onto itself keeps it
+        copy_file(self.files[0], self.files[0], "copy")
+        with open(self.files[0]) as f:
+            self.assertEqual(f.read(), "a.nii")
+        self.assertRaises(ValueError, copy_file, self.files[0], dest, "move")
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFileCopy)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
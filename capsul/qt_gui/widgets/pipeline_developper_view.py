@@ -30,6 +30,7 @@ from soma.qt_gui.qt_backend.Qt import QMessageBox
 from soma.sorted_dictionary import SortedDictionary
 from capsul.api import Switch, PipelineNode, OptionalOutputSwitch
 from capsul.pipeline import pipeline_tools
+from capsul.utils.stat_cache import StatCache
 from capsul.api import Pipeline
 from capsul.api import Process
 from capsul.api import get_process_instance
@@ -3199,10 +3200,12 @@ class PipelineDevelopperView(QGraphicsView):
         self.scene.pipeline.enable_all_pipeline_steps()
 
     def check_files(self):
+        # both checks share the directories listings
+        stat_cache = StatCache()
         overwritten_outputs = pipeline_tools.nodes_with_existing_outputs(
-            self.scene.pipeline)
+            self.scene.pipeline, stat_cache=stat_cache)
         missing_inputs = pipeline_tools.nodes_with_missing_inputs(
-            self.scene.pipeline)
+            self.scene.pipeline, stat_cache=stat_cache)
         if len(overwritten_outputs) == 0 and len(missing_inputs) == 0:
             QtGui.QMessageBox.information(
                 self, 'Pipeline ready', 'All input files are available. '
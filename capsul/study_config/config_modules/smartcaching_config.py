@@ -6,7 +6,7 @@
 # for details.
 ##########################################################################
 
-from traits.api import Bool, Undefined
+from traits.api import Bool, Dict, Directory, Int, List, Str, Undefined
 from capsul.study_config.study_config import StudyConfigModule
 
 
@@ -17,5 +17,51 @@ class SmartCachingConfig(StudyConfigModule):
             False,
             output=False,
             desc='Use smart-caching during the execution'))
+        study_config.add_trait('smart_caching_pipelines', List(
+            Str(),
+            output=False,
+            desc='Sub-pipeline nodes (names, or dotted paths from the '
+            'executed pipeline) which are cached as a whole, keyed by their '
+            'exported inputs, instead of caching their internal nodes one '
+            'by one. An empty name selects the executed pipeline itself.'))
+        study_config.add_trait('smart_caching_provenance', Bool(
+            False,
+            output=False,
+            desc='Derive the cache key of pipeline nodes from the keys of '
+            'their upstream nodes instead of input files fingerprints, so '
+            'that fully cached parts of the pipeline are detected and '
+            'skipped before the execution'))
+        study_config.add_trait('smart_caching_local_directory', Directory(
+            Undefined,
+            output=False,
+            desc='Local (fast) cache directory, used as a first tier over '
+            'the output directory cache: entries are copied there when they '
+            'are used and written to both tiers'))
+        study_config.add_trait('smart_caching_local_size_limit', Int(
+            0,
+            output=False,
+            desc='Size limit of the local cache directory in megabytes: the '
+            'least recently used entries are removed above it. 0 means no '
+            'limit.'))
+        study_config.add_trait('smart_caching_compression', Dict(
+            Str(), Str(),
+            output=False,
+            desc='Compression of the files stored in the cache: map file '
+            'extensions (ex: ".nii") to a codec name ("gzip", or "zstd" if '
+            'the zstandard module is installed)'))
+        study_config.add_trait('smart_caching_lazy_restore', Bool(
+            False,
+            output=False,
+            desc='On cache hits, only restore the output files which are '
+            'used by the executed nodes or exported by the pipeline: the '
+            'other ones are restored on request, using the study '
+            'configuration restore_cached_outputs() method'))
+        study_config.add_trait('smart_caching_reuse_fingerprints', Bool(
+            False,
+            output=False,
+            desc='Fingerprint each input file only once during a run, '
+            'instead of before each node. The outputs of the executed nodes '
+            'are fingerprinted again, but files must not be modified by '
+            'other means during the run.'))
         self.study_config = study_config
         # self.study_config.on_trait_change(self._use_smart_caching_changed, 'use_smart_caching')
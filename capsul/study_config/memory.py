@@ -18,9 +18,30 @@ import json
 import logging
 import six
 import sys
+import tempfile
+import gzip
+import threading
+import stat
+import inspect
+import io
+import tarfile
+import errno
+import socket
+import uuid
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows: cache locks will use lock directories
+    fcntl = None
+try:
+    import zstandard
+except ImportError:
+    # the zstd cache codec is not available
+    zstandard = None
 
 # CAPSUL import
 from capsul.process.process import Process, ProcessResult
+from capsul.utils.formats import associated_files
 
 # NIPYPE import
 try:
@@ -34,6 +55,9 @@ except ImportError:
 # TRAITS import
 from traits.api import Undefined
 
+# SOMA import
+from soma.controller import Controller
+
 if sys.version_info[0] >= 3:
     basestring = str
 
@@ -41,6 +65,10 @@ if sys.version_info[0] >= 3:
 # Define the logger
 logger = logging.getLogger(__name__)
 
+# Per process class cache of the hashed parameters: map each process class
+# to a {trait name: (trait, hashed)} dictionary
+_hashed_traits = {}
+
 
 ###########################################################################
 # Proxy process objects
@@ -187,9 +215,23 @@ class MemorizedProcess(object):
 
     All values are cached on the filesystem, in a deep directory
     structure. Methods are provided to inspect the cache or clean it.
+
+    A pipeline may also be memorized as a whole: it is then keyed by its
+    exported inputs (and nodes activation), only its exported outputs are
+    stored and restored, and on a hit its internal nodes (and their
+    temporary files) are not considered at all.
+
+    An optional local cache directory may be used as a fast tier over the
+    (shared) cache directory: entries are restored from it when present,
+    copied to it from the shared tier on a hit, and new entries are
+    written to both tiers. The least recently used local entries are
+    evicted to keep it under a size limit.
     """
 
-    def __init__(self, process, cachedir, timestamp=None, verbose=1):
+    def __init__(self, process, cachedir, timestamp=None, verbose=1,
+                 signature=None, local_cachedir=None, local_size_limit=None,
+                 compression=None, statistics=None, fingerprints=None,
+                 pending_restorations=None):
         """ Initialize the MemorizedProcess class.
 
         Parameters
@@ -206,6 +248,27 @@ class MemorizedProcess(object):
             is called.
         verbose: int
             if different from zero, print console messages.
+        signature: string (optional)
+            the cache key to use instead of the hash of the process
+            arguments (a provenance signature for instance).
+        local_cachedir: string (optional)
+            the directory of the local cache tier.
+        local_size_limit: int (optional)
+            the local cache tier size limit, in bytes. If None, local entries
+            are never evicted.
+        compression: dict (optional)
+            map file extensions to the name of the codec used to compress
+            the files stored in the cache (see :py:func:`get_cache_codec`).
+        statistics: CacheStatistics (optional)
+            the counters updated by the cache accesses.
+        fingerprints: dict (optional)
+            a cache of input files fingerprints, shared by the processes
+            called during a run. Files written by the processes are removed
+            from it.
+        pending_restorations: dict (optional)
+            where the output files which are not restored on a cache hit
+            (see restore_outputs) are recorded, to be restored later on
+            demand (see :py:meth:`Memory.restore`).
         """
         # Check the a process is passed
         self.process_class = process.__class__
@@ -234,6 +297,32 @@ class MemorizedProcess(object):
         # Store if some messages have to be displayed
         self.verbose = verbose
 
+        # Store the cache key if it is already known
+        self.signature = signature
+
+        # Define the local cache tier
+        if local_cachedir is not None:
+            local_cachedir = os.path.abspath(local_cachedir)
+        self.local_cachedir = local_cachedir
+        self.local_size_limit = local_size_limit
+
+        # Define the stored files compression
+        self.compression = dict(
+            (extension.lower(), get_cache_codec(codec_name))
+            for extension, codec_name in six.iteritems(compression or {}))
+
+        # Store the cache counters
+        self.statistics = statistics
+
+        # Store the fingerprints cache
+        self.fingerprints = fingerprints
+
+        # Define which outputs are restored on a hit: None means all of
+        # them, otherwise files of other output parameters are recorded in
+        # pending_restorations
+        self.restore_outputs = None
+        self.pending_restorations = pending_restorations
+
     def __call__(self, **kwargs):
         """ Call wrapped process and cache result, or read cache if
         available.
@@ -255,61 +344,332 @@ class MemorizedProcess(object):
 
         # Create the destination folder and a unique id for the current
         # process
+        start_time = time.time()
         process_dir, process_hash, input_parameters = self._get_process_id()
+        local_dir = self._get_local_entry_dir(process_dir)
+        self._record(hash_time=time.time() - start_time)
+
+        # Restore the process results from the local tier if possible
+        if local_dir is not None and self._is_valid_entry(local_dir):
+            result = self._restore_local_entry(local_dir, input_parameters)
+            if result is not None:
+                return result[0]
+
+        # Restore the process results from the cache folder if a complete
+        # entry is already there: entries are immutable once written, so no
+        # lock is needed to read them.
+        if not self._is_valid_entry(process_dir):
+
+            # Several workers may compute the same signature concurrently:
+            # only the first one runs the process, the others wait for the
+            # result and read it from the cache.
+            with CacheEntryLock(process_dir):
+                if not self._is_valid_entry(process_dir):
+                    return self._compute_entry(process_dir, input_parameters,
+                                               local_dir)
+
+        # Promote the entry to the local tier, replacing an invalid local
+        # entry (expired, or written under another cache policy)
+        if local_dir is not None:
+            if os.path.isdir(local_dir):
+                remove_cache_entry(local_dir)
+            copy_cache_entry(process_dir, local_dir)
+            result = self._restore_local_entry(local_dir, input_parameters)
+            if result is not None:
+                return result[0]
+
+        return self._restore_entry(process_dir, input_parameters)
+
+    def get_cached_entry(self):
+        """ Get the complete cache entry matching the current process
+        parameters.
 
-        # Execute the process
-        if not os.path.isdir(process_dir):
+        Returns
+        -------
+        process_dir: string
+            the entry directory, in the local tier if it is there, None if
+            the process is not cached.
+        """
+        process_dir = self._get_process_id()[0]
+        for entry_dir in (self._get_local_entry_dir(process_dir),
+                          process_dir):
+            if entry_dir is not None and self._is_valid_entry(entry_dir):
+                return entry_dir
+        return None
 
-            # Create the destination memory folder
-            os.makedirs(process_dir)
+    def _is_valid_entry(self, process_dir):
+        """ Check if a cache entry is complete and has not expired according
+        to the process cache policy.
+
+        Parameters
+        ----------
+        process_dir: string
+            the cache entry directory.
 
-            # Try to execute the process and if an error occured remove the
-            # cache folder
+        Returns
+        -------
+        valid: bool
+            True if the entry can be restored.
+        """
+        if not is_complete_cache_entry(process_dir):
+            return False
+        ttl = get_cache_policy(self.process).ttl
+        if ttl is not None:
+            result_fname = os.path.join(process_dir, "result.json")
             try:
-                # Run
-                result = self._call_process(process_dir, input_parameters)
-
-                # Save the result files in the memory with the corresponding
-                # mapping
-                output_parameters = {}
-                for name, trait in self.process.traits(output=True).items():
-                    # Get the trait value
-                    value = self.process.get_parameter(name)
-                    output_parameters[name] = value
-                file_mapping = []
-                self._copy_files_to_memory(output_parameters, process_dir,
-                                           file_mapping)
-                map_fname = os.path.join(process_dir, "file_mapping.json")
-                with open(map_fname, "w") as open_file:
-                    open_file.write(json.dumps(file_mapping))
-
-            except:
-                shutil.rmtree(process_dir)
-                raise
+                age = time.time() - os.stat(result_fname).st_mtime
+            except OSError:
+                return False
+            if age > ttl:
+                return False
+        return True
+
+    def _get_versions(self):
+        """ Get the code versions added to the process signature: the
+        process versions, and the version or source hash declared by its
+        cache policy.
 
-        # Restore the process results from the cache folder
-        else:
-            # Restore the memorized files
-            map_fname = os.path.join(process_dir, "file_mapping.json")
-            with open(map_fname, "r") as json_data:
-                file_mapping = json.load(json_data)
+        Returns
+        -------
+        versions: dict
+            the versions to hash.
+        """
+        policy = get_cache_policy(self.process)
+        if policy.version is None and not policy.source_hash:
+            return self.process.versions
+        versions = dict(self.process.versions)
+        if policy.version is not None:
+            versions["cache_policy_version"] = policy.version
+        if policy.source_hash:
+            versions["source_hash"] = get_source_hash(self.process_class)
+        return versions
+
+    def _get_local_entry_dir(self, process_dir):
+        """ Get the local tier counterpart of a cache entry.
 
-            # Go through all mapping files
-            for workspace_file, memory_file in file_mapping:
+        Parameters
+        ----------
+        process_dir: string
+            the cache entry directory.
 
-                # Determine if the workspace directory is writeable
-                if os.access(os.path.dirname(workspace_file), os.W_OK):
-                    shutil.copy2(memory_file, workspace_file)
-                else:
-                    logger.debug("Can't restore file '{0}', access rights are "
-                                 "not sufficients.".format(workspace_file))
+        Returns
+        -------
+        local_dir: string
+            the local entry directory, None if there is no local tier.
+        """
+        if self.local_cachedir is None:
+            return None
+        local_dir = os.path.join(
+            self.local_cachedir, os.path.relpath(process_dir, self.cachedir))
+        makedirs(os.path.dirname(local_dir))
+        return local_dir
+
+    def _restore_local_entry(self, local_dir, input_parameters):
+        """ Restore the process results from the local tier, and evict old
+        local entries.
+
+        Parameters
+        ----------
+        local_dir: string
+            the local cache entry directory.
+        input_parameters: dict
+            the process input_parameters.
+
+        Returns
+        -------
+        result: tuple
+            a 1-uplet with the process cached results, or None if the entry
+            has been evicted by a concurrent worker in the meantime.
+        """
+        # Mark the entry as recently used
+        try:
+            os.utime(local_dir, None)
+            result = self._restore_entry(local_dir, input_parameters)
+        except (IOError, OSError):
+            logger.debug("Local cache entry '{0}' has been evicted while "
+                         "reading it.".format(local_dir))
+            return None
+        if self.local_size_limit is not None:
+            evict_cache_entries(self.local_cachedir, self.local_size_limit,
+                                keep=[local_dir])
+        return (result, )
+
+    def _compute_entry(self, process_dir, input_parameters, local_dir=None):
+        """ Run the process and store its results in a new cache entry.
+
+        The entry is written in a temporary directory which is renamed
+        to its final location once complete, so that an interrupted run never
+        leaves a partial entry which would later be read as a hit.
+        This method must be called while holding the entry lock.
+
+        Parameters
+        ----------
+        process_dir: string
+            the final cache entry directory.
+        input_parameters: dict
+            the process input_parameters.
+        local_dir: string (optional)
+            the local tier entry directory. If given the entry is written
+            there first, then copied to the shared tier.
+
+        Returns
+        -------
+        result: dict
+            the process results.
+        """
+        entry_dir = process_dir
+        if local_dir is not None:
+            entry_dir = local_dir
+
+        self._record(misses=1)
+
+        # Remove an incomplete or invalid entry: readers may still be
+        # copying files from it
+        if local_dir is not None:
+            remove_cache_entry(local_dir)
+        else:
+            _discard_cache_entry(process_dir)
+
+        # Create the temporary memory folder, next to the final one so that
+        # it is on the same filesystem
+        tmp_dir = tempfile.mkdtemp(
+            prefix=os.path.basename(entry_dir) + ".tmp",
+            dir=os.path.dirname(entry_dir))
 
-            # Update the process output traits
-            result = self._load_process_result(process_dir, input_parameters)
+        # Try to execute the process and if an error occured remove the
+        # temporary cache folder
+        try:
+            # Run
+            result = self._call_process(tmp_dir, input_parameters)
+
+            # Save the result files in the memory with the corresponding
+            # mapping
+            output_parameters = {}
+            for name, trait in self.process.traits(output=True).items():
+                # Get the trait value
+                value = self.process.get_parameter(name)
+                output_parameters[name] = value
+            self._forget_fingerprints(output_parameters)
+            file_mapping = []
+            for name, value in six.iteritems(output_parameters):
+                self._copy_files_to_memory(value, tmp_dir, file_mapping,
+                                           parameter=name)
+            map_fname = os.path.join(tmp_dir, "file_mapping.json")
+            with open(map_fname, "w") as open_file:
+                open_file.write(json.dumps(file_mapping))
+
+            # Commit the entry
+            os.rename(tmp_dir, entry_dir)
+
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        # Write through to the shared tier
+        if local_dir is not None:
+            _discard_cache_entry(process_dir)
+            copy_cache_entry(local_dir, process_dir)
+            if self.local_size_limit is not None:
+                evict_cache_entries(self.local_cachedir,
+                                    self.local_size_limit, keep=[local_dir])
 
         return result
 
-    def _copy_files_to_memory(self, python_object, process_dir, file_mapping):
+    def _restore_entry(self, process_dir, input_parameters):
+        """ Restore the process results from a complete cache entry.
+
+        Parameters
+        ----------
+        process_dir: string
+            the cache entry directory.
+        input_parameters: dict
+            the process input_parameters.
+
+        Returns
+        -------
+        result: dict
+            the process cached results.
+        """
+        # Restore the memorized files
+        start_time = time.time()
+        restored_size = 0
+        map_fname = os.path.join(process_dir, "file_mapping.json")
+        with open(map_fname, "r") as json_data:
+            file_mapping = json.load(json_data)
+
+        # Go through all mapping files
+        for mapping in file_mapping:
+
+            # Older entries store (workspace_file, memory_file) lists
+            if isinstance(mapping, list):
+                mapping = {"workspace": mapping[0], "memory": mapping[1]}
+            workspace_file = mapping["workspace"]
+
+            # Memory files are stored relative to the entry directory
+            # (absolute paths are kept for older entries)
+            memory_file = os.path.join(process_dir, mapping["memory"])
+
+            # Outputs which are not needed are restored on demand
+            parameter = mapping.get("parameter")
+            if self.restore_outputs is not None and parameter is not None \
+                    and parameter not in self.restore_outputs \
+                    and self.pending_restorations is not None:
+                self.pending_restorations[workspace_file] = (
+                    self._get_memory_file_candidates(process_dir,
+                                                     mapping["memory"]),
+                    mapping.get("codec"))
+                continue
+
+            # Determine if the workspace directory is writeable
+            if os.access(os.path.dirname(workspace_file), os.W_OK):
+                self._forget_fingerprints(workspace_file)
+                restore_cache_file(memory_file, workspace_file,
+                                   mapping.get("codec"))
+                if self.pending_restorations is not None:
+                    self.pending_restorations.pop(workspace_file, None)
+                restored_size += os.path.getsize(workspace_file)
+            else:
+                logger.debug("Can't restore file '{0}', access rights are "
+                             "not sufficients.".format(workspace_file))
+        self._record(hits=1, bytes_restored=restored_size,
+                     copy_time=time.time() - start_time)
+
+        # Update the process output traits
+        return self._load_process_result(process_dir, input_parameters)
+
+    def _get_memory_file_candidates(self, process_dir, memory_file):
+        """ Get the locations of a stored file, the local tier one first.
+
+        Parameters
+        ----------
+        process_dir: str
+            the cache entry directory the file is restored from.
+        memory_file: str
+            the file name, relative to the entry directory.
+
+        Returns
+        -------
+        candidates: list of str
+            the stored file locations: in the given entry, then in the shared
+            tier if the entry is a local one (it may be evicted).
+        """
+        candidates = [os.path.join(process_dir, memory_file)]
+        if self.local_cachedir is not None \
+                and process_dir.startswith(self.local_cachedir + os.sep):
+            shared_dir = os.path.join(
+                self.cachedir,
+                os.path.relpath(process_dir, self.local_cachedir))
+            candidates.append(os.path.join(shared_dir, memory_file))
+        return candidates
+
+    def _record(self, **values):
+        """ Update the cache counters of the process class, if any.
+        """
+        if self.statistics is not None:
+            self.statistics.add(self.process.id, **values)
+
+    def _copy_files_to_memory(self, python_object, process_dir, file_mapping,
+                              parameter=None):
         """ Copy file items inside the memory.
 
         Parameters
@@ -318,31 +678,97 @@ class MemorizedProcess(object):
             a generic python object.
         process_dir: str
             the process memory path.
-        file_mapping: list of 2-uplet
+        file_mapping: list of dict
             store in this structure the mapping between the workspace and the
-            memory (workspace_file, memory_file).
+            memory: the 'workspace' file, the 'memory' file name, relative to
+            the process memory path, the compression 'codec' name (None
+            for uncompressed files), and the output 'parameter' name.
+        parameter: str (optional)
+            the name of the output parameter holding the python object.
         """
         # Deal with dictionary
         if isinstance(python_object, dict):
             for val in python_object.values():
                 if val is not Undefined:
-                    self._copy_files_to_memory(val, process_dir, file_mapping)
+                    self._copy_files_to_memory(val, process_dir, file_mapping,
+                                               parameter)
 
         # Deal with tuple and list
         elif isinstance(python_object, (list, tuple)):
             for val in python_object:
                 if val is not Undefined:
-                    self._copy_files_to_memory(val, process_dir, file_mapping)
+                    self._copy_files_to_memory(val, process_dir, file_mapping,
+                                               parameter)
 
-        # Otherwise start the copy if the object is a file
+        # Otherwise start the copy if the object is a file, with its
+        # associated files (.hdr, .minf...)
         else:
             if (python_object is not Undefined and
                     isinstance(python_object, basestring) and
                     os.path.isfile(python_object)):
-                fname = os.path.basename(python_object)
-                out = os.path.join(process_dir, fname)
-                shutil.copy2(python_object, out)
-                file_mapping.append((python_object, out))
+                for path in [python_object] + associated_files(
+                        python_object, existing_only=True):
+                    self._store_file(path, process_dir, file_mapping,
+                                     parameter)
+
+    def _store_file(self, path, process_dir, file_mapping, parameter):
+        """ Copy a file inside the memory.
+
+        Parameters
+        ----------
+        path: str
+            the workspace file.
+        process_dir: str
+            the process memory path.
+        file_mapping: list of dict
+            the mapping between the workspace and the memory, see
+            :py:meth:`_copy_files_to_memory`.
+        parameter: str
+            the name of the output parameter holding the file.
+        """
+        fname = os.path.basename(path)
+        codec_name, codec = self._get_codec(fname)
+        if codec is not None:
+            fname += codec.suffix
+        out = os.path.join(process_dir, fname)
+        start_time = time.time()
+        if codec is not None:
+            codec.compress_file(path, out)
+            shutil.copystat(path, out)
+        else:
+            shutil.copy2(path, out)
+        self._record(bytes_stored=os.path.getsize(out),
+                     copy_time=time.time() - start_time)
+        file_mapping.append({"workspace": path,
+                             "memory": fname,
+                             "codec": codec_name,
+                             "parameter": parameter})
+
+    def _get_codec(self, fname):
+        """ Get the codec used to store a file, from its extension.
+
+        The longest matching extension is used ('.nii.gz' takes precedence
+        over '.gz').
+
+        Parameters
+        ----------
+        fname: str
+            the file name.
+
+        Returns
+        -------
+        codec_name: str
+            the codec name, None if the file is not compressed.
+        codec: CacheCodec
+            the codec, None if the file is not compressed.
+        """
+        fname = fname.lower()
+        extensions = [extension for extension in self.compression
+                      if fname.endswith(extension)]
+        if not extensions:
+            return None, None
+        codec = self.compression[max(extensions, key=len)]
+        return codec.name, codec
 
     def _call_process(self, process_dir, input_parameters):
         """ Call a process.
@@ -369,13 +795,22 @@ class MemorizedProcess(object):
         start_time = time.time()
 
         # Execute the process
-        result = self.process()
+        if hasattr(self.process, "nodes"):
+            result = self._call_pipeline()
+        else:
+            result = self.process()
         duration = time.time() - start_time
 
-        # Save the result in json format
-        cache = {'parameters': dict((i, getattr(self.process, i)) 
-                                    for i in self.process.user_traits()),
-                 'result': result}
+        # Save the result in json format (pipeline controller parameters,
+        # such as nodes activation, are not parameters to restore)
+        parameters = {}
+        for name in self.process.user_traits():
+            value = getattr(self.process, name)
+            if not isinstance(value, Controller):
+                parameters[name] = value
+        cache = {'parameters': parameters,
+                 'result': result,
+                 'duration': duration}
         json_data = json.dumps(cache, sort_keys=True,
                                check_circular=True, indent=4,
                                cls=CapsulResultEncoder)
@@ -390,6 +825,28 @@ class MemorizedProcess(object):
 
         return result
 
+    def _call_pipeline(self):
+        """ Call a pipeline memorized as a whole.
+
+        The pipeline is run through its StudyConfig with smart-caching
+        disabled, so that its internal nodes are not cached one by one in
+        addition to the pipeline itself.
+
+        Returns
+        -------
+        result: dict
+            the pipeline results.
+        """
+        study_config = self.process.get_study_config()
+        use_smart_caching = study_config.get_trait_value("use_smart_caching")
+        if use_smart_caching:
+            study_config.use_smart_caching = False
+        try:
+            return self.process()
+        finally:
+            if use_smart_caching:
+                study_config.use_smart_caching = True
+
     def _load_process_result(self, process_dir, input_parameters):
         """ Load the result of a process.
 
@@ -416,9 +873,10 @@ class MemorizedProcess(object):
             raise KeyError(
                 "Non-existing cache value (may have been cleared).\n"
                 "File {0} does not exist.".format(result_fname))
+        start_time = time.time()
         with open(result_fname, "r") as json_data:
             result_dict = json.load(json_data, cls=CapsulResultDecoder)
-
+        self._record(load_time=time.time() - start_time)
 
         ## Update the process output traits
         for name, value in six.iteritems(result_dict['parameters']):
@@ -435,12 +893,17 @@ class MemorizedProcess(object):
         process_dir: string
             the directory where the cache should be write.
         process_hash: string
-            the process md5 hash.
+            the process hash.
         input_parameters: dict
             the process input_parameters.
         """
-        # Get the process id
-        process_hash, input_parameters = self._get_argument_hash()
+        # Get the process id: a signature given at construction replaces the
+        # arguments hash
+        if self.signature is not None:
+            process_hash = self.signature
+            input_parameters = self._get_hashed_parameters()
+        else:
+            process_hash, input_parameters = self._get_argument_hash()
         process_dir = os.path.join(self._get_process_dir(), process_hash)
 
         return process_dir, process_hash, input_parameters
@@ -461,47 +924,108 @@ class MemorizedProcess(object):
         Returns
         -------
         process_hash: string
-            the process md5 hash.
+            the process hash.
         input_parameters: dict
             the process input_parameters.
         """
-        # Store for input parameters
-        input_parameters = {}
+        # Get the parameters to hash
+        input_parameters = self._get_hashed_parameters()
 
-        # Go through all the user traits
-        for name, trait in six.iteritems(self.process.user_traits()):
+        # Add the tool versions to check roughly if the running codes have
+        # changed and add file path fingerprints
+        process_parameters = input_parameters.copy()
+        process_parameters = self._add_fingerprints(process_parameters)
+        process_parameters["versions"] = self._get_versions()
 
-            # Get the trait value
-            value = self.process.get_parameter(name)
+        # Generate the process hash
+        process_hash = hash_parameters(process_parameters)
 
-            # Split input and output traits
-            is_input = True
-            if "output" in trait.__dict__ and trait.output:
-                is_input = False
+        return process_hash, input_parameters
 
-            # Skip undefined trait attributes and outputs
-            if is_input and value is not Undefined:
+    def get_provenance_hash(self, upstream_parameters):
+        """ Get a provenance-chained hash of the process arguments.
 
-                # Check specific flags before hash
-                if has_attribute(trait, "nohash", attribute_value=True,
-                                 recursive=True):
-                    continue
+        Parameters whose value is produced by an upstream node are neither
+        fingerprinted nor read: they are represented by the upstream node
+        signature and plug instead, so the hash can be computed before the
+        upstream node has run. Other parameters are hashed as in the default
+        mode.
 
-                # Store the input parameter
-                input_parameters[name] = value
+        Parameters
+        ----------
+        upstream_parameters: dict
+            map each input parameter name produced by an upstream node to
+            an (upstream signature, upstream plug) tuple.
 
-        # Add the tool versions to check roughly if the running codes have
-        # changed and add file path fingerprints
-        process_parameters = input_parameters.copy()
-        process_parameters = self._add_fingerprints(process_parameters)
-        process_parameters["versions"] = self.process.versions
+        Returns
+        -------
+        process_hash: string
+            the process hash.
+        """
+        input_parameters = self._get_hashed_parameters()
+        process_parameters = {}
+        for name, value in six.iteritems(input_parameters):
+            if name not in upstream_parameters:
+                process_parameters[name] = self._add_fingerprints(value)
+        for name, provenance in six.iteritems(upstream_parameters):
+            process_parameters[name] = {"provenance": list(provenance)}
+        process_parameters["versions"] = self._get_versions()
 
         # Generate the process hash
-        hasher = hashlib.new("md5")
-        hasher.update(json.dumps(process_parameters, sort_keys=True).encode())
-        process_hash = hasher.hexdigest()
+        return hash_parameters(process_parameters)
 
-        return process_hash, input_parameters
+    def is_cached(self):
+        """ Check if the current process parameters have a complete cache
+        entry.
+
+        Returns
+        -------
+        cached: bool
+            True if the process results can be restored from the cache.
+        """
+        return self.get_cached_entry() is not None
+
+    def _get_hashed_parameters(self):
+        """ Get the process input parameters considered in hashes.
+
+        Some parameters are not considered during the hash computation:
+            * if the parameter value is not defined
+            * if the corresponding trait has an attribute 'nohash'
+
+        Which traits are hashed is computed once per process class (and
+        again for traits which are redefined).
+
+        Returns
+        -------
+        input_parameters: dict
+            the process input_parameters.
+        """
+        # Store for input parameters
+        input_parameters = {}
+        hashed_traits = _hashed_traits.setdefault(self.process_class, {})
+
+        # Go through all the user traits
+        for name, trait in six.iteritems(self.process.user_traits()):
+
+            # Select input traits without the 'nohash' flag
+            cached = hashed_traits.get(name)
+            if cached is not None and cached[0] is trait:
+                hashed = cached[1]
+            else:
+                hashed = (
+                    not ("output" in trait.__dict__ and trait.output) and
+                    not has_attribute(trait, "nohash", attribute_value=True,
+                                      recursive=True))
+                hashed_traits[name] = (trait, hashed)
+            if not hashed:
+                continue
+
+            # Store the defined input parameters
+            value = self.process.get_parameter(name)
+            if value is not Undefined:
+                input_parameters[name] = value
+
+        return input_parameters
 
     def _add_fingerprints(self, python_object):
         """ Add file path fingerprints.
@@ -516,6 +1040,10 @@ class MemorizedProcess(object):
         out: object
             the input object with fingerprint-file representation.
         """
+        # Deal with controllers (pipeline nodes activation for instance)
+        if isinstance(python_object, Controller):
+            python_object = python_object.export_to_dict()
+
         # Deal with dictionary
         out = {}
         if isinstance(python_object, dict):
@@ -535,13 +1063,62 @@ class MemorizedProcess(object):
         # Otherwise start the deletion if the object is a file
         else:
             out = python_object
-            if (python_object is not Undefined and
-                    isinstance(python_object, basestring) and
-                    os.path.isfile(python_object)):
-                out = file_fingerprint(python_object)
+            if isinstance(python_object, basestring):
+                fingerprint = self._get_fingerprint(python_object)
+                if fingerprint is not None:
+                    out = fingerprint
 
         return out
 
+    def _get_fingerprint(self, path):
+        """ Get the fingerprint of a file, reusing the fingerprints computed
+        in previous calls if a fingerprints cache is used.
+
+        Parameters
+        ----------
+        path: str
+            a parameter value which may be a file name.
+
+        Returns
+        -------
+        fingerprint: dict
+            the file fingerprint (see :py:func:`file_fingerprint`), None if
+            the path is not an existing file.
+        """
+        if self.fingerprints is not None:
+            try:
+                return self.fingerprints[path]
+            except KeyError:
+                pass
+        try:
+            path_stat = os.stat(path)
+        except (OSError, ValueError):
+            path_stat = None
+        if path_stat is None or not stat.S_ISREG(path_stat.st_mode):
+            fingerprint = None
+        else:
+            fingerprint = {
+                "name": path,
+                "mtime": str(path_stat.st_mtime),
+                "size": str(path_stat.st_size)
+            }
+        # Missing files are not recorded: they may be created later
+        if self.fingerprints is not None and fingerprint is not None:
+            self.fingerprints[path] = fingerprint
+        return fingerprint
+
+    def _forget_fingerprints(self, python_object):
+        """ Remove the files of a parameter value from the fingerprints
+        cache, when they are written.
+
+        Parameters
+        ----------
+        python_object: object
+            a generic python object.
+        """
+        if self.fingerprints is not None:
+            forget_fingerprints(self.fingerprints, python_object)
+
     def _get_process_dir(self):
         """ Get the directory corresponding to the cache for the current
         process.
@@ -557,8 +1134,7 @@ class MemorizedProcess(object):
         process_dir = os.path.join(*path)
 
         # Guarantee the path exists on the disk
-        if not os.path.exists(process_dir):
-            os.makedirs(process_dir)
+        makedirs(process_dir)
 
         return process_dir
 
@@ -611,6 +1187,85 @@ class MemorizedProcess(object):
             super(MemorizedProcess, self).__setattr__(name, value)
 
 
+def _execution_node_map(nodes):
+    """ Map the leaf nodes of executed nodes to the executed node containing
+    them (pipeline nodes executed as a whole contain their inner nodes).
+    """
+    node_map = {}
+    todo = [(node, node) for node in nodes]
+    while todo:
+        node, executed_node = todo.pop()
+        node_map[node] = executed_node
+        if hasattr(getattr(node, "process", None), "nodes"):
+            todo += [(sub_node, executed_node)
+                     for name, sub_node in six.iteritems(node.process.nodes)
+                     if name != ""]
+    return node_map
+
+
+def _new_hasher():
+    """ Create the hash object used for cache signatures: blake2b if it is
+    available (python >= 3.6), md5 otherwise.
+    """
+    if hasattr(hashlib, "blake2b"):
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.md5()
+
+
+def _update_hasher(hasher, python_object):
+    """ Feed the canonical representation of a parameter value to a hash
+    object, without building it in memory.
+
+    Dictionaries are walked in sorted keys order, strings are length
+    prefixed, and each value is tagged by its type so that distinct values
+    have distinct representations. Other objects are encoded in json.
+    """
+    if isinstance(python_object, dict):
+        hasher.update(b"{")
+        for key in sorted(python_object, key=six.text_type):
+            _update_hasher(hasher, six.text_type(key))
+            _update_hasher(hasher, python_object[key])
+        hasher.update(b"}")
+    elif isinstance(python_object, (list, tuple)):
+        hasher.update(b"[")
+        for value in python_object:
+            _update_hasher(hasher, value)
+        hasher.update(b"]")
+    elif isinstance(python_object, six.string_types):
+        data = python_object
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        hasher.update(("s{0}:".format(len(data))).encode())
+        hasher.update(data)
+    elif python_object is None or isinstance(python_object, bool):
+        hasher.update(("c{0};".format(python_object)).encode())
+    elif isinstance(python_object, six.integer_types + (float, )):
+        hasher.update(("n{0!r};".format(python_object)).encode())
+    else:
+        data = json.dumps(python_object, sort_keys=True,
+                          cls=CapsulResultEncoder)
+        hasher.update(("j{0}:".format(len(data))).encode())
+        hasher.update(data.encode("utf-8"))
+
+
+def hash_parameters(parameters):
+    """ Compute the cache signature of process parameters.
+
+    Parameters
+    ----------
+    parameters: dict
+        the parameters to hash, with files replaced by their fingerprints.
+
+    Returns
+    -------
+    signature: str
+        the hexadecimal digest of the canonical parameters representation.
+    """
+    hasher = _new_hasher()
+    _update_hasher(hasher, parameters)
+    return hasher.hexdigest()
+
+
 def get_process_signature(process, input_parameters):
     """ Generate the process signature.
 
@@ -631,6 +1286,25 @@ def get_process_signature(process, input_parameters):
     return "{0}({1})".format(process.id, ", ".join(kwargs))
 
 
+def forget_fingerprints(fingerprints, python_object):
+    """ Remove the files of a parameter value from a fingerprints cache.
+
+    Parameters
+    ----------
+    fingerprints: dict
+        the fingerprints cache, indexed by file name.
+    python_object: object
+        a generic python object.
+    """
+    if isinstance(python_object, dict):
+        python_object = list(python_object.values())
+    if isinstance(python_object, (list, tuple)):
+        for val in python_object:
+            forget_fingerprints(fingerprints, val)
+    elif isinstance(python_object, basestring):
+        fingerprints.pop(python_object, None)
+
+
 def has_attribute(trait, attribute_name, attribute_value=None,
                   recursive=True):
     """ Checks if a given trait has an attribute and optionally if it
@@ -700,42 +1374,1048 @@ def file_fingerprint(afile):
     return fingerprint
 
 
-class CapsulResultEncoder(json.JSONEncoder):
-    """ Deal with ProcessResult in json.
-    """
-    def default(self, obj):
-        try:
-            import numpy
-        except ImportError:
-            # numpy is not here
-            numpy = None
+class CachePolicy(object):
+    """ Smart-caching policy of a process.
 
-        # File special case
-        if isinstance(obj, ProcessResult):
-            result_dict = {}
-            for name in ["runtime", "returncode", "inputs",
-                         "outputs"]:
-                result_dict[name] = tuple_json_encoder(getattr(obj, name))
-            return result_dict
+    A process declares its policy in a cache_policy class (or instance)
+    attribute. Processes without policy use the default one (cached, no
+    expiration, invalidated by process.versions only).
 
-        # Undefined parameter special case
-        if isinstance(obj, Undefined.__class__):
-            return "<undefined_trait_value>"
+    ::
 
-        # InterfaceResult special case
-        if isinstance(obj, InterfaceResult):
-            return "<skip_nipype_interface_result>"
+        from capsul.api import Process
+        from capsul.study_config.memory import CachePolicy
 
-        # Array special case
-        if numpy is not None and isinstance(obj, numpy.ndarray):
-            return obj.tolist()
+        class Cheap(Process):
+            cache_policy = CachePolicy(enabled=False)
 
-        # Call the base class default method
-        return json.JSONEncoder.default(self, obj)
+        class Slow(Process):
+            cache_policy = CachePolicy(ttl=7 * 24 * 3600, source_hash=True)
 
+    Attributes
+    ----------
+    enabled: bool
+        if False the process is never cached (cheap or non-deterministic
+        processes for instance).
+    ttl: float
+        entries older than this number of seconds are computed again. None
+        means no expiration.
+    version: str
+        an explicit code version added to the signature: changing it
+        invalidates the entries of this process only.
+    source_hash: bool
+        if True, the hash of the process class module source file is added
+        to the signature, so that any change of the module invalidates its
+        entries.
+    """
+    def __init__(self, enabled=True, ttl=None, version=None,
+                 source_hash=False):
+        """ Initialize the CachePolicy class.
 
-def tuple_json_encoder(obj):
-    """ Encode a tuple in order to save it in json format.
+        Parameters
+        ----------
+        enabled: bool (optional, default True)
+            cache the process results.
+        ttl: float (optional)
+            entries lifetime in seconds.
+        version: str (optional)
+            the process code version.
+        source_hash: bool (optional, default False)
+            add the process source file hash to signatures.
+        """
+        self.enabled = enabled
+        self.ttl = ttl
+        self.version = version
+        self.source_hash = source_hash
+
+    def __repr__(self):
+        """ CachePolicy class representation.
+        """
+        return "{0}(enabled={1}, ttl={2}, version={3}, source_hash={4})" \
+            .format(self.__class__.__name__, self.enabled, self.ttl,
+                    repr(self.version), self.source_hash)
+
+
+_default_cache_policy = CachePolicy()
+
+
+def get_cache_policy(process):
+    """ Get the cache policy of a process.
+
+    Parameters
+    ----------
+    process: Process
+        a process (or pipeline) instance.
+
+    Returns
+    -------
+    policy: CachePolicy
+        the process cache_policy attribute, or the default policy.
+    """
+    policy = getattr(process, "cache_policy", None)
+    if policy is None:
+        return _default_cache_policy
+    return policy
+
+
+# Source files hashes, per process class
+_source_hashes = {}
+
+
+def get_source_hash(process_class):
+    """ Get the hash of the source file defining a process class.
+
+    The hash is computed once per class.
+
+    Parameters
+    ----------
+    process_class: class
+        the process class.
+
+    Returns
+    -------
+    source_hash: str
+        the source file hash, or None if the source is not available.
+    """
+    try:
+        return _source_hashes[process_class]
+    except KeyError:
+        pass
+    source_hash = None
+    try:
+        source_file = inspect.getsourcefile(process_class)
+    except TypeError:
+        source_file = None
+    if source_file is not None and os.path.isfile(source_file):
+        hasher = _new_hasher()
+        with open(source_file, "rb") as open_file:
+            for chunk in iter(lambda: open_file.read(65536), b""):
+                hasher.update(chunk)
+        source_hash = hasher.hexdigest()
+    _source_hashes[process_class] = source_hash
+    return source_hash
+
+
+class CacheStatistics(object):
+    """ Smart-cache counters, per process class.
+
+    For each process id, the following counters are maintained:
+
+    * hits: number of results restored from the cache,
+    * misses: number of results computed and stored,
+    * bytes_restored: size of the files restored in the workspace,
+    * bytes_stored: size of the files stored in the cache,
+    * hash_time: time spent computing signatures, in seconds,
+    * copy_time: time spent copying files (both ways), in seconds,
+    * load_time: time spent loading stored results, in seconds.
+
+    Counters are thread-safe.
+    """
+    counters = ("hits", "misses", "bytes_restored", "bytes_stored",
+                "hash_time", "copy_time", "load_time")
+
+    def __init__(self):
+        """ Initialize the CacheStatistics class.
+        """
+        self._lock = threading.Lock()
+        self._statistics = {}
+
+    def add(self, process_id, **values):
+        """ Increment counters of a process class.
+
+        Parameters
+        ----------
+        process_id: str
+            the process class id.
+        values: dict
+            counters increments.
+        """
+        with self._lock:
+            statistics = self._statistics.get(process_id)
+            if statistics is None:
+                statistics = dict((name, 0) for name in self.counters)
+                self._statistics[process_id] = statistics
+            for name, value in six.iteritems(values):
+                statistics[name] += value
+
+    def get(self, process_id=None):
+        """ Get the counters.
+
+        Parameters
+        ----------
+        process_id: str (optional)
+            the process class id. If not given, counters of all process
+            classes are returned.
+
+        Returns
+        -------
+        statistics: dict
+            a copy of the process counters, or of the counters of all
+            process classes indexed by process id.
+        """
+        with self._lock:
+            if process_id is not None:
+                return dict(self._statistics.get(
+                    process_id, dict((name, 0) for name in self.counters)))
+            return dict((pid, dict(statistics)) for pid, statistics
+                        in six.iteritems(self._statistics))
+
+    def reset(self):
+        """ Reset all counters.
+        """
+        with self._lock:
+            self._statistics = {}
+
+    def report(self):
+        """ Get a text report of the counters.
+
+        Returns
+        -------
+        report: str
+            one line per process class with its hit rate and counters.
+        """
+        lines = []
+        for process_id, statistics in sorted(six.iteritems(self.get())):
+            calls = statistics["hits"] + statistics["misses"]
+            hit_rate = 100. * statistics["hits"] / calls if calls else 0.
+            lines.append(
+                "{0}: {1} hits, {2} misses ({3:.0f}%), {4} bytes restored, "
+                "{5} bytes stored, hash {6:.2f}s, copy {7:.2f}s, "
+                "load {8:.2f}s".format(
+                    process_id, statistics["hits"], statistics["misses"],
+                    hit_rate, statistics["bytes_restored"],
+                    statistics["bytes_stored"], statistics["hash_time"],
+                    statistics["copy_time"], statistics["load_time"]))
+        return "\n".join(lines)
+
+
+class CacheCodec(object):
+    """ Compression codec of the files stored in the smart cache.
+
+    Codecs are registered by name with :py:func:`register_cache_codec`,
+    and selected per file extension using the Memory compression
+    parameter. Subclasses define the compressed files suffix and the
+    streaming compress_file and decompress_file methods.
+    """
+    name = None
+    suffix = ""
+
+    def compress_file(self, source, dest):
+        """ Compress the source file into dest.
+        """
+        raise NotImplementedError()
+
+    def decompress_file(self, source, dest):
+        """ Decompress the source file into dest.
+        """
+        raise NotImplementedError()
+
+
+class GzipCodec(CacheCodec):
+    """ gzip cache codec.
+    """
+    name = "gzip"
+    suffix = ".gz"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress_file(self, source, dest):
+        with open(source, "rb") as source_file:
+            with gzip.open(dest, "wb", self.level) as dest_file:
+                shutil.copyfileobj(source_file, dest_file)
+
+    def decompress_file(self, source, dest):
+        with gzip.open(source, "rb") as source_file:
+            with open(dest, "wb") as dest_file:
+                shutil.copyfileobj(source_file, dest_file)
+
+
+class ZstdCodec(CacheCodec):
+    """ zstd cache codec, using the zstandard module.
+    """
+    name = "zstd"
+    suffix = ".zst"
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise ValueError("The zstandard module is required to use the "
+                             "zstd smart-caching codec.")
+        self.level = level
+
+    def compress_file(self, source, dest):
+        compressor = zstandard.ZstdCompressor(level=self.level)
+        with open(source, "rb") as source_file:
+            with open(dest, "wb") as dest_file:
+                compressor.copy_stream(source_file, dest_file)
+
+    def decompress_file(self, source, dest):
+        decompressor = zstandard.ZstdDecompressor()
+        with open(source, "rb") as source_file:
+            with open(dest, "wb") as dest_file:
+                decompressor.copy_stream(source_file, dest_file)
+
+
+_cache_codecs = {
+    "gzip": GzipCodec,
+    "zstd": ZstdCodec,
+}
+
+
+def register_cache_codec(name, codec_class):
+    """ Register a smart-cache compression codec.
+
+    Parameters
+    ----------
+    name: str
+        the codec name, used in Memory compression parameters.
+    codec_class: CacheCodec subclass
+        the codec class, instantiated without parameters.
+    """
+    _cache_codecs[name] = codec_class
+
+
+def get_cache_codec(name):
+    """ Get a smart-cache compression codec.
+
+    Parameters
+    ----------
+    name: str
+        the registered codec name ('gzip' and 'zstd' are built-in).
+
+    Returns
+    -------
+    codec: CacheCodec
+        the codec instance.
+    """
+    codec_class = _cache_codecs.get(name)
+    if codec_class is None:
+        raise ValueError("Unknown smart-caching codec '{0}', available "
+                         "codecs are: {1}".format(
+                             name, ", ".join(sorted(_cache_codecs))))
+    codec = codec_class()
+    codec.name = name
+    return codec
+
+
+def restore_cache_file(memory_file, workspace_file, codec_name=None):
+    """ Restore a file stored in the cache into the workspace.
+
+    The file modification time is preserved.
+
+    Parameters
+    ----------
+    memory_file: str
+        the stored file.
+    workspace_file: str
+        the restored file.
+    codec_name: str (optional)
+        the codec used to compress the stored file, if any.
+    """
+    if codec_name:
+        get_cache_codec(codec_name).decompress_file(memory_file,
+                                                    workspace_file)
+        shutil.copystat(memory_file, workspace_file)
+    else:
+        shutil.copy2(memory_file, workspace_file)
+
+
+def makedirs(path):
+    """ Create a directory and its parents if they do not exist.
+
+    The directory may be created concurrently by another worker.
+
+    Parameters
+    ----------
+    path: string
+        the directory to create.
+    """
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def copy_cache_entry(source_dir, dest_dir):
+    """ Copy a complete cache entry to another cache directory.
+
+    The copy is written in a temporary directory renamed once complete. If
+    the destination entry is created concurrently, the copy is dropped.
+
+    Parameters
+    ----------
+    source_dir: string
+        the complete cache entry directory.
+    dest_dir: string
+        the destination entry directory.
+    """
+    makedirs(os.path.dirname(dest_dir))
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(dest_dir) + ".tmp",
+                               dir=os.path.dirname(dest_dir))
+    try:
+        for fname in os.listdir(source_dir):
+            shutil.copy2(os.path.join(source_dir, fname),
+                         os.path.join(tmp_dir, fname))
+        os.rename(tmp_dir, dest_dir)
+    except (IOError, OSError):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not is_complete_cache_entry(dest_dir):
+            raise
+
+
+def iter_cache_entries(cachedir):
+    """ Find the complete entries of a cache directory, skipping temporary
+    directories.
+
+    Parameters
+    ----------
+    cachedir: string
+        the cache directory, or a sub-directory of it.
+
+    Returns
+    -------
+    entries: iterator
+        (entry directory, entry file names) tuples.
+    """
+    for root, dirs, files in os.walk(cachedir):
+        dirs[:] = [dname for dname in dirs if ".tmp" not in dname]
+        if "result.json" in files and "file_mapping.json" in files:
+            dirs[:] = []
+            yield root, files
+
+
+def map_cache_paths(python_object, path_map):
+    """ Rewrite the paths of a parameter value through a prefix map.
+
+    Parameters
+    ----------
+    python_object: object
+        a generic python object, as loaded from json.
+    path_map: dict
+        map path prefixes to their replacement. The longest matching
+        prefix is used, and prefixes only match whole path components.
+
+    Returns
+    -------
+    out: object
+        the object with rewritten paths.
+    """
+    if isinstance(python_object, dict):
+        return dict((key, map_cache_paths(val, path_map))
+                    for key, val in six.iteritems(python_object))
+    elif isinstance(python_object, list):
+        return [map_cache_paths(val, path_map) for val in python_object]
+    elif isinstance(python_object, basestring):
+        for prefix in sorted(path_map, key=len, reverse=True):
+            stripped = prefix.rstrip("/" + os.sep) or prefix
+            if python_object == stripped:
+                return path_map[prefix].rstrip("/" + os.sep) \
+                    or path_map[prefix]
+            if python_object.startswith(stripped) \
+                    and python_object[len(stripped)] in ("/", os.sep):
+                return path_map[prefix].rstrip("/" + os.sep) \
+                    + python_object[len(stripped):]
+    return python_object
+
+
+def _map_cache_entry_file(fname, data, path_map):
+    """ Rewrite the workspace paths of a cache entry index file
+    ('result.json' or 'file_mapping.json').
+
+    Parameters
+    ----------
+    fname: string
+        the index file name.
+    data: bytes
+        the index file content.
+    path_map: dict
+        see :py:func:`map_cache_paths`.
+
+    Returns
+    -------
+    data: bytes
+        the rewritten file content.
+    """
+    content = json.loads(data.decode("utf-8"))
+    if fname == "file_mapping.json":
+        # Entries are moved: stored files are named relative to the entry
+        # directory (older entries store absolute names)
+        file_mapping = []
+        for mapping in content:
+            if isinstance(mapping, list):
+                mapping = {"workspace": mapping[0], "memory": mapping[1]}
+            mapping["memory"] = os.path.basename(mapping["memory"])
+            mapping["workspace"] = map_cache_paths(mapping["workspace"],
+                                                   path_map)
+            file_mapping.append(mapping)
+        return json.dumps(file_mapping).encode("utf-8")
+    content["parameters"] = map_cache_paths(content["parameters"], path_map)
+    content["result"] = map_cache_paths(content["result"], path_map)
+    return json.dumps(content, sort_keys=True, indent=4).encode("utf-8")
+
+
+def _open_cache_archive(archive, mode):
+    """ Open a cache archive in stream mode.
+
+    Parameters
+    ----------
+    archive: string or file object
+        the archive file name, or a file object.
+    mode: str
+        the tarfile stream mode ('r|*' or 'w|<compression>').
+
+    Returns
+    -------
+    tar: TarFile
+        the opened archive.
+    """
+    if isinstance(archive, basestring):
+        return tarfile.open(archive, mode)
+    return tarfile.open(fileobj=archive, mode=mode)
+
+
+def evict_cache_entries(cachedir, size_limit, keep=()):
+    """ Remove the least recently used entries of a cache directory until
+    its size is under a limit.
+
+    Parameters
+    ----------
+    cachedir: string
+        the cache directory.
+    size_limit: int
+        the cache size limit in bytes.
+    keep: list of string (optional)
+        entries directories which must not be removed.
+    """
+    # Find the complete entries
+    entries = []
+    total_size = 0
+    for root, files in iter_cache_entries(cachedir):
+        try:
+            size = sum(os.path.getsize(os.path.join(root, fname))
+                       for fname in files)
+            entries.append((os.stat(root).st_mtime, size, root))
+        except OSError:
+            # removed concurrently
+            continue
+        total_size += size
+    if total_size <= size_limit:
+        return
+
+    # Remove the oldest entries, skipping those locked by another worker
+    keep = set(keep)
+    for mtime, size, entry_dir in sorted(entries):
+        if total_size <= size_limit:
+            break
+        if entry_dir in keep:
+            continue
+        if remove_cache_entry(entry_dir, blocking=False):
+            total_size -= size
+
+
+def remove_cache_entry(entry_dir, blocking=True):
+    """ Remove a cache entry and its lock file.
+
+    The entry is renamed before being removed so that no partial entry is
+    visible, and the lock file is removed while holding the lock.
+
+    Parameters
+    ----------
+    entry_dir: string
+        the cache entry directory.
+    blocking: bool (optional, default True)
+        if False, the entry is not removed if it is locked by another worker.
+
+    Returns
+    -------
+    removed: bool
+        True if the entry has been removed by this call.
+    """
+    lock = CacheEntryLock(entry_dir)
+    if not lock.acquire(blocking=blocking):
+        return False
+    try:
+        removed = _discard_cache_entry(entry_dir)
+        lock.remove()
+    finally:
+        lock.release()
+    return removed
+
+
+def _discard_cache_entry(entry_dir):
+    """ Remove a cache entry directory, the entry lock being held.
+
+    The entry is renamed before being removed, so that lock-free readers
+    which are copying files from it never see a partial entry.
+
+    Parameters
+    ----------
+    entry_dir: string
+        the cache entry directory.
+
+    Returns
+    -------
+    removed: bool
+        True if the entry has been removed by this call.
+    """
+    if not os.path.isdir(entry_dir):
+        return False
+    removed = False
+    removed_dir = tempfile.mkdtemp(
+        prefix=os.path.basename(entry_dir) + ".tmp",
+        dir=os.path.dirname(entry_dir))
+    try:
+        os.rename(entry_dir, os.path.join(removed_dir, "entry"))
+        removed = True
+    except OSError:
+        # removed concurrently
+        pass
+    shutil.rmtree(removed_dir, ignore_errors=True)
+    return removed
+
+
+def get_cache_entry_duration(process_dir):
+    """ Get the execution duration stored in a cache entry.
+
+    Parameters
+    ----------
+    process_dir: string
+        the cache entry directory.
+
+    Returns
+    -------
+    duration: float
+        the process execution duration in seconds, None if it has not been
+        recorded.
+    """
+    result_fname = os.path.join(process_dir, "result.json")
+    with open(result_fname, "r") as json_data:
+        return json.load(json_data).get("duration")
+
+
+def is_complete_cache_entry(process_dir):
+    """ Check if a cache entry has been completely written.
+
+    Parameters
+    ----------
+    process_dir: string
+        the cache entry directory.
+
+    Returns
+    -------
+    complete: bool
+        True if the entry contains both its result and its file mapping.
+    """
+    return (os.path.isfile(os.path.join(process_dir, "result.json")) and
+            os.path.isfile(os.path.join(process_dir, "file_mapping.json")))
+
+
+class CacheEntryLock(object):
+    """ Inter-process lock on a cache entry.
+
+    The lock is taken on a '<process_dir>.lock' file using fcntl, so that it
+    is released by the system if the holder crashes. When fcntl is not
+    available, a '<process_dir>.lockdir' directory is atomically created
+    instead, holding an 'owner' file with the host name and process id of
+    the holder, and removed on release. A lock directory left by a crashed
+    holder is removed by the next worker which needs the lock when:
+
+    * its holder process runs on the same host and does not exist anymore
+      (this is only checked on POSIX systems),
+    * it is older than the lock stale_timeout, if given: it should be
+      longer than the longest process execution,
+    * it has no 'owner' file after :py:attr:`owner_delay` seconds (the
+      holder crashed just after creating it).
+
+    Otherwise, the workers wait for the lock directory to be removed by
+    hand.
+
+    When an entry is removed, its lock file is removed with it by calling
+    :py:meth:`remove` while holding the lock. A worker waiting on the removed
+    file notices it once it gets the lock, and locks the new file instead.
+
+    The lock is used as a context manager:
+
+    ::
+
+        with CacheEntryLock(process_dir):
+            ...
+    """
+    # Delay, in seconds, after which a lock directory without owner file is
+    # stale
+    owner_delay = 60.
+
+    def __init__(self, process_dir, poll_interval=0.1, stale_timeout=None):
+        """ Initialize the CacheEntryLock class.
+
+        Parameters
+        ----------
+        process_dir: string
+            the cache entry directory to protect.
+        poll_interval: float (optional, default 0.1)
+            waiting time, in seconds, between two attempts when fcntl is not
+            available.
+        stale_timeout: float (optional)
+            age, in seconds, after which a lock directory is stale whatever
+            its holder, when fcntl is not available. By default lock
+            directories of running or remote holders never expire.
+        """
+        self.process_dir = process_dir
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self._lock_file = None
+        self._owner = None
+
+    def acquire(self, blocking=True):
+        """ Acquire the lock.
+
+        Parameters
+        ----------
+        blocking: bool (optional, default True)
+            if False, do not wait if the lock is held by another worker.
+
+        Returns
+        -------
+        acquired: bool
+            True if the lock has been acquired.
+        """
+        if fcntl is not None:
+            lock_fname = self.process_dir + ".lock"
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            while True:
+                lock_file = open(lock_fname, "a")
+                try:
+                    fcntl.flock(lock_file.fileno(), flags)
+                except (IOError, OSError):
+                    lock_file.close()
+                    if blocking:
+                        raise
+                    return False
+
+                # The lock file may have been removed with its entry while
+                # waiting: the lock is only valid on the current file
+                try:
+                    current = os.stat(lock_fname)
+                except OSError:
+                    current = None
+                if current is not None and os.path.samestat(
+                        current, os.fstat(lock_file.fileno())):
+                    self._lock_file = lock_file
+                    return True
+                lock_file.close()
+        else:
+            lock_dir = self.process_dir + ".lockdir"
+            owner = "{0} {1} {2}".format(socket.gethostname(), os.getpid(),
+                                         uuid.uuid4().hex)
+            while True:
+                try:
+                    os.mkdir(lock_dir)
+                except OSError:
+                    if self._remove_stale_lock(lock_dir):
+                        continue
+                    if not blocking:
+                        return False
+                    time.sleep(self.poll_interval)
+                    continue
+                with open(os.path.join(lock_dir, "owner"), "w") as f:
+                    f.write(owner)
+                self._owner = owner
+                return True
+
+    def _remove_stale_lock(self, lock_dir):
+        """ Remove a lock directory left by a crashed holder.
+
+        Parameters
+        ----------
+        lock_dir: string
+            the lock directory.
+
+        Returns
+        -------
+        removed: bool
+            True if the lock directory does not exist anymore.
+        """
+        try:
+            age = time.time() - os.stat(lock_dir).st_mtime
+        except OSError:
+            # released in the meantime
+            return True
+        owner = _read_lock_owner(lock_dir)
+        if owner is None:
+            stale = age > self.owner_delay
+        else:
+            stale = (self.stale_timeout is not None
+                     and age > self.stale_timeout)
+            host, pid = owner.split()[:2]
+            if not stale and host == socket.gethostname():
+                stale = _is_process_alive(int(pid)) is False
+        if not stale:
+            return False
+
+        # Rename the lock directory before removing it, so that only one
+        # worker removes it
+        logger.warning("Removing stale cache lock '{0}' ({1}).".format(
+            lock_dir, owner))
+        removed_dir = tempfile.mkdtemp(
+            prefix=os.path.basename(lock_dir) + ".tmp",
+            dir=os.path.dirname(lock_dir))
+        stale_dir = os.path.join(removed_dir, "lock")
+        try:
+            os.rename(lock_dir, stale_dir)
+        except OSError:
+            # removed concurrently
+            stale_dir = None
+        if stale_dir is not None and _read_lock_owner(stale_dir) != owner:
+            # the lock has been taken again by another worker meanwhile:
+            # give it back
+            try:
+                os.rename(stale_dir, lock_dir)
+                stale_dir = None
+            except OSError:
+                logger.warning("Cache lock '{0}' has been broken.".format(
+                    lock_dir))
+        shutil.rmtree(removed_dir, ignore_errors=True)
+        return True
+
+    def release(self):
+        """ Release the lock.
+        """
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        else:
+            lock_dir = self.process_dir + ".lockdir"
+            if _read_lock_owner(lock_dir) == self._owner:
+                os.unlink(os.path.join(lock_dir, "owner"))
+                os.rmdir(lock_dir)
+            else:
+                logger.warning("Cache lock '{0}' has been broken.".format(
+                    lock_dir))
+            self._owner = None
+
+    def remove(self):
+        """ Remove the lock file, once the entry has been removed. The lock
+        must be held, and is still released by :py:meth:`release`.
+        """
+        if fcntl is not None:
+            try:
+                os.unlink(self.process_dir + ".lock")
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def _read_lock_owner(lock_dir):
+    """ Read the owner of a cache lock directory.
+
+    Parameters
+    ----------
+    lock_dir: string
+        the lock directory.
+
+    Returns
+    -------
+    owner: string
+        the '<host> <pid> <id>' owner of the lock, None if it is not known.
+    """
+    try:
+        with open(os.path.join(lock_dir, "owner")) as f:
+            owner = f.read()
+    except (IOError, OSError):
+        return None
+    if len(owner.split()) != 3:
+        # partially written
+        return None
+    return owner
+
+
+def _is_process_alive(pid):
+    """ Check if a process of the current host is running.
+
+    Parameters
+    ----------
+    pid: int
+        the process id.
+
+    Returns
+    -------
+    alive: bool
+        True if the process is running, None if it cannot be known.
+    """
+    if os.name != "posix":
+        # os.kill() would terminate the process on Windows
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class CachePlan(object):
+    """ Smart-caching plan of a pipeline execution.
+
+    Each node gets a status:
+
+    * 'run': the node is not cached and has to be computed,
+    * 'restore': the node is cached and its outputs have to be restored,
+      because they are exported by the pipeline or used by nodes to compute,
+    * 'skip': the node is cached and its outputs are not needed,
+    * 'unknown': the node is not cached according to its cache policy, or
+      uses results of such nodes: it is run, and its signature (if any) is
+      computed from its input files at run time.
+
+    Attributes
+    ----------
+    nodes: list of Node
+        the planned nodes, in execution order.
+    signatures: dict
+        the nodes provenance signatures.
+    status: dict
+        the nodes status.
+    durations: dict
+        the stored execution duration of cached nodes (None if unknown).
+    """
+    def __init__(self, nodes, signatures, status, durations):
+        """ Initialize the CachePlan class.
+
+        Parameters
+        ----------
+        nodes: list of Node
+            the planned nodes, in execution order.
+        signatures: dict
+            the nodes provenance signatures.
+        status: dict
+            the nodes status.
+        durations: dict
+            the stored execution duration of cached nodes.
+        """
+        self.nodes = nodes
+        self.signatures = signatures
+        self.status = status
+        self.durations = durations
+
+    @property
+    def execution_list(self):
+        """ The nodes to run or restore, in execution order.
+        """
+        return [node for node in self.nodes if self.status[node] != "skip"]
+
+    def nodes_with_status(self, status):
+        """ Get the nodes with the given status, in execution order.
+        """
+        return [node for node in self.nodes if self.status[node] == status]
+
+    def estimated_time_saved(self):
+        """ Sum the stored durations of cached nodes.
+
+        Returns
+        -------
+        saved: float
+            the estimated saved time in seconds.
+        unknown: int
+            the number of cached nodes without recorded duration.
+        """
+        saved = 0.
+        unknown = 0
+        for node in self.nodes:
+            if self.status[node] in ("restore", "skip"):
+                duration = self.durations.get(node)
+                if duration is None:
+                    unknown += 1
+                else:
+                    saved += duration
+        return saved, unknown
+
+    def report(self):
+        """ Get a text report of the plan.
+
+        Returns
+        -------
+        report: string
+            one line per node with its status, name, process and stored
+            duration, followed by a summary.
+        """
+        lines = []
+        for node in self.nodes:
+            duration = self.durations.get(node)
+            if duration is None:
+                duration = "-"
+            else:
+                duration = "{0:.1f}s".format(duration)
+            lines.append("{0:<8} {1:<30} {2} {3}".format(
+                self.status[node], node.name, node.process.id, duration))
+        saved, unknown = self.estimated_time_saved()
+        lines.append(
+            "{0} nodes: {1} to run, {2} to restore, {3} to skip, {4} "
+            "unknown".format(
+                len(self.nodes), len(self.nodes_with_status("run")),
+                len(self.nodes_with_status("restore")),
+                len(self.nodes_with_status("skip")),
+                len(self.nodes_with_status("unknown"))))
+        msg = "Estimated time saved: {0:.1f}s, {1:.1f}min".format(
+            saved, saved / 60.)
+        if unknown:
+            msg += " ({0} cached nodes without recorded duration)".format(
+                unknown)
+        lines.append(msg)
+        return "\n".join(lines)
+
+    def __repr__(self):
+        """ CachePlan class representation.
+        """
+        return "{0}({1} nodes, {2} to run)".format(
+            self.__class__.__name__, len(self.nodes),
+            len(self.nodes_with_status("run")))
+
+
+class CapsulResultEncoder(json.JSONEncoder):
+    """ Deal with ProcessResult in json.
+    """
+    def default(self, obj):
+        try:
+            import numpy
+        except ImportError:
+            # numpy is not here
+            numpy = None
+
+        # File special case
+        if isinstance(obj, ProcessResult):
+            result_dict = {}
+            for name in ["runtime", "returncode", "inputs",
+                         "outputs"]:
+                result_dict[name] = tuple_json_encoder(getattr(obj, name))
+            return result_dict
+
+        # Undefined parameter special case
+        if isinstance(obj, Undefined.__class__):
+            return "<undefined_trait_value>"
+
+        # InterfaceResult special case
+        if isinstance(obj, InterfaceResult):
+            return "<skip_nipype_interface_result>"
+
+        # Array special case
+        if numpy is not None and isinstance(obj, numpy.ndarray):
+            return obj.tolist()
+
+        # Call the base class default method
+        return json.JSONEncoder.default(self, obj)
+
+
+def tuple_json_encoder(obj):
+    """ Encode a tuple in order to save it in json format.
 
     Parameters
     ----------
@@ -797,35 +2477,77 @@ class Memory(object):
     ----------
     `cachedir`: string
         the location for the caching. If None is given, no caching is done.
+    `statistics`: CacheStatistics
+        the cache hits, misses, transfers and timings of the processes
+        cached through this object.
 
     Methods
     -------
     cache
     clear
+    export
+    import_
+    get_statistics
     """
 
-    def __init__(self, cachedir):
+    def __init__(self, cachedir, local_cachedir=None, local_size_limit=None,
+                 compression=None, reuse_fingerprints=False):
         """ Initialize the Memory class.
 
         Parameters
         ----------
         base_dir: string
             the directory name of the location for the caching.
+        local_cachedir: string (optional)
+            the directory name of a local (fast) cache tier over the
+            cachedir one, on a node-local disk for instance.
+        local_size_limit: int (optional)
+            the local cache tier size limit in bytes. If None, local entries
+            are never evicted.
+        compression: dict (optional)
+            map file extensions (for instance '.nii') to the name of the
+            codec ('gzip', 'zstd' or a registered codec) used to compress
+            stored files. Files with other extensions are stored as is.
+        reuse_fingerprints: bool (optional)
+            if True, input files are fingerprinted once during the Memory
+            lifetime (typically a run), unless they are outputs of a process
+            executed through the memory (see
+            :py:meth:`forget_fingerprints`). Files must then not be
+            modified by other means.
         """
-        # Build the capsul memory folder
+        # Build the capsul memory folders
         if cachedir is not None:
-            cachedir = os.path.join(
-                os.path.abspath(cachedir), "capsul_memory")
-            if not os.path.exists(cachedir):
-                os.makedirs(cachedir)
-            elif not os.path.isdir(cachedir):
-                raise ValueError("'base_dir' should be a directory")
+            cachedir = self._get_memory_dir(cachedir)
+        if cachedir is not None and local_cachedir is not None:
+            local_cachedir = self._get_memory_dir(local_cachedir)
+        else:
+            local_cachedir = None
 
         # Define class parameters
         self.cachedir = cachedir
+        self.local_cachedir = local_cachedir
+        self.local_size_limit = local_size_limit
+        self.compression = compression or {}
+        self.statistics = CacheStatistics()
+        self.fingerprints = {} if reuse_fingerprints else None
+        self.pending_restorations = {}
         self.timestamp = time.time()
 
-    def cache(self, process, verbose=1):
+        # Check the codecs early
+        for codec_name in self.compression.values():
+            get_cache_codec(codec_name)
+
+    def _get_memory_dir(self, cachedir):
+        """ Create the capsul memory folder in a cache directory.
+        """
+        cachedir = os.path.join(os.path.abspath(cachedir), "capsul_memory")
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        elif not os.path.isdir(cachedir):
+            raise ValueError("'base_dir' should be a directory")
+        return cachedir
+
+    def cache(self, process, verbose=1, signature=None):
         """ Create a proxy of the given process in order to only execute
         the process for input parameters not cached on disk.
 
@@ -835,6 +2557,9 @@ class Memory(object):
             the capsul Process to be wrapped and cached.
         verbose: int
             if different from zero, print console messages.
+        signature: string (optional)
+            the cache key to use instead of the hash of the process
+            arguments, as returned by :py:meth:`provenance_signatures`.
 
         Returns
         -------
@@ -873,13 +2598,427 @@ class Memory(object):
                 isinstance(process, UnMemorizedProcess)):
             process = process.process
 
-        # If the cachedir is None no caching is done
-        if self.cachedir is None:
+        # If the cachedir is None, or if the process cache policy disables
+        # caching, no caching is done
+        if self.cachedir is None or not get_cache_policy(process).enabled:
             return UnMemorizedProcess(process, verbose)
         # Otherwise a proxy process is created
         else:
             return MemorizedProcess(process, self.cachedir, self.timestamp,
-                                    verbose)
+                                    verbose, signature=signature,
+                                    local_cachedir=self.local_cachedir,
+                                    local_size_limit=self.local_size_limit,
+                                    compression=self.compression,
+                                    statistics=self.statistics,
+                                    fingerprints=self.fingerprints,
+                                    pending_restorations=(
+                                        self.pending_restorations))
+
+    def forget_fingerprints(self, process):
+        """ Forget the fingerprints of the output files of an executed
+        process, cached or not: these files may have been rewritten.
+
+        Parameters
+        ----------
+        process: Process
+            the executed process.
+        """
+        if self.fingerprints is None:
+            return
+        for name, trait in six.iteritems(process.user_traits()):
+            if trait.output:
+                forget_fingerprints(self.fingerprints,
+                                    process.get_parameter(name))
+
+    def provenance_signatures(self, nodes):
+        """ Compute provenance-chained (Merkle) signatures of pipeline nodes.
+
+        The signature of a node is derived from the signatures of the nodes
+        producing its inputs, plus its own parameters: only files which are
+        not produced by one of the given nodes are fingerprinted. All the
+        signatures are thus known before any node is executed.
+
+        Parameters
+        ----------
+        nodes: list of Node
+            the nodes to execute, in execution order, as returned by
+            :py:meth:`Pipeline.workflow_ordered_nodes`.
+
+        Returns
+        -------
+        signatures: dict
+            map each node to its signature. Nodes which are not cached
+            (according to their cache policy), and the nodes using their
+            results, have a None signature.
+        """
+        from capsul.pipeline.pipeline_tools import where_is_plug_value_from
+
+        node_map = _execution_node_map(nodes)
+        signatures = {}
+        for node in nodes:
+            # Nodes which are not cached have no signature
+            if not get_cache_policy(node.process).enabled:
+                signatures[node] = None
+                continue
+            upstream_parameters = {}
+            for plug_name, plug in six.iteritems(node.plugs):
+                if plug.output:
+                    continue
+                source, source_plug, parent \
+                    = where_is_plug_value_from(plug)
+                source = node_map.get(source)
+                if source is not None and source is not node \
+                        and source in signatures:
+                    upstream_parameters[plug_name] = (
+                        signatures[source], source_plug)
+            if None in [provenance[0] for provenance
+                        in upstream_parameters.values()]:
+                # Results of uncached nodes are only known once they have
+                # run: the signature is computed from files at run time
+                signatures[node] = None
+                continue
+            proxy_process = MemorizedProcess(node.process, self.cachedir,
+                                             self.timestamp, verbose=0,
+                                             fingerprints=self.fingerprints)
+            signatures[node] = proxy_process.get_provenance_hash(
+                upstream_parameters)
+        return signatures
+
+    def plan(self, pipeline, nodes):
+        """ Compute the smart-caching plan of pipeline nodes before their
+        execution.
+
+        Parameters
+        ----------
+        pipeline: Pipeline
+            the executed pipeline.
+        nodes: list of Node
+            the nodes to execute, in execution order, as returned by
+            :py:meth:`Pipeline.workflow_ordered_nodes`.
+
+        Returns
+        -------
+        plan: CachePlan
+            the nodes provenance signatures and cache status.
+        """
+        signatures = self.provenance_signatures(nodes)
+        status = {}
+        durations = {}
+        for node in nodes:
+            if signatures[node] is None:
+                status[node] = "unknown"
+                continue
+            proxy_process = self.cache(node.process, verbose=0,
+                                       signature=signatures[node])
+            process_dir = proxy_process.get_cached_entry()
+            if process_dir is not None:
+                status[node] = "restore"
+                durations[node] = get_cache_entry_duration(process_dir)
+            else:
+                status[node] = "run"
+        missing = [node for node in nodes
+                   if status[node] in ("run", "unknown")]
+        needed = self.needed_nodes(pipeline, nodes, missing)
+        for node in nodes:
+            if node not in needed:
+                status[node] = "skip"
+        return CachePlan(nodes, signatures, status, durations)
+
+    def needed_nodes(self, pipeline, nodes, missing):
+        """ Select the nodes which have to be run in provenance mode.
+
+        Nodes which are not cached have to be computed. Cached nodes only
+        have to be restored if one of their outputs is used by a node to
+        compute, or is exported by the pipeline. Other cached nodes are
+        skipped.
+
+        Parameters
+        ----------
+        pipeline: Pipeline
+            the executed pipeline.
+        nodes: list of Node
+            the nodes to execute, in execution order.
+        missing: list of Node
+            the nodes which are not cached, or whose cache status is only
+            known at run time.
+
+        Returns
+        -------
+        needed: list of Node
+            the nodes to run (compute or restore), in execution order.
+        """
+        from capsul.pipeline.pipeline_tools import where_is_plug_value_from
+
+        node_map = _execution_node_map(nodes)
+
+        # Inputs of the nodes to compute have to be restored
+        needed = set(missing)
+        for node in missing:
+            for plug in node.plugs.values():
+                if not plug.output:
+                    source = node_map.get(where_is_plug_value_from(plug)[0])
+                    if source is not None:
+                        needed.add(source)
+
+        # Exported outputs have to be restored
+        for plug in pipeline.pipeline_node.plugs.values():
+            if plug.output:
+                source = node_map.get(where_is_plug_value_from(plug)[0])
+                if source is not None:
+                    needed.add(source)
+
+        return [node for node in nodes if node in needed]
+
+    def needed_outputs(self, pipeline, nodes, plan=None):
+        """ Select the outputs of pipeline nodes which have to be restored on
+        cache hits.
+
+        Outputs are needed when they are used by active nodes which are run
+        (all the nodes, or the nodes to compute according to the plan), or
+        exported by the pipeline.
+
+        Parameters
+        ----------
+        pipeline: Pipeline
+            the executed pipeline.
+        nodes: list of Node
+            the nodes to execute, in execution order.
+        plan: CachePlan (optional)
+            the execution plan, if any.
+
+        Returns
+        -------
+        restore_outputs: dict
+            map each node to the set of its output parameters names to
+            restore, or to None if all outputs have to be restored
+            (pipelines cached as a whole).
+        """
+        from capsul.pipeline.pipeline_tools import where_is_plug_value_from
+
+        node_map = _execution_node_map(nodes)
+        restore_outputs = dict((node, set()) for node in nodes)
+        for node in nodes:
+            if hasattr(node.process, "nodes"):
+                restore_outputs[node] = None
+
+        def add_source(plug):
+            source, source_plug, parent = where_is_plug_value_from(plug)
+            node = node_map.get(source)
+            if node is not None and restore_outputs[node] is not None:
+                restore_outputs[node].add(source_plug)
+
+        for node in nodes:
+            if plan is not None and plan.status[node] in ("restore", "skip"):
+                continue
+            for plug in node.plugs.values():
+                if not plug.output:
+                    add_source(plug)
+        for plug in pipeline.pipeline_node.plugs.values():
+            if plug.output:
+                add_source(plug)
+        return restore_outputs
+
+    def restore(self, files=None):
+        """ Restore output files which have been left in the cache on
+        cache hits.
+
+        Parameters
+        ----------
+        files: list of str (optional)
+            the workspace files to restore. If not given, all pending files
+            are restored. Files which are not pending are ignored.
+
+        Returns
+        -------
+        restored: list of str
+            the restored files.
+        """
+        if files is None:
+            files = list(self.pending_restorations)
+        restored = []
+        for workspace_file in files:
+            pending = self.pending_restorations.pop(workspace_file, None)
+            if pending is None:
+                continue
+            candidates, codec_name = pending
+            for memory_file in candidates:
+                try:
+                    restore_cache_file(memory_file, workspace_file,
+                                       codec_name)
+                    break
+                except (IOError, OSError):
+                    # evicted from the local tier
+                    if memory_file == candidates[-1]:
+                        raise
+            if self.fingerprints is not None:
+                self.fingerprints.pop(workspace_file, None)
+            restored.append(workspace_file)
+        return restored
+
+    def export(self, selection, archive, compression=None, path_map=None):
+        """ Export cache entries to a tar archive, to seed the cache of
+        another site.
+
+        The archive is written in stream mode, so it can be sent through a
+        pipe or a socket. Entries keep their keys: they are used at the
+        destination by processes with the same signature, which means
+        the same parameters and input files fingerprints (or signatures
+        given explicitly, as in provenance mode).
+
+        Parameters
+        ----------
+        selection: list of str
+            the entries to export: process ids (all their entries are
+            exported) or cache entry directories. If None, the whole cache
+            is exported.
+        archive: str or file object
+            the archive file name, or a writable file object.
+        compression: str (optional)
+            the archive compression: 'gz', 'bz2' or 'xz' (python 3).
+        path_map: dict (optional)
+            map workspace path prefixes to their location on the
+            destination site (see :py:func:`map_cache_paths`).
+
+        Returns
+        -------
+        exported: list of str
+            the exported entry directories.
+        """
+        # Find the selected entries
+        if selection is None:
+            selection = [self.cachedir]
+        entries = []
+        for item in selection:
+            item_dir = item
+            if not os.path.isabs(item):
+                item_dir = os.path.join(self.cachedir, *item.split("."))
+            entries.extend(iter_cache_entries(item_dir))
+
+        # Write them, index files first so that a truncated archive only
+        # contains incomplete entries
+        exported = []
+        mode = "w|" + (compression or "")
+        with _open_cache_archive(archive, mode) as tar:
+            for entry_dir, files in entries:
+                root = self.cachedir
+                if self.local_cachedir is not None \
+                        and entry_dir.startswith(self.local_cachedir + os.sep):
+                    root = self.local_cachedir
+                arcdir = os.path.join(
+                    "capsul_memory",
+                    os.path.relpath(entry_dir, root)).replace(os.sep, "/")
+                index_files = ["file_mapping.json", "result.json"]
+                for fname in index_files:
+                    fpath = os.path.join(entry_dir, fname)
+                    with open(fpath, "rb") as open_file:
+                        data = open_file.read()
+                    if path_map:
+                        data = _map_cache_entry_file(fname, data, path_map)
+                    tarinfo = tar.gettarinfo(fpath, arcdir + "/" + fname)
+                    tarinfo.size = len(data)
+                    tar.addfile(tarinfo, io.BytesIO(data))
+                for fname in sorted(files):
+                    if fname not in index_files:
+                        tar.add(os.path.join(entry_dir, fname),
+                                arcdir + "/" + fname)
+                exported.append(entry_dir)
+
+        return exported
+
+    def import_(self, archive, path_map=None):
+        """ Import cache entries from an archive written by
+        :py:meth:`export`.
+
+        The archive is read in stream mode. Each entry is written in a
+        temporary directory renamed once complete. Entries which are
+        already in the cache are kept.
+
+        Parameters
+        ----------
+        archive: str or file object
+            the archive file name, or a readable file object.
+        path_map: dict (optional)
+            map workspace path prefixes to their location on this site
+            (see :py:func:`map_cache_paths`).
+
+        Returns
+        -------
+        imported: list of str
+            the imported entry directories.
+        """
+        imported = []
+        entry_dir = None
+        tmp_dir = None
+
+        def commit(entry_dir, tmp_dir):
+            if is_complete_cache_entry(tmp_dir):
+                with CacheEntryLock(entry_dir):
+                    if not is_complete_cache_entry(entry_dir):
+                        _discard_cache_entry(entry_dir)
+                        os.rename(tmp_dir, entry_dir)
+                        imported.append(entry_dir)
+                        return
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        try:
+            with _open_cache_archive(archive, "r|*") as tar:
+                for tarinfo in tar:
+                    # Only accept regular files inside entries
+                    path = tarinfo.name.split("/")
+                    if not tarinfo.isfile() or len(path) < 4 \
+                            or path[0] != "capsul_memory" \
+                            or any(item in ("", ".", "..") or ".tmp" in item
+                                   for item in path):
+                        raise ValueError(
+                            "'{0}' is not a cache archive member".format(
+                                tarinfo.name))
+                    member_entry_dir = os.path.join(self.cachedir, *path[1:-1])
+                    if member_entry_dir != entry_dir:
+                        if tmp_dir is not None:
+                            commit(entry_dir, tmp_dir)
+                            tmp_dir = None
+                        entry_dir = member_entry_dir
+                        makedirs(os.path.dirname(entry_dir))
+                        tmp_dir = tempfile.mkdtemp(
+                            prefix=os.path.basename(entry_dir) + ".tmp",
+                            dir=os.path.dirname(entry_dir))
+                    fname = path[-1]
+                    fpath = os.path.join(tmp_dir, fname)
+                    source = tar.extractfile(tarinfo)
+                    if fname in ("result.json", "file_mapping.json") \
+                            and path_map:
+                        data = _map_cache_entry_file(fname, source.read(),
+                                                     path_map)
+                        with open(fpath, "wb") as open_file:
+                            open_file.write(data)
+                    else:
+                        with open(fpath, "wb") as open_file:
+                            shutil.copyfileobj(source, open_file)
+                    os.utime(fpath, (tarinfo.mtime, tarinfo.mtime))
+            if tmp_dir is not None:
+                commit(entry_dir, tmp_dir)
+                tmp_dir = None
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return imported
+
+    def get_statistics(self, process_id=None):
+        """ Get the cache counters.
+
+        Parameters
+        ----------
+        process_id: str (optional)
+            the process class id. If not given, counters of all process
+            classes are returned.
+
+        Returns
+        -------
+        statistics: dict
+            see :py:meth:`CacheStatistics.get`.
+        """
+        return self.statistics.get(process_id)
 
     def clear(self, skips=None):
         """ Remove all the cache appart from those given to the method
@@ -892,17 +3031,32 @@ class Memory(object):
         """
         # Get all memory directories to remove
         to_remove_folders = []
+        lock_files = []
         skips = skips or []
         for root, dirs, files in os.walk(self.cachedir):
-            if "result.json" and files and dirs == [] and root not in skips:
+            dirs[:] = [dname for dname in dirs
+                       if not dname.endswith(".lockdir")]
+            lock_files.extend(os.path.join(root, fname) for fname in files
+                              if fname.endswith(".lock"))
+            if files and dirs == [] and root not in skips \
+                    and not all(fname.endswith(".lock") for fname in files):
                 to_remove_folders.append(root)
 
-        # Delete memory directories
+        # Delete memory directories with their lock files
         for folder in to_remove_folders:
-            shutil.rmtree(folder)
+            remove_cache_entry(folder)
+
+        # Delete the orphan lock files, which entries have been removed
+        for lock_fname in lock_files:
+            entry_dir = lock_fname[:-len(".lock")]
+            if not os.path.isdir(entry_dir):
+                remove_cache_entry(entry_dir, blocking=False)
 
     def __repr__(self):
         """ Memory class representation.
         """
+        if self.local_cachedir is not None:
+            return "{0}(cachedir={1}, local_cachedir={2})".format(
+                self.__class__.__name__, self.cachedir, self.local_cachedir)
         return "{0}(cachedir={1})".format(self.__class__.__name__,
                                           self.cachedir)
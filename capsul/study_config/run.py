@@ -22,7 +22,10 @@ logger = logging.getLogger(__name__)
 
 
 def run_process(output_dir, process_instance, cachedir=None,
-                generate_logging=False, verbose=0, **kwargs):
+                generate_logging=False, verbose=0, cache_signature=None,
+                local_cachedir=None, local_cache_size_limit=None,
+                cache_compression=None, memory=None, restore_outputs=None,
+                **kwargs):
     """ Execute a capsul process in a specific directory.
 
     Parameters
@@ -38,6 +41,22 @@ def run_process(output_dir, process_instance, cachedir=None,
         if True save the log stored in the process after its execution.
     verbose: int
         if different from zero, print console messages.
+    cache_signature: str (optional, default None)
+        the cache key of the process execution. If None, it is computed
+        from the process parameters.
+    local_cachedir: str (optional, default None)
+        a local cache tier used over cachedir.
+    local_cache_size_limit: int (optional, default None)
+        the local cache tier size limit in bytes. If None, no limit is set.
+    cache_compression: dict (optional, default None)
+        map file extensions to the codec used to compress cached files.
+    memory: Memory (optional, default None)
+        the smart-caching memory to use, which replaces the cachedir, local
+        cache and compression options. Its statistics are updated.
+    restore_outputs: set of str (optional, default None)
+        the output parameters whose files are restored on a cache hit. If
+        None, all of them are restored, otherwise the other files are
+        recorded in the memory, to be restored on request.
 
     Returns
     -------
@@ -84,13 +103,23 @@ def run_process(output_dir, process_instance, cachedir=None,
         print("{0}\n[Process] Calling {1}...\n{2}".format(
             80 * "_", process_instance.id,
             call_with_inputs))
-    if cachedir:
+    if memory is not None or cachedir:
         # Create a memory object
-        mem = Memory(cachedir)
-        proxy_instance = mem.cache(process_instance, verbose=verbose)
+        mem = memory
+        if mem is None:
+            mem = Memory(cachedir, local_cachedir=local_cachedir,
+                         local_size_limit=local_cache_size_limit,
+                         compression=cache_compression)
+        proxy_instance = mem.cache(process_instance, verbose=verbose,
+                                   signature=cache_signature)
+        if restore_outputs is not None and memory is not None:
+            proxy_instance.restore_outputs = restore_outputs
 
         # Execute the proxy process
-        returncode = proxy_instance(**kwargs)
+        try:
+            returncode = proxy_instance(**kwargs)
+        finally:
+            mem.forget_fingerprints(process_instance)
     else:
         for k, v in six.iteritems(kwargs):
             setattr(process_instance, k, v)
@@ -32,6 +32,7 @@ from soma.controller import Controller
 from capsul.pipeline.pipeline import Pipeline
 from capsul.process.process import Process
 from capsul.study_config.run import run_process
+from capsul.study_config.memory import Memory
 from capsul.pipeline.pipeline_nodes import Node
 from capsul.study_config.process_instance import get_process_instance
 
@@ -271,7 +272,8 @@ class StudyConfig(Controller):
             return module
 
     def run(self, process_or_pipeline, output_directory= None,
-            execute_qc_nodes=True, verbose=0, **kwargs):
+            execute_qc_nodes=True, verbose=0, cache_plan=None,
+            incremental=False, **kwargs):
         """Method to execute a process or a pipline in a study configuration
          environment.
 
@@ -297,6 +299,19 @@ class StudyConfig(Controller):
             process nodes.
         verbose: int
             if different from zero, print console messages.
+        cache_plan: CachePlan (optional)
+            the smart-caching plan of the execution, as returned by
+            :py:meth:`smart_caching_plan`, which must have been computed
+            with the same parameters. Its signatures are then used without
+            any hashing during the run. If not given and
+            smart_caching_provenance is set, it is computed here.
+        incremental: bool (optional, default False)
+            if True, only execute the pipeline nodes which are not up to
+            date, as make does (see
+            :py:func:`capsul.pipeline.pipeline_tools.nodes_to_update`).
+            Nodes parameters are recorded in the
+            'incremental_signatures.json' file of the output directory to
+            detect parameters changes. Only used for sequential executions.
         """
         
         if self.create_output_directories:
@@ -382,42 +397,88 @@ class StudyConfig(Controller):
             # Temporary files can be generated for pipelines
             temporary_files = []
             result = None
+            memory = None
+            signatures_file = None
+            executed_signatures = {}
             try:
                 # Generate ordered execution list
-                execution_list = []
-                if isinstance(process_or_pipeline, Pipeline):
-                    execution_list = \
-                        process_or_pipeline.workflow_ordered_nodes()
-                    # Filter process nodes if necessary
-                    if not execute_qc_nodes:
-                        execution_list = [node for node in execution_list
-                                          if node.node_type
-                                              == "processing_node"]
+                execution_list = self._execution_list(process_or_pipeline,
+                                                      execute_qc_nodes)
+                if execution_list and isinstance(execution_list[0], Node):
                     for node in execution_list:
                         # check temporary outputs and allocate files
                         process_or_pipeline._check_temporary_files_for_node(
                             node, temporary_files)
-                elif isinstance(process_or_pipeline, Process):
-                    execution_list.append(process_or_pipeline)
-                else:
-                    raise Exception(
-                        "Unknown instance type. Got {0}and expect Process or "
-                        "Pipeline instances".format(
-                            process_or_pipeline.__module__.name__))
+
+                # A single smart-caching memory is used during the run to
+                # gather its statistics
+                if output_directory not in (None, Undefined, "") \
+                        and self.get_trait_value("use_smart_caching"):
+                    memory = self._get_memory(output_directory)
+
+                # Use provenance signatures computed up front and skip cached
+                # nodes whose outputs are not needed
+                signatures = {}
+                if cache_plan is None \
+                        and execution_list \
+                        and isinstance(execution_list[0], Node) \
+                        and memory is not None \
+                        and self.get_trait_value("smart_caching_provenance"):
+                    cache_plan = memory.plan(process_or_pipeline,
+                                             execution_list)
+                if cache_plan is not None:
+                    signatures = cache_plan.signatures
+                    for node in cache_plan.nodes_with_status("skip"):
+                        logger.info("Study Config: skipping cached node "
+                                    "'{0}'".format(node.name))
+                    execution_list = cache_plan.execution_list
+
+                # Only execute the nodes which are not up to date
+                if incremental \
+                        and execution_list \
+                        and isinstance(execution_list[0], Node):
+                    execution_list, signatures_file, node_signatures \
+                        = self._incremental_execution_list(
+                            process_or_pipeline, execution_list,
+                            output_directory)
+
+                # Only restore the cached outputs which are used
+                restore_outputs = {}
+                if memory is not None \
+                        and execution_list \
+                        and isinstance(execution_list[0], Node) \
+                        and self.get_trait_value(
+                            "smart_caching_lazy_restore"):
+                    restore_outputs = memory.needed_outputs(
+                        process_or_pipeline, execution_list, cache_plan)
+                self._smart_caching_memory = memory
 
                 # Execute each process node element
                 for process_node in execution_list:
                     # Execute the process instance contained in the node
                     if isinstance(process_node, Node):
-                        result = self._run(process_node.process, 
-                                           output_directory, 
-                                           verbose)
+                        result = self._run(
+                            process_node.process, output_directory, verbose,
+                            cache_signature=signatures.get(process_node),
+                            memory=memory,
+                            restore_outputs=restore_outputs.get(process_node))
+                        if signatures_file is not None:
+                            executed_signatures[process_node.full_name] = \
+                                node_signatures[process_node]
 
                     # Execute the process instance
                     else:
                         result = self._run(process_node, output_directory,
-                                           verbose)
+                                           verbose, memory=memory)
             finally:
+                # Record the parameters of the executed nodes
+                if signatures_file is not None and executed_signatures:
+                    self._save_incremental_signatures(signatures_file,
+                                                      executed_signatures)
+                # Report the smart-caching statistics
+                if memory is not None:
+                    self._report_smart_caching_statistics(memory,
+                                                          output_directory)
                 # Destroy temporary files
                 if temporary_files:
                     # If temporary files have been created, we are sure that
@@ -426,7 +487,255 @@ class StudyConfig(Controller):
                     process_or_pipeline._free_temporary_files(temporary_files)
             return result
 
-    def _run(self, process_instance, output_directory, verbose, **kwargs):
+    def smart_caching_plan(self, process_or_pipeline, output_directory=None,
+                           execute_qc_nodes=True, **kwargs):
+        """ Compute the smart-caching plan of a pipeline before running it.
+
+        Nodes are keyed by provenance signatures (see the
+        smart_caching_provenance option): the plan tells which nodes are
+        cached, which have to be run, and the time saved according to the
+        stored durations. It may then be given to :py:meth:`run`.
+
+        Parameters
+        ----------
+        process_or_pipeline: Pipeline instance (mandatory)
+            the pipeline we want to execute
+        output_directory: Directory name (optional)
+            the output directory holding the cache. This replaces
+            self.output_directory but left it unchanged.
+        execute_qc_nodes: bool (optional, default True)
+            if True plan process nodes that are taged as qualtity control
+            process nodes.
+        kwargs:
+            the pipeline parameters.
+
+        Returns
+        -------
+        plan: CachePlan
+            the nodes signatures and cache status.
+        """
+        for k, v in six.iteritems(kwargs):
+            setattr(process_or_pipeline, k, v)
+        if output_directory is None or output_directory is Undefined:
+            output_directory = self.output_directory
+        if output_directory in (None, Undefined, ""):
+            raise ValueError("An output directory is required to locate the "
+                             "smart-caching entries.")
+        if not isinstance(process_or_pipeline, Pipeline):
+            raise ValueError("Smart-caching plans are computed for "
+                             "pipelines, got {0}".format(process_or_pipeline))
+        execution_list = self._execution_list(process_or_pipeline,
+                                              execute_qc_nodes)
+        if not execution_list or not isinstance(execution_list[0], Node):
+            # the pipeline is cached as a whole
+            execution_list = [process_or_pipeline.pipeline_node]
+        return self._get_memory(output_directory).plan(process_or_pipeline,
+                                                       execution_list)
+
+    def _incremental_execution_list(self, pipeline, execution_list,
+                                    output_directory):
+        """ Select the nodes which are not up to date.
+
+        Parameters
+        ----------
+        pipeline: Pipeline
+            the executed pipeline.
+        execution_list: list of Node
+            the nodes to execute.
+        output_directory: str
+            the output directory, where the nodes signatures are recorded.
+
+        Returns
+        -------
+        execution_list: list of Node
+            the nodes to execute.
+        signatures_file: str
+            the file recording the nodes signatures, None if there is no
+            output directory.
+        node_signatures: dict
+            the signatures of the nodes to execute.
+        """
+        from capsul.pipeline.pipeline_tools import nodes_to_update
+        from capsul.pipeline.pipeline_tools import node_signature
+
+        signatures_file = None
+        signatures = None
+        if output_directory not in (None, Undefined, ""):
+            signatures_file = os.path.join(output_directory,
+                                           "incremental_signatures.json")
+            signatures = {}
+            if os.path.exists(signatures_file):
+                with open(signatures_file) as open_file:
+                    signatures = json.load(open_file)
+        to_update = nodes_to_update(pipeline, execution_list, signatures)
+        for node in execution_list:
+            if node in to_update:
+                logger.info("Study Config: executing node '{0}': {1}".format(
+                    node.full_name, to_update[node]))
+            else:
+                logger.info("Study Config: skipping up to date node "
+                            "'{0}'".format(node.full_name))
+        execution_list = [node for node in execution_list
+                          if node in to_update]
+        node_signatures = {}
+        if signatures_file is not None:
+            node_signatures = dict((node, node_signature(node))
+                                   for node in execution_list)
+        return execution_list, signatures_file, node_signatures
+
+    def _save_incremental_signatures(self, signatures_file, signatures):
+        """ Record the signatures of executed nodes.
+
+        Parameters
+        ----------
+        signatures_file: str
+            the signatures file, which is updated.
+        signatures: dict
+            the executed nodes signatures, indexed by node full name.
+        """
+        recorded = {}
+        if os.path.exists(signatures_file):
+            with open(signatures_file) as open_file:
+                recorded = json.load(open_file)
+        recorded.update(signatures)
+        with open(signatures_file, "w") as open_file:
+            json.dump(recorded, open_file, indent=4, sort_keys=True)
+
+    def restore_cached_outputs(self, files=None):
+        """ Restore the output files left in the cache by the last run.
+
+        With the smart_caching_lazy_restore option, output files of cached
+        nodes which are not used during the run are not restored.
+
+        Parameters
+        ----------
+        files: list of str (optional)
+            the files to restore. If not given, all the files left in the
+            cache are restored.
+
+        Returns
+        -------
+        restored: list of str
+            the restored files.
+        """
+        memory = getattr(self, "_smart_caching_memory", None)
+        if memory is None:
+            return []
+        return memory.restore(files)
+
+    def _get_memory(self, cachedir):
+        """ Get the smart-caching Memory object of a cache directory.
+
+        Parameters
+        ----------
+        cachedir: str
+            the (shared) cache directory.
+
+        Returns
+        -------
+        memory: Memory
+            the memory using the configured local cache tier,
+            compression and fingerprints reuse.
+        """
+        return Memory(cachedir, **self._get_memory_options())
+
+    def _get_memory_options(self):
+        """ Get the smart-caching Memory options from the configuration.
+
+        Returns
+        -------
+        options: dict
+            local_cachedir, local_size_limit (in bytes), compression and
+            reuse_fingerprints Memory parameters.
+        """
+        options = {
+            "compression": self.get_trait_value("smart_caching_compression"),
+            "reuse_fingerprints": bool(self.get_trait_value(
+                "smart_caching_reuse_fingerprints"))}
+        local_cachedir = self.get_trait_value("smart_caching_local_directory")
+        if local_cachedir not in (None, Undefined, ""):
+            size_limit = self.get_trait_value(
+                "smart_caching_local_size_limit")
+            if size_limit:
+                size_limit = size_limit * 1024 * 1024
+            else:
+                size_limit = None
+            options["local_cachedir"] = local_cachedir
+            options["local_size_limit"] = size_limit
+        return options
+
+    def _execution_list(self, process_or_pipeline, execute_qc_nodes):
+        """ Get the ordered list of nodes or processes to execute.
+
+        Parameters
+        ----------
+        process_or_pipeline: Process or Pipeline instance (mandatory)
+            the process or pipeline we want to execute
+        execute_qc_nodes: bool
+            if True keep process nodes that are taged as qualtity control
+            process nodes.
+
+        Returns
+        -------
+        execution_list: list
+            pipeline nodes, or the process (or pipeline cached as a whole)
+            itself.
+        """
+        execution_list = []
+        cached_pipelines = []
+        if self.get_trait_value("use_smart_caching"):
+            cached_pipelines \
+                = self.get_trait_value("smart_caching_pipelines") or []
+        if isinstance(process_or_pipeline, Pipeline) \
+                and "" in cached_pipelines:
+            # The whole pipeline is cached as a single process
+            execution_list.append(process_or_pipeline)
+        elif isinstance(process_or_pipeline, Pipeline):
+            # Sub-pipelines cached as a whole are not expanded
+            execution_list = \
+                process_or_pipeline.workflow_ordered_nodes(
+                    unexpanded_pipelines=cached_pipelines)
+            # Filter process nodes if necessary
+            if not execute_qc_nodes:
+                execution_list = [node for node in execution_list
+                                  if node.node_type == "processing_node"]
+        elif isinstance(process_or_pipeline, Process):
+            execution_list.append(process_or_pipeline)
+        else:
+            raise Exception(
+                "Unknown instance type. Got {0}and expect Process or "
+                "Pipeline instances".format(
+                    process_or_pipeline.__module__.name__))
+        return execution_list
+
+    def _report_smart_caching_statistics(self, memory, output_directory):
+        """ Store and log the smart-caching statistics of a run.
+
+        The statistics are available in the smart_caching_statistics
+        attribute after the run. When generate_logging is set, they are
+        also saved in a 'smart_caching_statistics.json' file in the output
+        directory.
+
+        Parameters
+        ----------
+        memory: Memory
+            the memory used during the run.
+        output_directory: str
+            the run output directory.
+        """
+        self.smart_caching_statistics = memory.get_statistics()
+        logger.info("Study Config: smart-caching statistics:\n{0}".format(
+            memory.statistics.report()))
+        if self.generate_logging:
+            stats_file = os.path.join(output_directory,
+                                      "smart_caching_statistics.json")
+            with open(stats_file, "w") as open_file:
+                json.dump(self.smart_caching_statistics, open_file,
+                          indent=4, sort_keys=True)
+
+    def _run(self, process_instance, output_directory, verbose,
+             cache_signature=None, memory=None, restore_outputs=None,
+             **kwargs):
         """ Method to execute a process in a study configuration environment.
 
         Parameters
@@ -438,6 +747,12 @@ class StudyConfig(Controller):
             self.output_directory but left it unchanged.
         verbose: int
             if different from zero, print console messages.
+        cache_signature: str (optional)
+            the smart-caching key of the execution, if already known.
+        memory: Memory (optional)
+            the smart-caching memory to use, if smart-caching is used.
+        restore_outputs: set of str (optional)
+            the outputs to restore on a cache hit (all if None).
         """
         # Message
         logger.info("Study Config: executing process '{0}'...".format(
@@ -462,12 +777,19 @@ class StudyConfig(Controller):
                             not(process_instance.output_directory)):
                         process_instance.output_directory = output_directory
         
+        memory_options = self._get_memory_options()
         returncode, log_file = run_process(
             output_directory,
             process_instance,
             cachedir=cachedir,
             generate_logging=self.generate_logging,
             verbose=verbose,
+            cache_signature=cache_signature,
+            local_cachedir=memory_options.get("local_cachedir"),
+            local_cache_size_limit=memory_options.get("local_size_limit"),
+            cache_compression=memory_options["compression"],
+            memory=memory if cachedir else None,
+            restore_outputs=restore_outputs,
             **kwargs)
 
         # Increment the number of executed process count
@@ -0,0 +1,163 @@
+##########################################################################
+# Capsul - Copyright (C) CEA, 2014
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+import time
+
+# Capsul import
+from capsul.api import Process
+from capsul.api import Pipeline
+from capsul.api import StudyConfig
+from capsul.api import get_process_instance
+from capsul.pipeline.pipeline_tools import nodes_to_update
+
+# Trait import
+from traits.api import File, List, String
+
+
+class AppendProcess(Process):
+    """ Append a text to a file.
+    """
+    executions = []
+    input_file = File(optional=False, desc="the input file")
+    text = String(optional=False, desc="the appended text")
+    output_file = File(output=True, input_filename=True,
+                       desc="the output file")
+
+    def _run_process(self):
+        AppendProcess.executions.append(self.text)
+        with open(self.input_file) as f:
+            content = f.read()
+        with open(self.output_file, "w") as f:
+            f.write(content + self.text)
+
+
+class AppendPipeline(Pipeline):
+    """ Chain of two appending processes.
+    """
+    def pipeline_definition(self):
+        self.add_process("first", AppendProcess)
+        self.add_process("second", AppendProcess)
+        self.add_link("first.output_file->second.input_file")
+        self.export_parameter("first", "input_file")
+        self.export_parameter("first", "text", "first_text")
+        self.export_parameter("first", "output_file", "first_output")
+        self.export_parameter("second", "text", "second_text")
+        self.export_parameter("second", "output_file")
+
+
+class SplitProcess(Process):
+    """ Dummy process with lists of files parameters.
+    """
+    input_files = List(File(), optional=False, desc="the input files")
+    output_files = List(File(), output=True, input_filename=True,
+                        desc="the output files")
+
+    def _run_process(self):
+        pass
+
+
+class SplitPipeline(Pipeline):
+    """ Pipeline with a single lists of files process.
+    """
+    def pipeline_definition(self):
+        self.add_process("split", SplitProcess)
+
+
+class TestIncrementalRun(unittest.TestCase):
+    """ Test make-like pipeline executions.
+    """
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.study_config = StudyConfig(
+            output_directory=self.output_directory)
+        self.pipeline = get_process_instance(AppendPipeline)
+        self.input_file = os.path.join(self.output_directory, "in.txt")
+        with open(self.input_file, "w") as f:
+            f.write("a")
+        self.pipeline.input_file = self.input_file
+        self.pipeline.first_text = "b"
+        self.pipeline.second_text = "c"
+        self.pipeline.first_output = os.path.join(self.output_directory,
+                                                  "first.txt")
+        self.pipeline.output_file = os.path.join(self.output_directory,
+                                                 "second.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+
+    def run_pipeline(self):
+        AppendProcess.executions = []
+        self.study_config.run(self.pipeline, incremental=True)
+        with open(self.pipeline.output_file) as f:
+            self.assertEqual(f.read(), "abc")
+        return AppendProcess.executions
+
+    def test_incremental_run(self):
+        """ Test that only nodes which are not up to date are executed.
+        """
+        self.assertEqual(self.run_pipeline(), ["b", "c"])
+        self.assertEqual(self.run_pipeline(), [])
+
+        # Missing outputs
+        os.unlink(self.pipeline.output_file)
+        self.assertEqual(self.run_pipeline(), ["c"])
+
+        # Modified inputs are propagated downstream
+        time.sleep(0.01)
+        with open(self.input_file, "w") as f:
+            f.write("a")
+        self.assertEqual(self.run_pipeline(), ["b", "c"])
+
+        # Parameters changes
+        self.pipeline.second_text = "d"
+        self.study_config.run(self.pipeline, incremental=True)
+        self.pipeline.second_text = "c"
+        self.assertEqual(self.run_pipeline(), ["c"])
+
+    def test_file_lists(self):
+        """ Test the up to date check of lists of files parameters.
+        """
+        pipeline = get_process_instance(SplitPipeline)
+        files = []
+        for i, name in enumerate(("in1", "in2", "out1", "out2")):
+            fname = os.path.join(self.output_directory, name + ".txt")
+            open(fname, "w").close()
+            os.utime(fname, (1000 + i, 1000 + i))
+            files.append(fname)
+        pipeline.input_files = files[:2]
+        pipeline.output_files = files[2:]
+        nodes = pipeline.workflow_ordered_nodes()
+        self.assertEqual(nodes_to_update(pipeline, nodes), {})
+
+        # Modified inputs in a list
+        os.utime(files[1], (2000, 2000))
+        self.assertEqual(list(nodes_to_update(pipeline, nodes).values()),
+                         ["outputs are older than inputs"])
+
+        # Missing outputs in a list
+        os.utime(files[1], (1000, 1000))
+        os.unlink(files[3])
+        self.assertEqual(list(nodes_to_update(pipeline, nodes).values()),
+                         ["output output_files is missing"])
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestIncrementalRun)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
@@ -13,12 +13,32 @@ import unittest
 import os
 import tempfile
 import shutil
+import threading
+import time
+import gzip
+import json
+import tarfile
+import socket
+import subprocess
+import sys
 
 # Capsul import
 from capsul.api import Process
 from capsul.api import FileCopyProcess
 from capsul.api import get_process_instance
+from capsul.api import Pipeline
+from capsul.api import StudyConfig
+from capsul.study_config import memory
 from capsul.study_config.memory import Memory
+from capsul.study_config.memory import is_complete_cache_entry
+from capsul.study_config.memory import hash_parameters
+from capsul.study_config.memory import UnMemorizedProcess
+from capsul.study_config.memory import get_source_hash
+from capsul.study_config.memory import CachePlan
+from capsul.study_config.memory import CacheEntryLock
+from capsul.study_config.run import run_process
+from capsul.study_config.memory import remove_cache_entry
+from capsul.api import CachePolicy
 
 # Trait import
 from traits.api import Float, File, List, String
@@ -50,6 +70,52 @@ class DummyCopyProcess(FileCopyProcess):
         self.s = repr(self.copied_inputs)
 
 
+class CountingProcess(Process):
+    """ Slow process counting its executions.
+    """
+    executions = 0
+    f = Float(output=False, optional=False, desc="float")
+    res = Float(output=True, desc="float")
+
+    def _run_process(self):
+        CountingProcess.executions += 1
+        time.sleep(0.2)
+        self.res = self.f * 2
+
+
+class TextProcess(Process):
+    """ Write a text file.
+    """
+    text = String(output=False, optional=False, desc="the file content")
+    out = File(output=True, input_filename=True, desc="the written file")
+
+    def _run_process(self):
+        with open(self.out, "w") as f:
+            f.write(self.text * 100)
+
+
+class CountingPipeline(Pipeline):
+    """ Chain of two counting processes.
+    """
+    def pipeline_definition(self):
+        self.add_process("first", CountingProcess)
+        self.add_process("second", CountingProcess)
+        self.add_link("first.res->second.f")
+        self.export_parameter("first", "f")
+        self.export_parameter("second", "res")
+
+
+class CountingSuperPipeline(Pipeline):
+    """ Counting pipeline followed by a counting process.
+    """
+    def pipeline_definition(self):
+        self.add_process("sub", CountingPipeline)
+        self.add_process("last", CountingProcess)
+        self.add_link("sub.res->last.f")
+        self.export_parameter("sub", "f")
+        self.export_parameter("last", "res")
+
+
 class TestMemory(unittest.TestCase):
     """ Execute a process using smart-caching functionalities.
     """
@@ -97,6 +163,569 @@ class TestMemory(unittest.TestCase):
         # Call the test
         self.proxy_process_copy()
 
+    def test_concurrent_calls(self):
+        """ Test that concurrent identical calls compute only once.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir)
+        CountingProcess.executions = 0
+        results = []
+
+        def worker():
+            proxy_process = mem.cache(CountingProcess(), verbose=0)
+            proxy_process(f=1.5)
+            results.append(proxy_process.res)
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(CountingProcess.executions, 1)
+        self.assertEqual(results, [3.] * 4)
+
+    def test_incomplete_entry(self):
+        """ Test that a partially written entry is not read as a hit.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir)
+        CountingProcess.executions = 0
+        proxy_process = mem.cache(CountingProcess(), verbose=0)
+        proxy_process.process.f = 2.
+        process_dir = proxy_process._get_process_id()[0]
+        # simulate an interrupted write
+        os.makedirs(process_dir)
+        with open(os.path.join(process_dir, "result.json"), "w") as f:
+            f.write("{")
+        self.assertFalse(is_complete_cache_entry(process_dir))
+        proxy_process(f=2.)
+        self.assertEqual(CountingProcess.executions, 1)
+        self.assertEqual(proxy_process.res, 4.)
+        self.assertTrue(is_complete_cache_entry(process_dir))
+        proxy_process(f=2.)
+        self.assertEqual(CountingProcess.executions, 1)
+
+    def test_lock_files(self):
+        """ Test that lock files are removed with their entries.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir)
+        proxy_process = mem.cache(CountingProcess(), verbose=0)
+        proxy_process(f=1.)
+        process_dir = proxy_process._get_process_id()[0]
+
+        # A worker waiting on a removed lock file locks the new one
+        lock = CacheEntryLock(process_dir)
+        lock.acquire()
+        acquired = []
+
+        def worker():
+            with CacheEntryLock(process_dir):
+                acquired.append(os.path.exists(process_dir + ".lock"))
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(acquired, [])
+        lock.remove()
+        lock.release()
+        thread.join()
+        self.assertEqual(acquired, [True])
+
+        # Locked entries are not removed without waiting
+        lock.acquire()
+        self.assertFalse(remove_cache_entry(process_dir, blocking=False))
+        lock.release()
+        self.assertTrue(remove_cache_entry(process_dir))
+        self.assertFalse(os.path.exists(process_dir))
+        self.assertFalse(os.path.exists(process_dir + ".lock"))
+
+        # Evicted entries and cleared caches leave no lock file
+        local_cachedir = os.path.join(self.workspace_dir, "local")
+        mem = Memory(self.cachedir, local_cachedir=local_cachedir,
+                     local_size_limit=1)
+        proxy_process = mem.cache(CountingProcess(), verbose=0)
+        proxy_process(f=1.)
+        proxy_process(f=2.)
+        local_dir = proxy_process._get_local_entry_dir(
+            proxy_process._get_process_id()[0])
+        lock_files = [fname for fname in os.listdir(
+            os.path.dirname(local_dir)) if fname.endswith(".lock")]
+        self.assertEqual(lock_files, [])
+        orphan = os.path.join(os.path.dirname(process_dir), "orphan.lock")
+        open(orphan, "w").close()
+        mem.clear()
+        for root, dirs, files in os.walk(self.cachedir):
+            self.assertEqual([fname for fname in files
+                              if fname.endswith(".lock")], [])
+        self.assertFalse(os.path.exists(process_dir))
+
+    def test_lock_directories(self):
+        """ Test the lock directories used without fcntl, and the removal of
+        stale ones.
+        """
+        process_dir = os.path.join(self.workspace_dir, "entry")
+        lock_dir = process_dir + ".lockdir"
+        old_time = time.time() - 7200
+
+        def make_lock_dir(owner):
+            os.mkdir(lock_dir)
+            if owner is not None:
+                with open(os.path.join(lock_dir, "owner"), "w") as f:
+                    f.write(owner)
+            os.utime(lock_dir, (old_time, old_time))
+
+        dead_process = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead_process.wait()
+        fcntl = memory.fcntl
+        memory.fcntl = None
+        try:
+            lock = CacheEntryLock(process_dir)
+            with lock:
+                self.assertTrue(os.path.isdir(lock_dir))
+                self.assertFalse(CacheEntryLock(process_dir).acquire(
+                    blocking=False))
+            self.assertFalse(os.path.exists(lock_dir))
+
+            # Locks of running processes are kept, locks of dead processes
+            # or without owner are removed
+            make_lock_dir("{0} {1} x".format(socket.gethostname(),
+                                             os.getpid()))
+            self.assertFalse(lock.acquire(blocking=False))
+            shutil.rmtree(lock_dir)
+            for owner in ("{0} {1} x".format(socket.gethostname(),
+                                             dead_process.pid), None):
+                make_lock_dir(owner)
+                self.assertTrue(lock.acquire(blocking=False))
+                lock.release()
+                self.assertFalse(os.path.exists(lock_dir))
+
+            # Locks of other hosts are removed after the stale timeout
+            make_lock_dir("other_host 1 x")
+            self.assertFalse(lock.acquire(blocking=False))
+            lock = CacheEntryLock(process_dir, stale_timeout=3600)
+            self.assertTrue(lock.acquire(blocking=False))
+            lock.release()
+            self.assertEqual(os.listdir(self.workspace_dir), [])
+        finally:
+            memory.fcntl = fcntl
+
+    def test_pipeline_caching(self):
+        """ Test caching a whole pipeline and a sub-pipeline node.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        study_config = StudyConfig(
+            modules=["SmartCachingConfig"],
+            use_smart_caching=True,
+            output_directory=self.cachedir)
+
+        # The executed pipeline itself
+        study_config.smart_caching_pipelines = [""]
+        CountingProcess.executions = 0
+        pipeline = get_process_instance(CountingPipeline)
+        for i in range(2):
+            study_config.run(pipeline, f=1.)
+            self.assertEqual(pipeline.res, 4.)
+            self.assertEqual(CountingProcess.executions, 2)
+        self.assertTrue(os.path.isdir(os.path.join(
+            self.cachedir, "capsul_memory", *pipeline.id.split("."))))
+
+        # A sub-pipeline node, cached as a whole next to the last process
+        study_config.smart_caching_pipelines = ["sub"]
+        CountingProcess.executions = 0
+        pipeline = get_process_instance(CountingSuperPipeline)
+        study_config.run(pipeline, f=2.)
+        self.assertEqual(pipeline.res, 16.)
+        self.assertEqual(CountingProcess.executions, 3)
+        CountingProcess.executions = 0
+        study_config.run(pipeline, f=2.)
+        self.assertEqual(pipeline.res, 16.)
+        self.assertEqual(CountingProcess.executions, 0)
+
+    def test_provenance_signatures(self):
+        """ Test that cached nodes are detected and skipped up front.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        study_config = StudyConfig(
+            modules=["SmartCachingConfig"],
+            use_smart_caching=True,
+            smart_caching_provenance=True,
+            output_directory=self.cachedir)
+        pipeline = get_process_instance(CountingPipeline)
+        memory = Memory(self.cachedir)
+        pipeline.f = 3.
+        nodes = pipeline.workflow_ordered_nodes()
+        signatures = memory.provenance_signatures(nodes)
+        self.assertEqual(len(set(signatures.values())), 2)
+        self.assertEqual(memory.needed_nodes(pipeline, nodes, nodes), nodes)
+
+        CountingProcess.executions = 0
+        study_config.run(pipeline, f=3.)
+        self.assertEqual(pipeline.res, 12.)
+        self.assertEqual(CountingProcess.executions, 2)
+        self.assertEqual(memory.provenance_signatures(nodes), signatures)
+
+        # Only the node producing the pipeline output is restored
+        study_config.reset_process_counter()
+        CountingProcess.executions = 0
+        pipeline.res = 0.
+        study_config.run(pipeline, f=3.)
+        self.assertEqual(pipeline.res, 12.)
+        self.assertEqual(CountingProcess.executions, 0)
+        self.assertEqual(study_config.process_counter, 2)
+
+        # Upstream changes propagate downstream
+        study_config.run(pipeline, f=4.)
+        self.assertEqual(pipeline.res, 16.)
+        self.assertEqual(CountingProcess.executions, 2)
+
+    def test_cache_plan(self):
+        """ Test the smart-caching plan computed before execution.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        study_config = StudyConfig(
+            modules=["SmartCachingConfig"],
+            use_smart_caching=True,
+            output_directory=self.cachedir)
+        pipeline = get_process_instance(CountingSuperPipeline)
+        plan = study_config.smart_caching_plan(pipeline, f=1.)
+        self.assertEqual([plan.status[node] for node in plan.nodes],
+                         ["run"] * 3)
+        self.assertEqual(plan.estimated_time_saved(), (0., 0))
+
+        CountingProcess.executions = 0
+        study_config.run(pipeline, cache_plan=plan)
+        self.assertEqual(pipeline.res, 8.)
+        self.assertEqual(CountingProcess.executions, 3)
+
+        plan = study_config.smart_caching_plan(pipeline, f=1.)
+        self.assertEqual([plan.status[node] for node in plan.nodes],
+                         ["skip", "skip", "restore"])
+        saved, unknown = plan.estimated_time_saved()
+        self.assertTrue(saved >= 0.6)
+        self.assertEqual(unknown, 0)
+        self.assertTrue("Estimated time saved" in plan.report())
+        CountingProcess.executions = 0
+        pipeline.res = 0.
+        study_config.run(pipeline, cache_plan=plan)
+        self.assertEqual(pipeline.res, 8.)
+        self.assertEqual(CountingProcess.executions, 0)
+
+    def test_lazy_restore(self):
+        """ Test the restoration of needed outputs only on cache hits.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir)
+        out = os.path.join(self.workspace_dir, "out.txt")
+        proxy_process = mem.cache(TextProcess(), verbose=0)
+        proxy_process(text="capsul ", out=out)
+        os.unlink(out)
+
+        # Unneeded outputs are left in the cache
+        proxy_process = mem.cache(TextProcess(), verbose=0)
+        proxy_process.restore_outputs = set()
+        proxy_process(text="capsul ", out=out)
+        self.assertEqual(proxy_process.out, out)
+        self.assertFalse(os.path.exists(out))
+        self.assertEqual(list(mem.pending_restorations), [out])
+
+        # and restored on request
+        self.assertEqual(mem.restore([out]), [out])
+        with open(out) as f:
+            self.assertEqual(f.read(), "capsul " * 100)
+        self.assertEqual(mem.pending_restorations, {})
+        self.assertEqual(mem.restore(), [])
+
+        # Needed outputs are used by run nodes or exported
+        pipeline = get_process_instance(CountingSuperPipeline)
+        nodes = pipeline.workflow_ordered_nodes()
+        self.assertEqual([node.name for node in nodes],
+                         ["first", "second", "last"])
+        self.assertEqual([mem.needed_outputs(pipeline, nodes)[node]
+                          for node in nodes], [set(["res"])] * 3)
+        plan = CachePlan(nodes, {}, dict(zip(nodes,
+                                             ["skip", "skip", "restore"])),
+                         {})
+        self.assertEqual([mem.needed_outputs(pipeline, nodes, plan)[node]
+                          for node in nodes], [set(), set(), set(["res"])])
+
+    def test_export_import(self):
+        """ Test moving cache entries to another site.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        source_dir = os.path.join(self.workspace_dir, "source")
+        dest_dir = os.path.join(self.workspace_dir, "dest")
+        os.mkdir(source_dir)
+        os.mkdir(dest_dir)
+        mem = Memory(os.path.join(self.cachedir, "source"))
+        proxy_process = mem.cache(TextProcess(), verbose=0)
+        proxy_process(text="capsul ", out=os.path.join(source_dir, "out.txt"))
+        mem.cache(CountingProcess(), verbose=0)(f=1.)
+
+        # Export the entries of a process through a stream
+        archive = os.path.join(self.workspace_dir, "cache.tar.gz")
+        with open(archive, "wb") as f:
+            exported = mem.export([proxy_process.process.id], f,
+                                  compression="gz",
+                                  path_map={source_dir: dest_dir})
+        self.assertEqual(exported, [proxy_process.get_cached_entry()])
+
+        # Import them on the destination site
+        dest_mem = Memory(os.path.join(self.cachedir, "dest"))
+        imported = dest_mem.import_(archive)
+        self.assertEqual(len(imported), 1)
+        self.assertEqual(dest_mem.import_(archive), [])
+        out = os.path.join(dest_dir, "out.txt")
+        proxy_process = dest_mem.cache(TextProcess(), verbose=0)
+        self.assertEqual(proxy_process.get_cached_entry(), None)
+        proxy_process.text = "capsul "
+        self.assertEqual(proxy_process.get_cached_entry(), imported[0])
+        proxy_process(text="capsul ", out=out)
+        self.assertEqual(proxy_process.out, out)
+        with open(out) as f:
+            self.assertEqual(f.read(), "capsul " * 100)
+
+        # Archives may only contain cache entries
+        with open(archive, "wb") as f:
+            with tarfile.open(fileobj=f, mode="w|") as tar:
+                tar.add(out, "../out.txt")
+        self.assertRaises(ValueError, dest_mem.import_, archive)
+
+    def test_local_tier(self):
+        """ Test the local cache tier over the shared one.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        local_cachedir = os.path.join(self.workspace_dir, "local")
+        mem = Memory(self.cachedir, local_cachedir=local_cachedir)
+        CountingProcess.executions = 0
+        proxy_process = mem.cache(CountingProcess(), verbose=0)
+
+        # New entries are written to both tiers
+        proxy_process(f=1.)
+        process_dir = proxy_process._get_process_id()[0]
+        local_dir = proxy_process._get_local_entry_dir(process_dir)
+        self.assertTrue(is_complete_cache_entry(process_dir))
+        self.assertTrue(is_complete_cache_entry(local_dir))
+        self.assertEqual(proxy_process.get_cached_entry(), local_dir)
+
+        # Shared entries are promoted to the local tier on hit
+        shutil.rmtree(local_dir)
+        proxy_process(f=1.)
+        self.assertEqual(proxy_process.res, 2.)
+        self.assertTrue(is_complete_cache_entry(local_dir))
+        self.assertEqual(CountingProcess.executions, 1)
+
+        # Least recently used local entries are evicted, not shared ones
+        mem = Memory(self.cachedir, local_cachedir=local_cachedir,
+                     local_size_limit=1)
+        proxy_process = mem.cache(CountingProcess(), verbose=0)
+        proxy_process(f=2.)
+        self.assertEqual(CountingProcess.executions, 2)
+        self.assertFalse(os.path.exists(local_dir))
+        self.assertTrue(is_complete_cache_entry(process_dir))
+        proxy_process(f=1.)
+        self.assertEqual(proxy_process.res, 2.)
+        self.assertEqual(CountingProcess.executions, 2)
+        self.assertTrue(is_complete_cache_entry(local_dir))
+
+        # Expired local entries are replaced by valid shared ones
+        process = CountingProcess()
+        process.cache_policy = CachePolicy(ttl=3600)
+        proxy_process = mem.cache(process, verbose=0)
+        result_fname = os.path.join(local_dir, "result.json")
+        old_time = time.time() - 7200
+        os.utime(result_fname, (old_time, old_time))
+        self.assertFalse(proxy_process._is_valid_entry(local_dir))
+        os.utime(os.path.join(process_dir, "result.json"), None)
+        proxy_process(f=1.)
+        self.assertEqual(proxy_process.res, 2.)
+        self.assertEqual(CountingProcess.executions, 2)
+        self.assertTrue(proxy_process._is_valid_entry(local_dir))
+
+    def test_compression(self):
+        """ Test the compressed storage of cached files.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir, compression={".txt": "gzip"})
+        out = os.path.join(self.workspace_dir, "out.txt")
+        proxy_process = mem.cache(TextProcess(), verbose=0)
+        proxy_process(text="capsul ", out=out)
+        mtime = os.stat(out).st_mtime
+
+        process_dir = proxy_process.get_cached_entry()
+        stored = os.path.join(process_dir, "out.txt.gz")
+        with gzip.open(stored, "rb") as f:
+            self.assertEqual(f.read().decode(), "capsul " * 100)
+        self.assertTrue(os.path.getsize(stored) < os.path.getsize(out))
+
+        # Restore the compressed file
+        os.unlink(out)
+        proxy_process(text="capsul ", out=out)
+        with open(out) as f:
+            self.assertEqual(f.read(), "capsul " * 100)
+        self.assertEqual(os.stat(out).st_mtime, mtime)
+
+        # Entries written with the former mapping format are still read
+        map_fname = os.path.join(process_dir, "file_mapping.json")
+        shutil.copy2(out, os.path.join(process_dir, "out.txt"))
+        with open(map_fname, "w") as f:
+            json.dump([[out, "out.txt"]], f)
+        os.unlink(out)
+        proxy_process(text="capsul ", out=out)
+        with open(out) as f:
+            self.assertEqual(f.read(), "capsul " * 100)
+
+        self.assertRaises(ValueError, Memory, self.cachedir,
+                          compression={".txt": "unknown"})
+
+    def test_statistics(self):
+        """ Test the cache counters.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir)
+        out = os.path.join(self.workspace_dir, "out.txt")
+        proxy_process = mem.cache(TextProcess(), verbose=0)
+        proxy_process(text="a", out=out)
+        proxy_process(text="a", out=out)
+        proxy_process(text="b", out=out)
+        statistics = mem.get_statistics(proxy_process.process.id)
+        self.assertEqual(statistics["hits"], 1)
+        self.assertEqual(statistics["misses"], 2)
+        self.assertEqual(statistics["bytes_restored"], 100)
+        self.assertEqual(statistics["bytes_stored"], 200)
+        for name in ("hash_time", "copy_time", "load_time"):
+            self.assertTrue(statistics[name] > 0)
+        self.assertEqual(list(mem.get_statistics().keys()),
+                         [proxy_process.process.id])
+        self.assertTrue("1 hits, 2 misses" in mem.statistics.report())
+
+        # StudyConfig gathers the statistics of a run
+        study_config = StudyConfig(
+            modules=["SmartCachingConfig"],
+            use_smart_caching=True,
+            output_directory=self.cachedir)
+        pipeline = get_process_instance(CountingPipeline)
+        for i in range(2):
+            study_config.run(pipeline, f=5.)
+        statistics = study_config.smart_caching_statistics[
+            pipeline.nodes["first"].process.id]
+        self.assertEqual((statistics["hits"], statistics["misses"]), (2, 0))
+
+    def test_signatures(self):
+        """ Test the signatures computation.
+        """
+        self.assertEqual(hash_parameters({"a": [1, "b"], "c": None}),
+                         hash_parameters({"c": None, "a": [1, "b"]}))
+        self.assertNotEqual(hash_parameters({"a": 1}),
+                            hash_parameters({"a": "1"}))
+        self.assertNotEqual(hash_parameters({"a": ["bc"]}),
+                            hash_parameters({"a": ["b", "c"]}))
+
+        # Fingerprints are reused during the memory lifetime, unless the
+        # files are written by a cached process
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir, reuse_fingerprints=True)
+        out = os.path.join(self.workspace_dir, "out.txt")
+        with open(out, "w") as f:
+            f.write("previous")
+        proxy_process = mem.cache(DummyCopyProcess(), verbose=0)
+        proxy_process.process.destination = os.path.join(
+            self.workspace_dir, "copy")
+        os.mkdir(proxy_process.process.destination)
+        proxy_process(f=1., i=out, l=[])
+        self.assertTrue(out in mem.fingerprints)
+        proxy_process = mem.cache(TextProcess(), verbose=0)
+        proxy_process(text="a", out=out)
+        self.assertFalse(out in mem.fingerprints)
+
+        # Files written by uncached processes are fingerprinted again
+        proxy_process = mem.cache(DummyCopyProcess(), verbose=0)
+        proxy_process.process.destination = os.path.join(
+            self.workspace_dir, "copy")
+        proxy_process(f=1., i=out, l=[])
+        self.assertTrue(out in mem.fingerprints)
+        process = TextProcess()
+        process.cache_policy = CachePolicy(enabled=False)
+        run_process(self.workspace_dir, process, memory=mem, verbose=0,
+                    text="b", out=out)
+        self.assertFalse(out in mem.fingerprints)
+
+        # Missing files are not recorded
+        missing = os.path.join(self.workspace_dir, "missing.txt")
+        self.assertEqual(proxy_process._get_fingerprint(missing), None)
+        self.assertFalse(missing in mem.fingerprints)
+
+        # Fingerprints are not reused by default
+        self.assertEqual(Memory(self.cachedir).fingerprints, None)
+        study_config = StudyConfig(modules=["SmartCachingConfig"])
+        self.assertEqual(study_config._get_memory(self.cachedir).fingerprints,
+                         None)
+
+    def test_cache_policy(self):
+        """ Test the per-process cache policies.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        mem = Memory(self.cachedir)
+
+        # Opt-out
+        process = CountingProcess()
+        process.cache_policy = CachePolicy(enabled=False)
+        self.assertTrue(isinstance(mem.cache(process), UnMemorizedProcess))
+
+        # Time to live
+        CountingProcess.executions = 0
+        process = CountingProcess()
+        process.cache_policy = CachePolicy(ttl=3600)
+        proxy_process = mem.cache(process, verbose=0)
+        proxy_process(f=1.)
+        proxy_process(f=1.)
+        self.assertEqual(CountingProcess.executions, 1)
+        result_fname = os.path.join(proxy_process.get_cached_entry(),
+                                    "result.json")
+        old_time = time.time() - 7200
+        os.utime(result_fname, (old_time, old_time))
+        self.assertFalse(proxy_process.is_cached())
+
+        # Expired entries are renamed before being removed, never removed
+        # in place while readers may use them
+        removed = []
+        rmtree = shutil.rmtree
+
+        def recording_rmtree(path, *args, **kwargs):
+            removed.append(path)
+            rmtree(path, *args, **kwargs)
+
+        shutil.rmtree = recording_rmtree
+        try:
+            proxy_process(f=1.)
+        finally:
+            shutil.rmtree = rmtree
+        self.assertEqual(CountingProcess.executions, 2)
+        self.assertTrue(proxy_process.is_cached())
+        entry_dir = proxy_process.get_cached_entry()
+        self.assertFalse(entry_dir in removed)
+        self.assertEqual([fname for fname in os.listdir(
+            os.path.dirname(entry_dir)) if ".tmp" in fname], [])
+
+        # Versions
+        signatures = set()
+        for policy in (None, CachePolicy(version="1"),
+                       CachePolicy(version="2"),
+                       CachePolicy(source_hash=True)):
+            process.cache_policy = policy
+            signatures.add(proxy_process._get_argument_hash()[0])
+        self.assertEqual(len(signatures), 4)
+        self.assertEqual(len(get_source_hash(CountingProcess)), 32)
+
+        # Nodes using results of uncached nodes are hashed at run time
+        pipeline = get_process_instance(CountingPipeline)
+        pipeline.nodes["first"].process.cache_policy \
+            = CachePolicy(enabled=False)
+        pipeline.f = 1.
+        plan = mem.plan(pipeline, pipeline.workflow_ordered_nodes())
+        self.assertEqual([plan.status[node] for node in plan.nodes],
+                         ["unknown", "unknown"])
+
     def proxy_process(self):
         """ Test the proxy process behaviours.
         """
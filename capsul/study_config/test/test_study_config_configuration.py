@@ -31,6 +31,12 @@ tests_no_files = [
         "generate_logging": False,
         'use_matlab': False,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
@@ -49,6 +55,12 @@ tests_no_files = [
         "generate_logging": False,
         'use_matlab': False,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
@@ -67,6 +79,12 @@ tests_no_files = [
         "generate_logging": False,
         'use_matlab': False,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
@@ -108,6 +126,12 @@ tests_no_files = [
         "use_freesurfer": False,
         "shared_directory": soma.config.BRAINVISA_SHARE,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
@@ -134,6 +158,12 @@ tests_standard_files = [
         "generate_logging": False,
         'use_matlab': False,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
@@ -176,6 +206,12 @@ tests_standard_files = [
         "generate_logging": False,
         'use_matlab': False,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
@@ -225,6 +261,12 @@ tests_custom_files = [
         "generate_logging": False,
         'use_matlab': False,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
@@ -266,6 +308,12 @@ tests_custom_files = [
         "generate_logging": False,
         'use_matlab': False,
         'use_smart_caching': False,
+        'smart_caching_pipelines': [],
+        'smart_caching_provenance': False,
+        'smart_caching_local_size_limit': 0,
+        'smart_caching_compression': {},
+        'smart_caching_lazy_restore': False,
+        'smart_caching_reuse_fingerprints': False,
         'use_soma_workflow': False,
         'create_output_directories': True,
         'process_output_directory': False,
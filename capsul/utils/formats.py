@@ -0,0 +1,126 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Registry of the file formats made of several files.
+
+Files of some formats come with associated files: an Analyze '.img' image
+has a '.hdr' header, SPM writes '.mat' files next to the images it
+processes, AIMS writes '.minf' metadata files, and BIDS datasets store
+'.json' sidecars (with '.bval' and '.bvec' files for diffusion images) next
+to NIfTI images. The registry tells which files go along with a file,
+without listing its directory. It is used to
+copy process inputs, to store files in the smart-cache, to remove
+temporary files and to transfer files to computing resources.
+"""
+
+# System import
+import os
+import six
+
+# Formats: {name: {extension: [(associated extension, mandatory)]}}
+formats = {
+    "NIFTI-1": {".nii": [(".mat", False), (".json", False), (".bval", False),
+                         (".bvec", False)],
+                ".img": [(".hdr", True), (".mat", False)],
+                ".hdr": [(".img", True), (".mat", False)],
+                ".nii.gz": [(".json", False), (".bval", False),
+                            (".bvec", False)]},
+    "GIS": {".ima": [(".dim", True)],
+            ".dim": [(".ima", True)]},
+    "GIFTI": {".gii": []},
+    "MESH": {".mesh": []},
+    "ARG": {".arg": [(".data", False)]},
+}
+
+# Extension of the metadata files which may go along with any file
+# ('<file>.minf')
+metadata_extension = ".minf"
+
+# Formats merged in an extension based dict (formats names are lost here):
+# {extension: [(associated extension, mandatory)]}
+_merged_formats = {}
+
+
+def _merge_formats():
+    """ Update the extension based formats dict.
+    """
+    _merged_formats.clear()
+    for name, extensions in six.iteritems(formats):
+        _merged_formats.update(extensions)
+
+
+def register_format(name, extensions):
+    """ Register a file format.
+
+    Parameters
+    ----------
+    name: str
+        the format name. A format with the same name is replaced.
+    extensions: dict
+        map the format extensions (ex: '.img') to lists of (associated
+        extension, mandatory) tuples (ex: [('.hdr', True)]).
+    """
+    formats[name] = extensions
+    _merge_formats()
+
+
+def split_extension(path):
+    """ Split a file name into its base name and its registered extension.
+
+    The longest registered extension is used ('.nii.gz' rather than '.gz').
+
+    Parameters
+    ----------
+    path: str
+        the file name.
+
+    Returns
+    -------
+    base: str
+        the file name without extension.
+    extension: str
+        the registered extension, None if the file format is unknown.
+    """
+    bname_start = len(path) - len(os.path.basename(path))
+    position = path.find(".", bname_start)
+    while position >= 0:
+        extension = path[position:]
+        if extension in _merged_formats:
+            return path[:position], extension
+        position = path.find(".", position + 1)
+    return path, None
+
+
+def associated_files(path, existing_only=False):
+    """ Get the files which go along with a file.
+
+    Parameters
+    ----------
+    path: str
+        the file name.
+    existing_only: bool (optional, default False)
+        if True, only return existing files. Otherwise all the files
+        which may exist are returned.
+
+    Returns
+    -------
+    paths: list of str
+        the associated file names, the file itself excluded.
+    """
+    paths = []
+    base, extension = split_extension(path)
+    if extension is not None:
+        paths += [base + associated[0]
+                  for associated in _merged_formats[extension]]
+    paths.append(path + metadata_extension)
+    if existing_only:
+        paths = [afile for afile in paths if os.path.isfile(afile)]
+    return paths
+
+
+_merge_formats()
@@ -0,0 +1,165 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import errno
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+# Define the logger
+logger = logging.getLogger(__name__)
+
+
+def _list_directory(directory):
+    """ List the entries of a directory, with os.scandir when it is
+    available (python >= 3.5).
+
+    Returns
+    -------
+    names: set
+        the entries names.
+    links: set
+        the names of symbolic links entries, None if they are not known
+        (without os.scandir).
+    """
+    if hasattr(os, "scandir"):
+        names = set()
+        links = set()
+        for entry in os.scandir(directory):
+            names.add(entry.name)
+            if entry.is_symlink():
+                links.add(entry.name)
+        return names, links
+    return set(os.listdir(directory)), None
+
+
+class StatCache(object):
+    """ Cache of files existence, filled by directory listings.
+
+    Checking many files one by one is slow on network filesystems. The
+    cache lists each directory once instead, and can list the directories
+    of many files concurrently beforehand:
+
+    ::
+
+        stat_cache = StatCache()
+        stat_cache.prefetch(paths)
+        existing = [path for path in paths if stat_cache.exists(path)]
+
+    The cache is a snapshot: files created or removed after their directory
+    has been listed are not seen. Otherwise answers are those of
+    os.path.exists(): symbolic links are followed (broken links do not
+    exist), and names which only differ from a listed entry by their case
+    are checked on the filesystem, which may be case-insensitive.
+    """
+    def __init__(self, workers=8):
+        """ Initialize the StatCache class.
+
+        Parameters
+        ----------
+        workers: int (optional, default 8)
+            the number of directories listed concurrently by
+            :py:meth:`prefetch`.
+        """
+        self.workers = workers
+        # map directories to (entries names, symbolic links names, lower
+        # case entries names) tuples, or to None if they cannot be listed
+        # (files are then checked one by one)
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def _scan(self, directory):
+        """ List a directory and store its entries.
+
+        Parameters
+        ----------
+        directory: str
+            an absolute directory name.
+        """
+        try:
+            names, links = _list_directory(directory)
+            listing = (names, links, set(name.lower() for name in names))
+        except (IOError, OSError) as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                listing = (set(), set(), set())
+            else:
+                # not readable, but its files may be accessible
+                logger.debug("cannot list '{0}': {1}".format(directory, e))
+                listing = None
+        with self._lock:
+            self._listings[directory] = listing
+
+    def prefetch(self, paths):
+        """ List the directories of files concurrently.
+
+        Parameters
+        ----------
+        paths: iterable of str
+            the files which will be checked.
+        """
+        directories = set()
+        for path in paths:
+            if not path:
+                continue
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory not in self._listings:
+                directories.add(directory)
+        if len(directories) > 1 and self.workers > 1:
+            pool = ThreadPool(min(self.workers, len(directories)))
+            try:
+                pool.map(self._scan, sorted(directories))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for directory in directories:
+                self._scan(directory)
+
+    def exists(self, path):
+        """ Check if a file or directory exists.
+
+        Parameters
+        ----------
+        path: str
+            the file name.
+
+        Returns
+        -------
+        exists: bool
+            True if the path exists.
+        """
+        if not path:
+            return False
+        path = os.path.abspath(path)
+        directory, name = os.path.split(path)
+        if not name:
+            # filesystem root
+            return os.path.exists(path)
+        if directory not in self._listings:
+            self._scan(directory)
+        listing = self._listings[directory]
+        if listing is None:
+            return os.path.exists(path)
+        names, links, lower_names = listing
+        if name in names:
+            if links is None or name in links:
+                # the link target has to exist
+                return os.path.exists(path)
+            return True
+        if name.lower() in lower_names:
+            # the filesystem may be case-insensitive
+            return os.path.exists(path)
+        return False
+
+    def clear(self):
+        """ Forget the directories listings.
+        """
+        with self._lock:
+            self._listings.clear()
@@ -0,0 +1,70 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+
+# Capsul import
+from capsul.utils import formats
+from capsul.utils.formats import associated_files
+from capsul.utils.formats import split_extension
+from capsul.utils.formats import register_format
+
+
+class TestFormats(unittest.TestCase):
+    """ Test the files formats registry.
+    """
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+        formats.formats.pop("TEST", None)
+        formats._merge_formats()
+
+    def test_associated_files(self):
+        """ Test the files associated with a file.
+        """
+        self.assertEqual(split_extension("/tmp/a.b/c.nii.gz"),
+                         ("/tmp/a.b/c", ".nii.gz"))
+        self.assertEqual(split_extension("/tmp/a.b/c.txt"),
+                         ("/tmp/a.b/c.txt", None))
+        self.assertEqual(associated_files("/tmp/c.img"),
+                         ["/tmp/c.hdr", "/tmp/c.mat", "/tmp/c.img.minf"])
+        self.assertEqual(associated_files("/tmp/c.txt"), ["/tmp/c.txt.minf"])
+        self.assertEqual(associated_files("/tmp/c.nii.gz"),
+                         ["/tmp/c.json", "/tmp/c.bval", "/tmp/c.bvec",
+                          "/tmp/c.nii.gz.minf"])
+
+        # Only existing files may be returned
+        image = os.path.join(self.workspace_dir, "c.img")
+        for fname in ["c.img", "c.hdr", "c.img.minf", "c.txt"]:
+            open(os.path.join(self.workspace_dir, fname), "w").close()
+        self.assertEqual(associated_files(image, existing_only=True),
+                         [os.path.join(self.workspace_dir, "c.hdr"),
+                          image + ".minf"])
+
+        # Register a new format
+        register_format("TEST", {".txt": [(".json", False)]})
+        self.assertEqual(associated_files("/tmp/c.txt"),
+                         ["/tmp/c.json", "/tmp/c.txt.minf"])
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFormats)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,141 @@
+##########################################################################
+# CAPSUL - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import unittest
+import os
+import tempfile
+import shutil
+
+# Capsul import
+from capsul.api import Process
+from capsul.api import Pipeline
+from capsul.api import get_process_instance
+from capsul.pipeline.pipeline_tools import nodes_with_existing_outputs
+from capsul.pipeline.pipeline_tools import nodes_with_missing_inputs
+from capsul.utils.stat_cache import StatCache
+
+# Trait import
+from traits.api import File
+
+
+class FileProcess(Process):
+    """ Dummy file processing.
+    """
+    input_image = File(optional=False, desc="an input file")
+    output_image = File(output=True, desc="an output file")
+
+    def _run_process(self):
+        pass
+
+
+class FilePipeline(Pipeline):
+    """ Chain of two file processes.
+    """
+    def pipeline_definition(self):
+        self.add_process("first", FileProcess)
+        self.add_process("second", FileProcess)
+        self.add_link("first.output_image->second.input_image")
+        self.export_parameter("first", "input_image")
+        self.export_parameter("first", "output_image", "first_output")
+        self.export_parameter("second", "output_image")
+
+
+class TestStatCache(unittest.TestCase):
+    """ Test the files existence cache.
+    """
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        for dname in ["a", "b"]:
+            os.mkdir(os.path.join(self.workspace_dir, dname))
+            open(os.path.join(self.workspace_dir, dname, "in.nii"),
+                 "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+
+    def test_exists(self):
+        """ Test files existence checks.
+        """
+        stat_cache = StatCache()
+        paths = [os.path.join(self.workspace_dir, "a", "in.nii"),
+                 os.path.join(self.workspace_dir, "b", "in.nii"),
+                 os.path.join(self.workspace_dir, "b", "out.nii"),
+                 os.path.join(self.workspace_dir, "c", "in.nii"),
+                 os.path.join(self.workspace_dir, "b")]
+        stat_cache.prefetch(paths)
+        self.assertEqual([stat_cache.exists(path) for path in paths],
+                         [True, True, False, False, True])
+        self.assertFalse(stat_cache.exists(""))
+
+        # The cache is a snapshot
+        open(paths[2], "w").close()
+        self.assertFalse(stat_cache.exists(paths[2]))
+        stat_cache.clear()
+        self.assertTrue(stat_cache.exists(paths[2]))
+
+    def test_exists_semantics(self):
+        """ Test that answers match os.path.exists().
+        """
+        stat_cache = StatCache()
+        directory = os.path.join(self.workspace_dir, "a")
+        existing = os.path.join(directory, "in.nii")
+        link = os.path.join(directory, "link.nii")
+        broken_link = os.path.join(directory, "broken.nii")
+        os.symlink(existing, link)
+        os.symlink(os.path.join(directory, "missing.nii"), broken_link)
+        other_case = os.path.join(directory, "IN.nii")
+        paths = [existing, link, broken_link, other_case]
+        stat_cache.prefetch(paths)
+        self.assertEqual([stat_cache.exists(path) for path in paths],
+                         [os.path.exists(path) for path in paths])
+        self.assertEqual([stat_cache.exists(path) for path in paths[:3]],
+                         [True, True, False])
+
+    def test_pipeline_checks(self):
+        """ Test the existing outputs and missing inputs of pipelines.
+        """
+        pipeline = get_process_instance(FilePipeline)
+        pipeline.input_image = os.path.join(self.workspace_dir, "a",
+                                            "missing.nii")
+        pipeline.first_output = os.path.join(self.workspace_dir, "b",
+                                             "in.nii")
+        pipeline.output_image = os.path.join(self.workspace_dir, "b",
+                                             "out.nii")
+        self.assertEqual(nodes_with_existing_outputs(pipeline),
+                         {"first": [("output_image",
+                                     pipeline.first_output)]})
+        self.assertEqual(nodes_with_missing_inputs(pipeline),
+                         {"first": [("input_image", pipeline.input_image)]})
+
+        # A shared cache lists each directory once
+        scanned = []
+
+        class CountingStatCache(StatCache):
+            def _scan(self, directory):
+                scanned.append(directory)
+                super(CountingStatCache, self)._scan(directory)
+
+        stat_cache = CountingStatCache()
+        nodes_with_existing_outputs(pipeline, stat_cache=stat_cache)
+        nodes_with_missing_inputs(pipeline, stat_cache=stat_cache)
+        self.assertEqual(sorted(scanned),
+                         [os.path.join(self.workspace_dir, "a"),
+                          os.path.join(self.workspace_dir, "b")])
+
+
+def test():
+    """ Function to execute unitest
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStatCache)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()